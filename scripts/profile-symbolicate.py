@@ -1,6 +1,21 @@
 #!/usr/bin/python
 
-import argparse, bisect, json, os, subprocess, sys
+import argparse, bisect, cPickle, hashlib, itertools, json, multiprocessing, multiprocessing.pool, os, re, shutil
+import sqlite3, subprocess, sys, tempfile, time
+
+# We share fix_b2g_stack.py's ELF reader, and its library index code and
+# on-disk format (though our indexes live in files of their own; see
+# GetLibIndex).
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+import include.elf_utils as elf_utils
+import include.lib_index as lib_index
+
+try:
+  import numpy as np
+except ImportError:
+  # Libraries.ScanLocations and the libraries' lookups are much faster with
+  # numpy, but work without it.
+  np = None
 
 gSpecialLibs = {
     # The [vectors] is a special section used for functions which can really
@@ -14,80 +29,423 @@ gSpecialLibs = {
     }
 }
 
+# (absolute path of a tree, name of directories we skip) --> LibIndex of the tree
+gLibIndexes = {}
+
+# Shared libraries (e.g. libxul.so, libstagefright.so.1) and executables
+# (e.g. b2g, app_process), which have no extension.
+gLibNameRe = re.compile(r"\.so(\.[0-9]+)*$|^[^.]+$")
+
+def IsLibName(basename):
+  """Decides whether GetLibIndex's indexes include a file."""
+  return gLibNameRe.search(basename) is not None
+
+def GetLibIndex(dir, exclude_dir=None):
+  """Gets the LibIndex of the libraries and executables in a tree, which every
+  Library searching the tree shares."""
+  key = (os.path.abspath(dir), exclude_dir)
+  if key not in gLibIndexes:
+    exclude_dirs = [exclude_dir] if exclude_dir else []
+    gLibIndexes[key] = lib_index.LibIndex(CacheFilename("libindex", key), [dir],
+                                          file_filter=IsLibName, exclude_dirs=exclude_dirs)
+  return gLibIndexes[key]
+
+def SaveLibIndexes():
+  """Saves the library indexes, so the next run only has to look at directories which changed."""
+  for index in gLibIndexes.values():
+    index.save()
+
+def CacheFilename(kind, key):
+  """Gets the name of a file, next to the library indexes, in which we persist something about key."""
+  return os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      ".profile-symbolicate-%s.%s" % (hashlib.md5(repr(key)).hexdigest(), kind))
+
+def PruneCacheFiles(kind, keep):
+  """Deletes all but the keep most recently modified of the files CacheFilename
+  names for kind."""
+  dir = os.path.dirname(os.path.abspath(__file__))
+  suffix = "." + kind
+  files = []
+  for name in os.listdir(dir):
+    if name.startswith(".profile-symbolicate-") and name.endswith(suffix):
+      path = os.path.join(dir, name)
+      files.append((os.stat(path).st_mtime, path))
+  files.sort(reverse=True)
+  for _, path in files[keep:]:
+    os.remove(path)
+
+def TargetToolsPrefix():
+  if "TARGET_TOOLS_PREFIX" in os.environ:
+    return os.environ["TARGET_TOOLS_PREFIX"]
+  return "arm-eabi-"
+
+###############################################################################
+#
+# SymbolCache class. Remembers the functions at offsets into libraries between
+# runs, so that profiling the same build again doesn't resolve them again.
+# Like fix_b2g_stack.py's cache, we remember when each entry was last used,
+# and when the cache outgrows its limit, drop the least recently used ones.
+#
+###############################################################################
+
+class SymbolCache:
+  # Bump this when changing the table below or what we store in it; we discard
+  # caches written with a different schema.
+  SCHEMA_VERSION = 1
+
+  # When the cache outgrows its limit, shrink it to this fraction of the
+  # limit, so that we don't have to evict again on the next run.
+  EVICT_TO = 0.9
+
+  # Record that an entry has been used only if we last recorded that more
+  # than this many seconds ago, so that reading from the cache rarely writes
+  # to it.
+  TOUCH_INTERVAL = 24 * 60 * 60
+
+  def __init__(self, filename, max_size):
+    """If we can't open the cache, it just never finds anything. max_size is
+    how many bytes the cache may grow to, or 0 for no limit."""
+    self.max_size = max_size
+    # (lib key, offset) of the entries whose last_used we should update.
+    self.touched = []
+    self.db = None
+    try:
+      db = sqlite3.connect(filename, timeout=30)
+      db.text_factory = str
+      try:
+        db.execute("PRAGMA journal_mode=WAL")
+      except sqlite3.DatabaseError:
+        pass
+      with db:
+        (version,) = db.execute("PRAGMA user_version").fetchone()
+        if version != SymbolCache.SCHEMA_VERSION:
+          db.execute("DROP TABLE IF EXISTS functions")
+          db.execute("PRAGMA user_version = %d" % SymbolCache.SCHEMA_VERSION)
+        db.execute("""CREATE TABLE IF NOT EXISTS functions (
+                        lib TEXT NOT NULL,
+                        offset INTEGER NOT NULL,
+                        func TEXT NOT NULL,
+                        last_used REAL NOT NULL,
+                        PRIMARY KEY (lib, offset))""")
+      self.db = db
+    except sqlite3.Error:
+      pass
+
+  @staticmethod
+  def Filename():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), ".profile-symbolicate.sqlite")
+
+  def Get(self, lib_key, offsets):
+    """Returns a dict mapping the offsets into the library which we know about to their functions."""
+    functions = {}
+    if not self.db:
+      return functions
+    stale = time.time() - SymbolCache.TOUCH_INTERVAL
+    # Stay under sqlite's limit on the number of parameters in a statement.
+    for i in range(0, len(offsets), 500):
+      chunk = offsets[i:i+500]
+      query = ("SELECT offset, func, last_used FROM functions WHERE lib = ? AND offset IN (%s)" %
+               ",".join(["?"] * len(chunk)))
+      try:
+        for offset, func, last_used in self.db.execute(query, [lib_key] + chunk):
+          functions[offset] = func
+          if last_used < stale:
+            self.touched.append((lib_key, offset))
+      except sqlite3.Error:
+        break
+    return functions
+
+  def Put(self, lib_key, functions):
+    """Stores a dict mapping offsets into the library to their functions."""
+    if not self.db:
+      return
+    now = time.time()
+    try:
+      self.db.executemany("INSERT OR REPLACE INTO functions (lib, offset, func, last_used) "
+                          "VALUES (?, ?, ?, ?)",
+                          [(lib_key, offset, func, now) for offset, func in functions.items()])
+    except sqlite3.Error:
+      pass
+
+  def Evict(self):
+    """If the cache has outgrown max_size, drops the least recently used
+    entries to shrink it to EVICT_TO of that. Deleted rows leave free pages
+    in the file, which later inserts reuse."""
+    if not self.max_size:
+      return
+    (page_size,) = self.db.execute("PRAGMA page_size").fetchone()
+    (page_count,) = self.db.execute("PRAGMA page_count").fetchone()
+    (free_pages,) = self.db.execute("PRAGMA freelist_count").fetchone()
+    size = (page_count - free_pages) * page_size
+    if size <= self.max_size:
+      return
+    (entries,) = self.db.execute("SELECT COUNT(*) FROM functions").fetchone()
+    # Assume every entry takes the same amount of space.
+    excess = int(entries * (1 - SymbolCache.EVICT_TO * self.max_size / float(size)))
+    self.db.execute("DELETE FROM functions WHERE rowid IN "
+                    "(SELECT rowid FROM functions ORDER BY last_used LIMIT ?)", (excess,))
+
+  def Close(self):
+    if not self.db:
+      return
+    try:
+      self.db.executemany("UPDATE functions SET last_used = ? WHERE lib = ? AND offset = ?",
+                          [(time.time(), lib_key, offset) for lib_key, offset in self.touched])
+      self.Evict()
+      self.db.commit()
+    except sqlite3.Error:
+      # Someone else held the write lock for longer than our timeout; we'll
+      # just have to resolve these again next time.
+      pass
+    self.db.close()
+
+###############################################################################
+#
+# SymbolTable class. Maps addresses to the functions which contain them, given
+# where each function starts and, if we know, how big it is.
+#
+###############################################################################
+
+class SymbolTable:
+  # Bump this whenever the format of saved symbol tables changes.
+  FORMAT_VERSION = 1
+
+  # We keep the tables of this many libraries, the ones we've used most
+  # recently, on disk.
+  MAX_SAVED_TABLES = 16
+
+  # The end of a function whose size we don't know.
+  NO_END = (1 << 63) - 1
+
+  def __init__(self, symbols):
+    """symbols is a list of (start address, name, size) triples, in any
+    order. A size of 0 or None means we don't know where the function ends,
+    so it runs up to the next one."""
+    symbols = sorted(symbols)
+    # Each distinct name is stored once; name_ids index into names.
+    self.names = []
+    name_ids = {}
+    for start, name, size in symbols:
+      if name not in name_ids:
+        name_ids[name] = len(self.names)
+        self.names.append(name)
+    self.starts = [start for start, name, size in symbols]
+    self.ends = [start + size if size else SymbolTable.NO_END for start, name, size in symbols]
+    self.name_ids = [name_ids[name] for start, name, size in symbols]
+    self.MakeArrays()
+
+  def MakeArrays(self):
+    """Makes the numpy arrays Lookup uses, if we have numpy."""
+    if np is not None:
+      self.starts_array = np.array(self.starts, dtype=np.int64)
+      self.ends_array = np.array(self.ends, dtype=np.int64)
+
+  def Lookup(self, addresses):
+    """Gets the name of the function containing each of a list of addresses,
+    or None for addresses below the first function or past the end of the
+    function below them."""
+    if not self.starts:
+      return [None] * len(addresses)
+    if np is not None:
+      addresses = np.asarray(addresses, dtype=np.int64)
+      indices = np.searchsorted(self.starts_array, addresses, side="right") - 1
+      found = (indices >= 0) & (addresses < self.ends_array[indices])
+      indices = np.where(found, indices, -1).tolist()
+    else:
+      indices = [bisect.bisect_right(self.starts, address) - 1 for address in addresses]
+      indices = [i if i >= 0 and address < self.ends[i] else -1
+                 for address, i in zip(addresses, indices)]
+    return [self.names[self.name_ids[i]] if i >= 0 else None for i in indices]
+
+  @staticmethod
+  def FromNm(lib_path):
+    """Builds a table of the functions in a library from nm's output."""
+    symbols = []
+    for nm_args in [["-C", "-S", "--defined-only"], ["-C", "-S", "-D", "--defined-only"]]:
+      # Stripped libraries only have dynamic symbols.
+      output = subprocess.check_output([TargetToolsPrefix() + "nm"] + nm_args + [lib_path])
+      for line in output.split("\n"):
+        # Lines look like "0001c9a5 00000010 T PR_IntervalNow", or
+        # "0001c9a5 T PR_IntervalNow" for a symbol without a size.
+        fields = line.split(" ", 2)
+        size = 0
+        if len(fields) == 3 and len(fields[1]) > 1:
+          size = int(fields[1], 16)
+          fields = [fields[0]] + fields[2].split(" ", 1)
+        if len(fields) == 3 and fields[1] in "TtWw":
+          symbols.append((int(fields[0], 16), fields[2], size))
+      if symbols:
+        break
+    return SymbolTable(symbols)
+
+  @staticmethod
+  def ForLib(lib_path):
+    """Gets the table of the functions in a library. We save the table, so we
+    only run nm again when the library changes."""
+    st = os.stat(lib_path)
+    stamp = (st.st_size, st.st_mtime)
+    filename = CacheFilename("symtab", os.path.abspath(lib_path))
+    try:
+      with open(filename, "rb") as f:
+        data = cPickle.load(f)
+      if data["version"] == SymbolTable.FORMAT_VERSION and data["stamp"] == stamp:
+        table = SymbolTable([])
+        table.starts = data["starts"]
+        table.ends = data["ends"]
+        table.names = data["names"]
+        table.name_ids = data["name_ids"]
+        table.MakeArrays()
+        # Mark the table as recently used; see PruneCacheFiles.
+        os.utime(filename, None)
+        return table
+    except (EOFError, IOError, OSError, KeyError, ValueError, cPickle.PickleError):
+      pass
+
+    table = SymbolTable.FromNm(lib_path)
+    try:
+      (fd, tmp_filename) = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=".profile-symbolicate")
+      with os.fdopen(fd, "wb") as f:
+        cPickle.dump({"version": SymbolTable.FORMAT_VERSION, "stamp": stamp,
+                      "starts": table.starts, "ends": table.ends,
+                      "names": table.names, "name_ids": table.name_ids},
+                     f, cPickle.HIGHEST_PROTOCOL)
+      os.rename(tmp_filename, filename)
+      PruneCacheFiles("symtab", SymbolTable.MAX_SAVED_TABLES)
+    except (IOError, OSError, cPickle.PickleError):
+      pass
+    return table
+
 ###############################################################################
 #
 # Library class. There is an instance of this for each library in the profile.
 #
 ###############################################################################
 
+def NoAddresses():
+  """Gets an empty set of addresses, in the form Library.unresolved_addresses takes."""
+  if np is not None:
+    return np.zeros(0, dtype=np.uint64)
+  return set()
+
+def AddressList(addresses):
+  """Converts a list or numpy array of addresses into a list of ints."""
+  if np is not None and isinstance(addresses, np.ndarray):
+    return addresses.tolist()
+  return list(addresses)
+
 class Library:
   def __init__(self, lib_dict, verbose=False):
     """lib_dict will be the JSON dictionary from the profile"""
     self.start = lib_dict["start"]
     self.end = lib_dict["end"]
     self.offset = lib_dict["offset"]
-    self.target_name = lib_dict["name"]
+    # Newer profiles give the library's basename as its name, and where it
+    # lives on the device as its path.
+    self.target_name = lib_dict.get("path", lib_dict["name"])
     self.verbose = verbose
     self.host_name = None
     self.located = False
+    # The symbols we've found, by address. We only format the addresses as
+    # 0xAAAAAAAA strings when we write the symbols out.
     self.symbols = {}
+    # The addresses which we have yet to translate into symbols: a sorted
+    # numpy uint64 array if we have numpy, else a set.
+    self.unresolved_addresses = NoAddresses()
     self.symbol_table = None
-    self.symbol_table_addresses = None
+    # The key we cache our functions under (see CacheKey), and the functions
+    # we've resolved, by library address, for Libraries.ResolveSymbols to
+    # cache.
+    self.cache_key = None
+    self.resolved_functions = {}
 
-  def AddressToSymbol(self, address_str):
+  def AddressToSymbol(self, address):
     """Attempts to convert an address into a symbol."""
-    return self.AddressesToSymbols([address_str])[0]
+    return self.AddressesToSymbols([address])[0]
 
-  def AddressesToSymbols(self, addresses_strs):
-    """Converts multiple addresses into symbols."""
+  def AddressesToSymbols(self, addresses):
+    """Converts multiple addresses (a list, or a numpy array) into symbols."""
     if not self.located:
       self.Locate()
     if self.symbol_table:
-      return self.LookupAddressesInSymbolTable(addresses_strs)
+      return self.LookupAddressesInSymbolTable(addresses)
     if not self.host_name:
       unknown = "Unknown (in " + self.target_name + ")"
-      return [unknown for i in range(len(addresses_strs))]
-    if "TARGET_TOOLS_PREFIX" in os.environ:
-      target_tools_prefix = os.environ["TARGET_TOOLS_PREFIX"]
+      return [unknown for i in range(len(addresses))]
+    args = [TargetToolsPrefix() + "addr2line", "-C", "-f", "-e", self.host_name]
+    lib_addresses = self.LibAddresses(addresses)
+    # Fix up addresses from stack frames; they're for the insn after
+    # the call, which might be different function thanks to inlining:
+    if np is not None:
+      adj_addresses = ((lib_addresses & ~1) - 1).tolist()
+      lib_addresses = lib_addresses.tolist()
     else:
-      target_tools_prefix = "arm-eabi-"
-    args = [target_tools_prefix + "addr2line", "-C", "-f", "-e", self.host_name]
-    nm_args = ["gecko/tools/profiler/nm-symbolicate.py", self.host_name]
-    for address_str in addresses_strs:
-      lib_address = int(address_str, 0) - self.start + self.offset
-      if self.verbose:
-        print "Address %s maps to library '%s' offset 0x%08x" % (address_str, self.host_name, lib_address)
-      # Fix up addresses from stack frames; they're for the insn after
-      # the call, which might be different function thanks to inlining:
-      adj_address = (lib_address & ~1) - 1
-      args.append("0x%08x" % adj_address)
-      nm_args.append("0x%08x" % adj_address)
-    # Calling addr2line will return 2 lines for each address. The output will be something
-    # like the following:
+      adj_addresses = [(lib_address & ~1) - 1 for lib_address in lib_addresses]
+    if self.verbose:
+      for address, lib_address in zip(AddressList(addresses), lib_addresses):
+        print "Address 0x%08x maps to library '%s' offset 0x%08x" % (address, self.host_name, lib_address)
+    # We start a single addr2line for all of the addresses, and feed them to it
+    # on stdin. It will return 2 lines for each address. The output will be
+    # something like the following:
     #   PR_IntervalNow
     #   /home/work/B2G-profiler/mozilla-inbound/nsprpub/pr/src/misc/prinrval.c:43
     #   PR_Unlock
     #   /home/work/B2G-profiler/mozilla-inbound/nsprpub/pr/src/pthreads/ptsynch.c:191
-    syms_and_lines = subprocess.check_output(args).split("\n")
+    addr2line = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output = addr2line.communicate("".join(["0x%08x\n" % a for a in adj_addresses]))[0]
+    if addr2line.returncode:
+      raise subprocess.CalledProcessError(addr2line.returncode, args)
+    funcs = output.split("\n")[0:2 * len(adj_addresses):2]
 
-    # Check if we had no useful output from addr2line. If so well try using the symbol table
+    # For the addresses addr2line couldn't name, try using the symbol table
     # from nm.
-    has_good_line = False
-    for line in syms_and_lines:
-      if line != "??" and line != "??:0" and line != "":
-        has_good_line = True
-    if has_good_line == False:
-      syms_and_lines = subprocess.check_output(nm_args).split("\n")
+    unknown = [i for i in range(len(funcs)) if funcs[i] == "??"]
+    if unknown:
+      names = SymbolTable.ForLib(self.host_name).Lookup([adj_addresses[i] for i in unknown])
+      for i, name in zip(unknown, names):
+        funcs[i] = name or "??"
+    # Don't cache the addresses we couldn't name, so that we try them again
+    # next time rather than remembering a failure.
+    self.resolved_functions.update((lib_address, func) for lib_address, func
+                                   in zip(lib_addresses, funcs) if func != "??")
 
     syms = []
-    for i in range(len(addresses_strs)):
-      syms.append(syms_and_lines[i*2] + " (in " + self.target_name + ")")
+    for func in funcs:
+      syms.append(func + " (in " + self.target_name + ")")
     return syms
 
+  def LibAddresses(self, addresses):
+    """Converts addresses in the profile into offsets into the library file,
+    as an int64 array if we have numpy, else a list."""
+    if np is not None:
+      return np.asarray(addresses, dtype=np.int64) - self.start + self.offset
+    return [address - self.start + self.offset for address in addresses]
+
+  def CacheKey(self):
+    """Gets the key we cache this library's functions under, or None if we
+    shouldn't cache them. We key on the library's build-id, which identifies
+    its contents. Stripped and unstripped copies share a build-id but not
+    symbols, so we keep their functions apart."""
+    if not self.host_name or self.symbol_table:
+      return None
+    try:
+      with elf_utils.ElfFile(self.host_name) as elf:
+        build_id = elf.build_id()
+        if not build_id:
+          return None
+        if elf.has_symbols():
+          return build_id
+        return build_id + ":stripped"
+    except (IOError, OSError, elf_utils.ElfError):
+      return None
+
   def AddUnresolvedAddress(self, address):
-    """Stores an address into a set of addresses which will be translated into symbols later"""
-    # The output format wants the addresses as 0xAAAAAAAA, so we store the keys as strings
-    self.symbols["0x%08x" % address] = None
+    """Stores an address into the set of addresses which will be translated
+    into symbols later (without numpy; see AddUnresolvedAddresses)"""
+    self.unresolved_addresses.add(address)
+
+  def AddUnresolvedAddresses(self, addresses):
+    """Stores a sorted numpy array of distinct addresses which will be translated into symbols later"""
+    self.unresolved_addresses = np.union1d(self.unresolved_addresses, addresses)
 
   def ContainsAddress(self, address):
     """Determines if the indicated address is contained in this library"""
@@ -100,20 +458,17 @@ class Library:
 
   def DumpSymbols(self):
     """Dumps out some information about the symbols in this library."""
-    for address_str in sorted(self.symbols.keys()):
-      print address_str, self.symbols[address_str]
+    for address in sorted(self.symbols.keys()):
+      print "0x%08x" % address, self.symbols[address]
 
   def FindLibInTree(self, basename, dir, exclude_dir=None):
     """Search a tree for a library and return the first one found"""
-    args = ["find", dir]
-    if exclude_dir:
-      args = args + ["!", "(", "-name", exclude_dir, "-prune", ")"]
-    args = args + ["-name", basename, "-type", "f", "-print", "-quit"]
-    fullname = subprocess.check_output(args)
-    if len(fullname) > 0:
-      if fullname[-1] == "\n":
-        return fullname[:-1]
-      return fullname
+    # Rather than running find over the whole tree for every library, we look
+    # the library up in an index of the tree which persists between runs.
+    for path in GetLibIndex(dir, exclude_dir).find(basename):
+      # Like find -type f, skip symlinks.
+      if os.path.isfile(path) and not os.path.islink(path):
+        return path
     return None
 
   def Locate(self):
@@ -155,8 +510,8 @@ class Library:
         if self.verbose:
           print "Found '" + self.host_name + "' for '" + self.target_name + "'"
     elif self.target_name in gSpecialLibs:
-      self.symbol_table = gSpecialLibs[self.target_name]
-      self.symbol_table_addresses = sorted(self.symbol_table.keys())
+      self.symbol_table = SymbolTable([(int(address_str, 0), name, None) for address_str, name
+                                       in gSpecialLibs[self.target_name].items()])
     elif self.target_name[:1] == "/": # Absolute paths.
       basename = os.path.basename(self.target_name)
       dirname = os.path.dirname(self.target_name)
@@ -168,36 +523,61 @@ class Library:
           print "Found '" + self.host_name + "' for '" + self.target_name + "'"
     self.located = True
 
-  def LookupAddressInSymbolTable(self, address_str):
+  def LookupAddressInSymbolTable(self, address):
     """Lookup an address using a special symbol_table."""
-    i = bisect.bisect(self.symbol_table_addresses, address_str)
-    if i:
-      i = i - 1
-    if address_str >= self.symbol_table_addresses[i]:
-      sym = self.symbol_table[self.symbol_table_addresses[i]]
-    else:
-      sym = "Unknown"
-    return sym + " (in " + self.target_name + ")"
+    return self.LookupAddressesInSymbolTable([address])[0]
 
   def LookupAddressesInSymbolTable(self, addresses):
     """Looks up multiple addresses using the special symbol table."""
-    syms = []
-    for address in addresses:
-      syms.append(self.LookupAddressInSymbolTable(address))
-    return syms
+    names = self.symbol_table.Lookup(addresses)
+    return [(name or "Unknown") + " (in " + self.target_name + ")" for name in names]
+
+  def NumUnresolvedAddresses(self):
+    """Returns how many addresses ResolveSymbols has to translate."""
+    return len(self.unresolved_addresses)
+
+  def UnresolvedAddresses(self):
+    """Gets the addresses which ResolveSymbols has to translate, in order."""
+    if np is not None:
+      return self.unresolved_addresses
+    return sorted(self.unresolved_addresses)
+
+  def UseCachedSymbols(self, cache, progress=False):
+    """Fills in the symbols which the SymbolCache cache knows about."""
+    self.cache_key = self.CacheKey()
+    if not self.cache_key or not self.NumUnresolvedAddresses():
+      return
+    addresses = self.UnresolvedAddresses()
+    offsets = self.LibAddresses(addresses)
+    functions = cache.Get(self.cache_key, AddressList(offsets))
+    if np is not None:
+      cached = np.in1d(offsets, np.fromiter(functions.iterkeys(), dtype=np.int64, count=len(functions)))
+      self.unresolved_addresses = addresses[~cached]
+      cached = zip(addresses[cached].tolist(), offsets[cached].tolist())
+    else:
+      cached = [(address, offset) for address, offset in zip(addresses, offsets) if offset in functions]
+      self.unresolved_addresses.difference_update([address for address, offset in cached])
+    for address, offset in cached:
+      self.symbols[address] = functions[offset] + " (in " + self.target_name + ")"
+    if progress and functions:
+      print "Found %d of %s's symbols in the cache" % (len(functions), self.target_name)
+
+  def CacheSymbols(self, cache):
+    """Stores the functions we've resolved in the SymbolCache cache."""
+    if self.cache_key and self.resolved_functions:
+      cache.Put(self.cache_key, self.resolved_functions)
+    self.resolved_functions = {}
 
   def ResolveSymbols(self, progress=False):
     """Tries to convert all of the symbols into symbolic equivalents."""
-    if len(self.symbols) == 0:
+    addresses = self.UnresolvedAddresses()
+    if len(addresses) == 0:
       return
-    addresses_strs = self.symbols.keys()
-    for i in range(0,len(addresses_strs), 256):
-      slice = addresses_strs[i:i+256]
-      if progress:
-        print "Resolving symbols for", self.target_name, len(slice), "addresses"
-      syms = self.AddressesToSymbols(slice)
-      for j in range(len(syms)):
-        self.symbols[addresses_strs[i+j]] = syms[j]
+    if progress:
+      print "Resolving symbols for %s %d addresses" % (self.target_name, len(addresses))
+    syms = self.AddressesToSymbols(addresses)
+    self.symbols.update(zip(AddressList(addresses), syms))
+    self.unresolved_addresses = NoAddresses()
 
 ###############################################################################
 #
@@ -207,7 +587,10 @@ class Library:
 
 class Libraries:
   def __init__(self, profile, verbose=False):
-    lib_dicts = json.loads(profile["libs"])
+    lib_dicts = profile["libs"]
+    if isinstance(lib_dicts, basestring):
+      # Older profiles store the libraries as a string of JSON.
+      lib_dicts = json.loads(lib_dicts)
     lib_dicts = sorted(lib_dicts, key=lambda lib: lib["start"])
     self.libs = [Library(lib_dict, verbose=verbose) for lib_dict in lib_dicts]
     # Create a sorted list of just the start addresses so that we can use
@@ -242,39 +625,303 @@ class Libraries:
       self.last_lib = self.AddressToLib(address)
     return self.last_lib
 
-  def ResolveSymbols(self, progress=True):
-    """Tries to convert all of the symbols into symbolic equivalents."""
-    for lib in self.libs:
-      lib.ResolveSymbols(progress=progress)
+  def ResolveSymbols(self, progress=True, cache_max_size=0):
+    """Tries to convert all of the symbols into symbolic equivalents.
+
+    We resolve several libraries at once, on a pool of threads sized to this
+    machine; the real work happens in each library's addr2line process. The
+    libraries with the most addresses go first, so that a big libxul doesn't
+    hold up all of the small libraries behind it.
+
+    Only the addresses which aren't in our SymbolCache go to the resolvers,
+    and we add what they find to the cache, which may grow to cache_max_size
+    bytes (0 for no limit)."""
+    libs = [lib for lib in self.libs if lib.NumUnresolvedAddresses()]
+    if not libs:
+      return
+    # Locating libraries uses the shared library indexes, and sqlite
+    # connections belong to one thread, so do those up front, on this thread.
+    for lib in libs:
+      lib.Locate()
+    cache = SymbolCache(SymbolCache.Filename(), cache_max_size)
+    try:
+      for lib in libs:
+        lib.UseCachedSymbols(cache, progress=progress)
+      libs = [lib for lib in libs if lib.NumUnresolvedAddresses()]
+      if not libs:
+        return
+      libs.sort(key=lambda lib: lib.NumUnresolvedAddresses(), reverse=True)
+      pool = multiprocessing.pool.ThreadPool(min(multiprocessing.cpu_count(), len(libs)))
+      try:
+        for _ in pool.imap_unordered(lambda lib: lib.ResolveSymbols(progress=progress), libs):
+          pass
+      finally:
+        pool.close()
+        pool.join()
+      for lib in libs:
+        lib.CacheSymbols(cache)
+    finally:
+      cache.Close()
 
   def ScanLocations(self, progress=False):
     """Scans through the locations and builds a set of unresolved addresses for each library."""
     if progress:
       print "Scanning for unresolved addresses..."
-    last_address = None
-    for thread in self.profile["threads"]:
-      samples = thread["samples"]
-      for sample in samples:
-        frames = sample["frames"]
-        for frame in frames:
-          address_str = frame["location"]
-          if address_str[:2] == "0x":
-            address = int(address_str, 0)
-            # Quick optimization since lots of times the same address appears
-            # many times in a row. We only need to add each address once.
-            if address != last_address:
-              lib = self.Lookup(address)
-              if lib:
-                lib.AddUnresolvedAddress(address)
-                last_address = address
+    self.AddLocations(itertools.chain.from_iterable(
+        [ThreadLocations(thread) for thread in self.profile["threads"]]))
+
+  def AddLocations(self, locations):
+    """Builds the sets of unresolved addresses from an iterable of distinct frame
+    locations (distinct within each thread, at least)."""
+    if np is not None:
+      self.AddAddressesVectorized(np.unique(np.fromiter(
+          (int(location, 16) for location in locations if location[:2] == "0x"), dtype=np.uint64)))
+      return
+    for address_str in locations:
+      if address_str[:2] == "0x":
+        address = int(address_str, 16)
+        lib = self.Lookup(address)
+        if lib:
+          lib.AddUnresolvedAddress(address)
+
+  def AddAddressesVectorized(self, addresses):
+    """Hands each library its addresses from a sorted numpy array of distinct
+    addresses. Rather than looking up every address on its own, we find the
+    libraries for all of them with a single searchsorted."""
+    if len(addresses) == 0 or len(self.libs) == 0:
+      return
+
+    starts = np.array(self.libs_start, dtype=np.uint64)
+    ends = np.array([lib.end for lib in self.libs], dtype=np.uint64)
+    # Like AddressToLib, pick the last library which starts at or below each
+    # address, and check that the address is below its end.
+    indices = np.searchsorted(starts, addresses, side="right") - 1
+    found = indices >= 0
+    found[found] = addresses[found] < ends[indices[found]]
+    addresses = addresses[found]
+    indices = indices[found]
+
+    # The addresses are sorted, so each library's addresses are a contiguous run.
+    bounds = np.searchsorted(indices, np.arange(len(self.libs) + 1))
+    for i, lib in enumerate(self.libs):
+      if bounds[i] < bounds[i + 1]:
+        lib.AddUnresolvedAddresses(addresses[bounds[i]:bounds[i + 1]])
 
   def SymbolicationTable(self):
     """Create the union of all of the symbols from all of the libraries."""
     result = {}
     for lib in self.libs:
-      result.update(lib.symbols)
+      for address, symbol in lib.symbols.iteritems():
+        result["0x%08x" % address] = symbol
     return result
 
+  def SymbolicateStringTables(self):
+    """Replaces the addresses in the string tables of threads with frame tables
+    with their symbols, in place. Returns whether every thread has a frame table,
+    so that the profile needs no symbolication table."""
+    symbols = {}
+    for lib in self.libs:
+      symbols.update(lib.symbols)
+    all_tables = True
+    for thread in self.profile["threads"]:
+      if not HasFrameTable(thread):
+        all_tables = False
+        continue
+      strings = thread["stringTable"]
+      for index in FrameTableLocationIndices(thread):
+        address_str = strings[index]
+        if address_str[:2] == "0x":
+          symbol = symbols.get(int(address_str, 16))
+          if symbol:
+            strings[index] = symbol
+    return all_tables and len(self.profile["threads"]) > 0
+
+###############################################################################
+#
+# Frame tables. Newer profiles store each distinct frame once, in a thread's
+# frameTable, with its location in the thread's stringTable; samples refer to
+# stacks in the stackTable, which refer to frames.
+#
+###############################################################################
+
+def HasFrameTable(thread):
+  return "frameTable" in thread and "stringTable" in thread
+
+def FrameTableLocationIndices(thread):
+  """Gets the set of indices into the stringTable of the frames' locations."""
+  frame_table = thread["frameTable"]
+  location = frame_table["schema"]["location"]
+  return set([frame[location] for frame in frame_table["data"]])
+
+def FrameTableLocations(thread):
+  """Gets the set of the frames' locations."""
+  strings = thread["stringTable"]
+  return set([strings[index] for index in FrameTableLocationIndices(thread)])
+
+def ThreadLocations(thread):
+  """Gets the set of a thread's frames' locations. With a frame table, each
+  distinct frame is stored once, so we only have to look at those."""
+  if HasFrameTable(thread):
+    return FrameTableLocations(thread)
+  return SampleLocations(thread["samples"])
+
+def SampleLocations(samples):
+  """Gets the set of the locations of the frames in an iterable of samples."""
+  return set(frame["location"] for sample in samples for frame in sample["frames"])
+
+###############################################################################
+#
+# Streaming. Profiles from long sessions can be bigger than we can load into
+# memory, let alone copy into a new dict and write out again.
+#
+###############################################################################
+
+class JsonStream:
+  """Reads JSON from a file a piece at a time. The caller walks the structure
+  with Members and Elements, and decodes the values it wants (e.g. a single
+  sample) with Value; json's decoder does the actual parsing."""
+  WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+  def __init__(self, f, chunk_size=1024 * 1024):
+    self.f = f
+    self.chunk_size = chunk_size
+    self.buf = ""
+    self.pos = 0
+    self.eof = False
+    self.decoder = json.JSONDecoder()
+
+  def Read(self):
+    """Reads more of the file into the buffer, dropping what we've consumed.
+    Returns False at the end of the file."""
+    # Read at least as much as we're holding on to, so that a value which
+    # needs many reads is decoded a logarithmic number of times.
+    data = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+    if not data:
+      self.eof = True
+      return False
+    self.buf = self.buf[self.pos:] + data
+    self.pos = 0
+    return True
+
+  def Peek(self):
+    """Skips whitespace and returns the next character, or "" at the end of the file."""
+    while True:
+      self.pos = self.WHITESPACE.match(self.buf, self.pos).end()
+      if self.pos < len(self.buf):
+        return self.buf[self.pos]
+      if not self.Read():
+        return ""
+
+  def Next(self, expected):
+    """Consumes the next character, which must be one of expected, and returns it."""
+    c = self.Peek()
+    if not c or c not in expected:
+      raise ValueError("Expected one of %r but found %r" % (expected, c))
+    self.pos += 1
+    return c
+
+  def Value(self):
+    """Decodes the next value."""
+    self.Peek()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buf, self.pos)
+        # A number which runs up to the end of the buffer (or to a "." or an
+        # "e" at its end) may continue in the next read.
+        if self.eof or (end < len(self.buf) and self.buf[end] not in "0123456789.eE+-"):
+          self.pos = end
+          return value
+      except ValueError:
+        if self.eof:
+          raise
+      self.Read()
+
+  def Members(self):
+    """Iterates over the next value, an object, yielding each key. The caller
+    must consume the key's value (e.g. with Value or Skip) before going on."""
+    self.Next("{")
+    if self.Peek() == "}":
+      self.pos += 1
+      return
+    while True:
+      key = self.Value()
+      self.Next(":")
+      yield key
+      if self.Next(",}") == "}":
+        return
+
+  def Elements(self):
+    """Iterates over the next value, an array. The caller must consume each
+    element before going on."""
+    self.Next("[")
+    if self.Peek() == "]":
+      self.pos += 1
+      return
+    while True:
+      yield
+      if self.Next(",]") == "]":
+        return
+
+  def Skip(self):
+    """Skips the next value. An array or object which is already all in our
+    buffer is decoded in one go; we walk bigger ones an element or member at
+    a time, so that they never have to fit in memory."""
+    c = self.Peek()
+    if c not in ("[", "{"):
+      self.Value()
+      return
+    try:
+      _, self.pos = self.decoder.raw_decode(self.buf, self.pos)
+      return
+    except ValueError:
+      pass
+    if c == "[":
+      for _ in self.Elements():
+        self.Skip()
+    else:
+      for _ in self.Members():
+        self.Skip()
+
+def ScanProfileStream(f):
+  """Walks the profile in f without loading all of it. Returns its "libs" and
+  an iterable of each thread's set of distinct locations in
+  threads[].samples[].frames[], or in its frame table."""
+  stream = JsonStream(f)
+  libs = None
+  locations = []
+  for key in stream.Members():
+    if key == "libs":
+      libs = stream.Value()
+    elif key == "threads":
+      for _ in stream.Elements():
+        # A frame table and a string table hold one entry per distinct frame
+        # and string, so we can afford to decode them whole.
+        tables = {}
+        for thread_key in stream.Members():
+          if thread_key == "samples" and stream.Peek() == "[":
+            locations.append(SampleLocations(stream.Value() for _ in stream.Elements()))
+          elif thread_key in ("frameTable", "stringTable"):
+            tables[thread_key] = stream.Value()
+          else:
+            stream.Skip()
+        if HasFrameTable(tables):
+          locations.append(FrameTableLocations(tables))
+    else:
+      stream.Skip()
+  return libs, itertools.chain.from_iterable(locations)
+
+def WriteSymbolicatedProfileStream(filename, sym_filename, symbolication_table):
+  """Writes the same document as main does, but copies the profile's bytes
+  through rather than serializing it again. (So we can't put symbols into
+  frame tables' string tables; they're all in the symbolication table.)"""
+  with open(filename, "rb") as f:
+    with open(sym_filename, "wb") as out:
+      out.write('{"format": "profileJSONWithSymbolicationTable,1", "profileJSON": ')
+      shutil.copyfileobj(f, out, 1024 * 1024)
+      out.write(', "symbolicationTable": ')
+      json.dump(symbolication_table, out)
+      out.write("}")
+
 ###############################################################################
 #
 # Main
@@ -290,6 +937,11 @@ def main():
   parser.add_argument("-l", "--lookup", help="lookup a single address")
   parser.add_argument("-o", "--output", help="specify the name of the output file")
   parser.add_argument("-v", "--verbose", help="increase output verbosity", action="store_true")
+  parser.add_argument("--stream", help="read and write the profile a piece at a time, "
+                      "for profiles too big to load into memory", action="store_true")
+  parser.add_argument("--cache-max-size", metavar="MB", type=int, default=256,
+                      help="Evict the least recently used functions when the symbol cache "
+                      "grows past this size (default: 256)")
   args = parser.parse_args(sys.argv[1:])
   verbose = args.verbose
   progress = not args.no_progress
@@ -315,7 +967,12 @@ def main():
   # Read in the JSON file created by the profiler.
   if progress:
     print "Reading profiler file", args.filename, "..."
-  profile = json.load(open(args.filename, "rb"))
+  if args.stream:
+    with open(args.filename, "rb") as f:
+      (libs_json, locations) = ScanProfileStream(f)
+    profile = {"libs": libs_json}
+  else:
+    profile = json.load(open(args.filename, "rb"))
 
   libs = Libraries(profile, verbose)
   if args.dump_libs:
@@ -327,25 +984,35 @@ def main():
     lib = libs.Lookup(address)
     if lib:
       lib.Locate()
-      print("Address 0x%08x maps to symbol '%s'" % (address, lib.AddressToSymbol(address_str)))
+      print("Address 0x%08x maps to symbol '%s'" % (address, lib.AddressToSymbol(address)))
     else:
       print("Address 0x%08x not found in a library" % address)
+    SaveLibIndexes()
   else:
-    libs.ScanLocations(progress=progress)
-    libs.ResolveSymbols(progress=progress)
+    if args.stream:
+      libs.AddLocations(locations)
+    else:
+      libs.ScanLocations(progress=progress)
+    libs.ResolveSymbols(progress=progress, cache_max_size=args.cache_max_size * 1024 * 1024)
+    SaveLibIndexes()
     if args.dump_syms:
       libs.DumpSymbols()
     else:
-      sym_profile = {"format": "profileJSONWithSymbolicationTable,1",
-                     "profileJSON": profile,
-                     "symbolicationTable": libs.SymbolicationTable()}
       if args.output:
         sym_filename = args.output
       else:
         sym_filename = args.filename + ".syms"
       if progress:
         print "Writing symbolicated results to", sym_filename, "..."
-      json.dump(sym_profile, open(sym_filename, "wb"))
+      if args.stream:
+        WriteSymbolicatedProfileStream(args.filename, sym_filename, libs.SymbolicationTable())
+      elif libs.SymbolicateStringTables():
+        json.dump(profile, open(sym_filename, "wb"))
+      else:
+        sym_profile = {"format": "profileJSONWithSymbolicationTable,1",
+                       "profileJSON": profile,
+                       "symbolicationTable": libs.SymbolicationTable()}
+        json.dump(sym_profile, open(sym_filename, "wb"))
       if progress:
         print "Done"
 
@@ -0,0 +1,459 @@
+#!/usr/bin/env python
+
+"""Benchmarks fix_b2g_stack.py on synthetic DMD-style input.
+
+We generate a fake gecko objdir full of small libraries, a stand-in
+cross-toolchain whose addr2line answers with made-up symbols after a
+configurable delay, and an input file with a configurable number of frames,
+mix of libraries, and fraction of repeated frames.  Then we run
+fix_b2g_stacks_in_file over the input in each of the requested modes, once
+with an empty cache (cold) and once more with the cache the first run left
+behind (warm), and report lines/sec, frames/sec, the symbol cache's hit rate,
+and peak RSS.
+
+By default the libraries are minimal ELF files with a symbol table but no
+debug info, so every lookup goes to the stand-in addr2line.  With --cc, we
+instead compile real libraries with DWARF line info, which exercises the
+builtin symbolizer.
+
+Each run happens in a fresh Python process, so runs don't share in-memory
+state and peak RSS is measured per run.  Use --save-baseline to keep a run's
+results and --baseline to compare a later run against them, e.g.
+
+    bench_fix_b2g_stack.py --save-baseline before.json
+    (hack hack hack)
+    bench_fix_b2g_stack.py --baseline before.json
+
+"""
+
+from __future__ import print_function
+
+import sys
+if sys.version_info < (2, 7):
+    # We need Python 2.7 because we import argparse.
+    print('This script requires Python 2.7.', file=sys.stderr)
+    sys.exit(1)
+
+import os
+import json
+import stat
+import random
+import shutil
+import struct
+import argparse
+import platform
+import resource
+import tempfile
+import textwrap
+import subprocess
+import multiprocessing
+
+import include.elf_utils as elf_utils
+
+TOOLCHAIN_PREFIX = 'arm-linux-androideabi-'
+
+# The stand-in for the cross-toolchain's addr2line.  It takes the same
+# arguments as the real one (-Cfe LIB) and answers each address it reads on
+# stdin with a made-up function and file:line.
+FAKE_ADDR2LINE = '''\
+#!%(python)s
+import os
+import sys
+import time
+
+time.sleep(%(startup)f)
+lib = os.path.basename(sys.argv[-1])
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    time.sleep(%(latency)f)
+    address = int(line, 16)
+    sys.stdout.write('bench_fn_%%x\\nbench/%%s.c:%%d\\n' %%
+                     (address & ~0x3f, lib, address %% 1000 + 1))
+    sys.stdout.flush()
+'''
+
+# Each function in a fake library is this many bytes long.
+FAKE_FUNCTION_SIZE = 0x40
+
+
+def write_fake_lib(path, num_functions):
+    """Write a minimal 64-bit ELF file to path, with a build-id and a symbol
+    table of num_functions functions, but no code or debug info.
+
+    Returns a list of (address, size) pairs, one for each function.
+
+    """
+    def section_names():
+        names = ['', '.note.gnu.build-id', '.text', '.symtab', '.strtab',
+                 '.shstrtab']
+        offsets = {}
+        table = ''
+        for name in names:
+            offsets[name] = len(table)
+            table += name + '\0'
+        return offsets, table
+
+    (name_offsets, shstrtab) = section_names()
+    build_id = os.urandom(20)
+    note = struct.pack('<III', 4, len(build_id), elf_utils.NT_GNU_BUILD_ID) + \
+        'GNU\0' + build_id
+
+    functions = []
+    strtab = '\0'
+    symtab = '\0' * 24
+    text_index = 2
+    for i in range(num_functions):
+        address = 0x1000 + i * FAKE_FUNCTION_SIZE
+        functions.append((address, FAKE_FUNCTION_SIZE))
+        name_offset = len(strtab)
+        strtab += 'bench_fn_%x\0' % address
+        symtab += struct.pack('<IBBHQQ', name_offset,
+                              (1 << 4) | elf_utils.STT_FUNC, 0, text_index,
+                              address, FAKE_FUNCTION_SIZE)
+    text_size = num_functions * FAKE_FUNCTION_SIZE
+
+    body = ''
+    header_size = 64
+    sections = []
+
+    def add_section(name, sh_type, data, link=0, entsize=0, size=None):
+        offset = header_size + len(body)
+        sections.append(struct.pack('<IIQQQQIIQQ', name_offsets[name], sh_type,
+                                    0, 0, offset,
+                                    len(data) if size is None else size,
+                                    link, 0, 1, entsize))
+        return data
+
+    sections.append('\0' * 64)
+    body += add_section('.note.gnu.build-id', elf_utils.SHT_NOTE, note)
+    body += add_section('.text', elf_utils.SHT_NOBITS, '', size=text_size)
+    body += add_section('.symtab', elf_utils.SHT_SYMTAB, symtab, link=4,
+                        entsize=24)
+    body += add_section('.strtab', 3, strtab)
+    body += add_section('.shstrtab', 3, shstrtab)
+
+    shoff = header_size + len(body)
+    ident = '\x7fELF' + chr(elf_utils.ELFCLASS64) + \
+        chr(elf_utils.ELFDATA2LSB) + '\x01' + '\0' * 9
+    header = ident + struct.pack('<HHIQQQIHHHHHH', 3, 40, 1, 0, 0, shoff, 0,
+                                 header_size, 0, 0, 64, len(sections),
+                                 len(sections) - 1)
+    with open(path, 'wb') as f:
+        f.write(header + body + ''.join(sections))
+    return functions
+
+
+def build_real_lib(cc, path, num_functions):
+    """Compile a library with num_functions functions and DWARF line info
+    using the C compiler cc.
+
+    Returns a list of (address, size) pairs, one for each function.
+
+    """
+    source = path + '.c'
+    with open(source, 'w') as f:
+        for i in range(num_functions):
+            f.write('int bench_fn_%d(int x) {\n  return x * %d + 1;\n}\n' %
+                    (i, i))
+    subprocess.check_call([cc, '-shared', '-fPIC', '-O0', '-gdwarf-4',
+                           '-o', path, source])
+    with elf_utils.ElfFile(path) as elf:
+        return [(address, size) for (address, size, name)
+                in elf.function_symbols() if name.startswith('bench_fn_')]
+
+
+def make_fixtures(workdir, args):
+    """Create the objdirs, toolchain and libraries for a benchmark.
+
+    Returns a list of (lib, functions) pairs, where functions is a list of
+    (address, size) pairs.
+
+    """
+    toolchain_dir = os.path.join(workdir, 'toolchain')
+    lib_dir = os.path.join(workdir, 'objdir-gecko', 'dist', 'bin')
+    product_dir = os.path.join(workdir, 'out', 'target', 'product', 'bench')
+    for d in (toolchain_dir, lib_dir, product_dir):
+        os.makedirs(d)
+
+    addr2line = os.path.join(toolchain_dir, TOOLCHAIN_PREFIX + 'addr2line')
+    with open(addr2line, 'w') as f:
+        f.write(FAKE_ADDR2LINE % {'python': sys.executable,
+                                  'startup': args.addr2line_startup / 1000.0,
+                                  'latency': args.addr2line_latency / 1000.0})
+    os.chmod(addr2line, os.stat(addr2line).st_mode | stat.S_IXUSR)
+
+    libs = []
+    for i in range(args.libs):
+        lib = 'libbench%d.so' % i
+        path = os.path.join(lib_dir, lib)
+        if args.cc:
+            functions = build_real_lib(args.cc, path, args.functions)
+        else:
+            functions = write_fake_lib(path, args.functions)
+        libs.append((lib, functions))
+    return libs
+
+
+def write_input(path, libs, args):
+    """Write a DMD-style report to path.
+
+    Returns (num_lines, num_frames).
+
+    """
+    rng = random.Random(args.seed)
+    # A few libraries get most of the frames, like libxul.so does in real
+    # reports.
+    weights = [1.0 / (i + 1) ** args.lib_skew for i in range(len(libs))]
+    total_weight = sum(weights)
+
+    def new_frame():
+        x = rng.random() * total_weight
+        for ((lib, functions), weight) in zip(libs, weights):
+            x -= weight
+            if x <= 0:
+                break
+        (address, size) = rng.choice(functions)
+        return (lib, address + rng.randrange(size))
+
+    num_unique = max(1, int(args.frames * (1 - args.repeat_ratio)))
+    seen = []
+    num_lines = 0
+    num_frames = 0
+    with open(path, 'w') as f:
+        record = 0
+        while num_frames < args.frames:
+            record += 1
+            f.write('Unreported {\n'
+                    '  %d blocks in heap block record %d\n'
+                    '  %d bytes (%d requested / %d slop)\n'
+                    '  Allocated at {\n' %
+                    (rng.randint(1, 100), record, 4096, 4000, 96))
+            num_lines += 4
+            for depth in range(min(args.stack_depth, args.frames - num_frames)):
+                remaining = args.frames - num_frames
+                if len(seen) < num_unique and \
+                   (not seen or rng.random() * remaining < num_unique - len(seen)):
+                    frame = new_frame()
+                    seen.append(frame)
+                else:
+                    frame = rng.choice(seen)
+                f.write('    #%02d: ???[%s +0x%x] 0x%x\n' %
+                        (depth + 1, frame[0], frame[1], 0x40000000 + frame[1]))
+                num_lines += 1
+                num_frames += 1
+            f.write('  }\n}\n\n')
+            num_lines += 3
+    return num_lines, num_frames
+
+
+def run_one(config):
+    """Run fix_b2g_stacks_in_file as described by config, in this process, and
+    print our measurements as JSON.  This is what each benchmark subprocess
+    does."""
+    import fix_b2g_stack
+
+    # Keep the library index with the rest of the benchmark's files rather
+    # than next to fix_b2g_stack.py.
+    fix_b2g_stack.StackFixer.lib_index_filename = \
+        staticmethod(lambda: config['lib_index'])
+
+    # Count cache hits and misses.  The counters live in shared memory, so
+    # that they see lookups in --pipeline mode's worker processes too.
+    counts = multiprocessing.Array('l', 2)
+    cache_get = fix_b2g_stack.StackFixerCache.get
+
+    def counting_get(self, lib_path, offset):
+        result = cache_get(self, lib_path, offset)
+        with counts.get_lock():
+            counts[0 if result else 1] += 1
+        return result
+    fix_b2g_stack.StackFixerCache.get = counting_get
+
+    parser = argparse.ArgumentParser()
+    fix_b2g_stack.add_argparse_arguments(parser)
+    fixer_args = parser.parse_args(config['fixer_args'])
+
+    start = os.times()[4]
+    with open(config['input']) as infile:
+        with open(os.devnull, 'w') as outfile:
+            fix_b2g_stack.fix_b2g_stacks_in_file(infile, outfile, fixer_args)
+    elapsed = os.times()[4] - start
+
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on Mac OS and in kilobytes elsewhere.
+    if platform.system() != 'Darwin':
+        peak_rss *= 1024
+    print(json.dumps({'seconds': elapsed,
+                      'cache_hits': counts[0],
+                      'cache_misses': counts[1],
+                      'peak_rss': peak_rss}))
+
+
+def run_benchmark(workdir, mode, warm, args, num_lines, num_frames):
+    fixer_args = ['--toolchain-dir', os.path.join(workdir, 'toolchain'),
+                  '--toolchain-prefix', TOOLCHAIN_PREFIX,
+                  '--gecko-objdir', os.path.join(workdir, 'objdir-gecko'),
+                  '--gonk-objdir', os.path.join(workdir, 'out'),
+                  '--cache-file', os.path.join(workdir, 'cache.sqlite'),
+                  '--symbolizer', args.symbolizer,
+                  # Otherwise, if a daemon is listening on the default
+                  # socket, we'd measure it instead of a fresh process.
+                  '--no-daemon']
+    if args.jobs:
+        fixer_args += ['--jobs', str(args.jobs)]
+    if mode in ('batch', 'pipeline'):
+        fixer_args.append('--' + mode)
+    if not warm:
+        fixer_args.append('--remove-cache')
+
+    config = {'input': os.path.join(workdir, 'input.txt'),
+              'lib_index': os.path.join(workdir, 'lib_index'),
+              'fixer_args': fixer_args}
+    out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                   '--run-one', json.dumps(config)])
+    result = json.loads(out.splitlines()[-1])
+
+    seconds = max(result['seconds'], 1e-6)
+    lookups = result['cache_hits'] + result['cache_misses']
+    return {'seconds': seconds,
+            'lines_per_sec': num_lines / seconds,
+            'frames_per_sec': num_frames / seconds,
+            'cache_hit_rate': (float(result['cache_hits']) / lookups
+                               if lookups else 0.0),
+            'peak_rss_mb': result['peak_rss'] / (1024.0 * 1024)}
+
+
+def print_results(results, baseline):
+    print('%-16s %9s %12s %12s %9s %12s' %
+          ('run', 'seconds', 'lines/sec', 'frames/sec', 'hit rate',
+           'peak RSS MB'))
+    for (name, r) in results:
+        print('%-16s %9.2f %12.0f %12.0f %8.1f%% %12.1f' %
+              (name, r['seconds'], r['lines_per_sec'], r['frames_per_sec'],
+               100 * r['cache_hit_rate'], r['peak_rss_mb']))
+        old = baseline.get(name)
+        if old:
+            def change(key):
+                if not old[key]:
+                    return 'n/a'
+                return '%+.1f%%' % (100.0 * (r[key] - old[key]) / old[key])
+            print('%-16s %9s %12s %12s %9s %12s' %
+                  ('  vs. baseline', change('seconds'),
+                   change('lines_per_sec'), change('frames_per_sec'), '',
+                   change('peak_rss_mb')))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--run-one', metavar='CONFIG', help=argparse.SUPPRESS)
+    parser.add_argument('--modes', default='serial,batch',
+                        help=textwrap.dedent('''\
+                            Comma-separated list of fix_b2g_stack modes to
+                            benchmark: serial, batch, pipeline (default:
+                            %(default)s)'''))
+    parser.add_argument('--symbolizer', default='builtin',
+                        choices=('builtin', 'addr2line'),
+                        help='fix_b2g_stack --symbolizer (default: %(default)s)')
+    parser.add_argument('--jobs', type=int,
+                        help='fix_b2g_stack --jobs (default: its default)')
+    parser.add_argument('--frames', type=int, default=200000,
+                        help='Number of stack frames in the input '
+                             '(default: %(default)s)')
+    parser.add_argument('--repeat-ratio', type=float, default=0.9,
+                        help='Fraction of frames which repeat an earlier '
+                             'frame (default: %(default)s)')
+    parser.add_argument('--stack-depth', type=int, default=12,
+                        help='Frames per stack (default: %(default)s)')
+    parser.add_argument('--libs', type=int, default=20,
+                        help='Number of libraries (default: %(default)s)')
+    parser.add_argument('--lib-skew', type=float, default=1.5,
+                        help='How much the first few libraries dominate the '
+                             'frames; 0 spreads frames evenly '
+                             '(default: %(default)s)')
+    parser.add_argument('--functions', type=int, default=2000,
+                        help='Functions per library (default: %(default)s)')
+    parser.add_argument('--addr2line-latency', type=float, default=0,
+                        metavar='MS',
+                        help='Delay before the stand-in addr2line answers '
+                             'each address (default: %(default)s)')
+    parser.add_argument('--addr2line-startup', type=float, default=0,
+                        metavar='MS',
+                        help='Delay before the stand-in addr2line starts '
+                             'answering, like a real one loading a big '
+                             'library (default: %(default)s)')
+    parser.add_argument('--cc', metavar='CC',
+                        help='Build real libraries with DWARF line info with '
+                             'this C compiler, instead of writing fake ones')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for the input (default: %(default)s)')
+    parser.add_argument('--workdir', metavar='DIR',
+                        help='Where to put the fixtures (must not exist; we '
+                             'keep it afterwards).  Default: a temporary '
+                             'directory, which we remove.')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='Compare the results with those saved in FILE')
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help='Save the results to FILE, for --baseline')
+    args = parser.parse_args()
+
+    if args.run_one:
+        run_one(json.loads(args.run_one))
+        return
+
+    modes = args.modes.split(',')
+    for mode in modes:
+        if mode not in ('serial', 'batch', 'pipeline'):
+            parser.error('Unknown mode %r' % mode)
+
+    params = dict((k, v) for (k, v) in vars(args).items()
+                  if k not in ('baseline', 'save_baseline', 'run_one',
+                               'workdir'))
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        baseline = saved['results']
+        changed = sorted(k for k in params
+                         if saved['params'].get(k) != params[k] and
+                         k != 'modes')
+        if changed:
+            print('Warning: the baseline was run with different %s.' %
+                  ', '.join('--' + k.replace('_', '-') for k in changed))
+
+    if args.workdir:
+        workdir = args.workdir
+        os.makedirs(workdir)
+    else:
+        workdir = tempfile.mkdtemp(prefix='bench_fix_b2g_stack')
+    try:
+        print('Generating fixtures in %s...' % workdir)
+        libs = make_fixtures(workdir, args)
+        (num_lines, num_frames) = write_input(
+            os.path.join(workdir, 'input.txt'), libs, args)
+        print('%d lines, %d frames, %d libraries.\n' %
+              (num_lines, num_frames, len(libs)))
+
+        results = []
+        for mode in modes:
+            for warm in (False, True):
+                name = '%s/%s' % (mode, 'warm' if warm else 'cold')
+                results.append((name, run_benchmark(workdir, mode, warm, args,
+                                                    num_lines, num_frames)))
+        print_results(results, baseline)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'params': params, 'results': dict(results)},
+                      f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
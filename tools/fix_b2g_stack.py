@@ -15,6 +15,11 @@ The stack frames don't need to be on their own line; fix_b2g_stack will replace
 them wherever they appear, and is happy to replace multiple stack frames per
 line.
 
+If you fix stacks often, run "fix_b2g_stack.py --daemon &" once.  The daemon
+keeps what it has learned about your libraries in memory, and later runs of
+fix_b2g_stack.py (and of tools which use fix_b2g_stacks_in_file) hand their
+work to it instead of starting from scratch.
+
 This is an analog to fix-linux-stack.pl and is functionally similar to
 $B2G_ROOT/scripts/profile-symbolicate.py.
 
@@ -30,18 +35,35 @@ if sys.version_info < (2, 7):
 
 import os
 import re
+import ast
+import json
+import time
+import signal
+import socket
+import SocketServer
 import subprocess
 import itertools
+import multiprocessing
+import multiprocessing.pool
+import multiprocessing.util
 import argparse
 import platform
+import tempfile
 import textwrap
 import threading
-import cPickle as pickle
-import fcntl
+import sqlite3
+import shutil
+import Queue
+import copy
 from os.path import dirname
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 from gzip import GzipFile
 
+import include.demangle as demangle
+import include.dwarf_utils as dwarf_utils
+import include.elf_utils as elf_utils
+import include.lib_index as lib_index
+
 
 def first(pred, itr):
     """Return the first element of itr which matches the predicate pred, or
@@ -57,31 +79,9 @@ def first(pred, itr):
         return None
 
 
-def pump(dst, src):
-    """Pump the file dst into the file src.  When src hits EOF, close dst.
-
-    Returns a thread object, so you can e.g. join() on the result.
-
-    """
-    class Pumper(threading.Thread):
-        def run(self):
-            while True:
-                bytes = src.read(4096)
-                if not bytes:
-                    break
-                dst.write(bytes)
-            dst.close()
-    p = Pumper()
-    p.start()
-    return p
-
-
-def _none_factory():
-    return None
-
+SYMBOLIZERS = ('builtin', 'addr2line')
 
-def _defaultdict_none_factory():
-    return defaultdict(_none_factory)
+OUTPUT_FORMATS = ('text', 'json')
 
 
 class FixB2GStacksOptions(object):
@@ -110,10 +110,72 @@ class FixB2GStacksOptions(object):
       * product: The device we're targeting.  Default: the one directory
         inside gonk_objdir/target/product.  If gonk_objdir/target/product
         is empty or has multiple sub-directories and the |product| arg was
-        not specified, we raise an exception.
+        not specified, we raise an exception when we first need to search
+        for a library.
 
       * remove_cache: If true, delete fix_b2g_stack.py's persistent
-        addr2line cache when we start running fix_b2g_stacks_in_file.
+        symbol cache and library index when we start running
+        fix_b2g_stacks_in_file.
+
+      * cache_file: The sqlite database in which we cache symbols.  Since
+        entries are keyed on libraries' build-ids, one cache file can be
+        shared between objdirs, checkouts, and machines.  The builtin
+        symbolizer saves the line tables it parses in the directory
+        cache_file + '-dwarf', keyed the same way.  Default:
+        .fix_b2g_stack.sqlite, next to this file.
+
+      * cache_max_size: How many MB the symbol cache may grow to before we
+        evict what we've used least recently.  Default: 256.
+
+      * symbolizer: How we translate lib+offsets.  'builtin' reads each
+        library's DWARF line table and functions in-process, naming inlined
+        code the way addr2line does; 'addr2line' talks to the
+        cross-toolchain's addr2line.  Even in 'builtin' mode, we fall back to
+        addr2line for libraries which have no line table we can read.
+        Default: 'builtin'.
+
+      * addr2line_procs: How many addr2line processes (one per library) we
+        keep running at once.  Default: 8.
+
+      * addr2line_memory: Roughly how many MB of RAM our addr2line processes
+        may use between them before we stop the least recently used ones.
+        Default: 4096.
+
+      * batch: If true, read the whole input before writing any output, so
+        that we can resolve each library's frames in one bulk request rather
+        than one at a time.  Default: False.
+
+      * jobs: How many libraries to resolve concurrently in batch mode, or
+        how many worker processes to use in pipeline mode.  Default: the
+        number of CPUs on this machine.
+
+      * pipeline: If true, stream the input through a pool of worker
+        processes, each rewriting whole blocks of lines, and write the blocks
+        out in order.  Meant for multi-gigabyte DMD logs.  If batch is also
+        set, each worker batches the lookups within a block.  Default: False.
+
+      * pipeline_memory: Roughly how many MB of input and output pipeline
+        mode may hold in memory at once.  Default: 256.
+
+      * daemon_socket: The Unix socket on which a StackFixerDaemon listens.
+        Default: .fix_b2g_stack.sock, next to this file.
+
+      * no_daemon: If true, do all of the work in this process, even if a
+        StackFixerDaemon is listening on daemon_socket.  We never use the
+        daemon in pipeline mode.  Default: False.
+
+      * stats: If true, print a summary of where the time went (per-library
+        lookup counts, cache hit ratios, and resolver latencies; time spent
+        in each phase) to stderr when we're done.  Default: False.
+
+      * stats_json: A file to write the same summary to, as JSON.  Default:
+        None.
+
+      * output_format: 'text' copies the input to the output with its stack
+        frames rewritten.  'json' writes a StackTables document instead,
+        which stores each distinct function name, file name, frame, and stack
+        once.  We always do 'json' in this process, without a daemon or a
+        pipeline.  Default: 'text'.
 
     In addition, this class defines two additional properties on itself based
     on the parameters received in __init__.
@@ -124,6 +186,11 @@ class FixB2GStacksOptions(object):
         program.  For example, cross_bin('nm') returns a path to the
         cross-toolchain's nm binary.
 
+    We don't guess toolchain_dir or product until something asks for
+    toolchain_dir, cross_bin() or lib_search_dirs.  When every frame in the
+    input is in the cache, nothing does, so fixing stacks works even without
+    a toolchain or objdirs.
+
     """
     def __init__(self, args):
         def get_arg(arg, default=None):
@@ -147,25 +214,74 @@ class FixB2GStacksOptions(object):
             return default
 
         self.toolchain_prefix = get_arg('toolchain_prefix', 'arm-linux-androideabi-')
-        self.toolchain_dir = get_arg('toolchain_dir', self._guess_toolchain_dir)
+        # None until we need to guess it; see the toolchain_dir property.
+        self._toolchain_dir = get_arg('toolchain_dir')
         self.remove_cache = get_arg('remove_cache', False)
+        self.cache_file = get_arg('cache_file', StackFixerCache.cache_filename)
+        self.cache_max_size = int(get_arg('cache_max_size', 256))
+        self.symbolizer = get_arg('symbolizer', 'builtin')
+        if self.symbolizer not in SYMBOLIZERS:
+            raise Exception("Unknown symbolizer %r; expected one of %s." %
+                            (self.symbolizer, SYMBOLIZERS))
+        self.addr2line_procs = int(get_arg('addr2line_procs', 8))
+        self.addr2line_memory = int(get_arg('addr2line_memory', 4096))
+        self.batch = get_arg('batch', False)
+        self.jobs = int(get_arg('jobs', multiprocessing.cpu_count))
+        self.pipeline = get_arg('pipeline', False)
+        self.pipeline_memory = int(get_arg('pipeline_memory', 256))
+        self.daemon_socket = get_arg('daemon_socket',
+                                     StackFixerDaemon.socket_filename)
+        self.no_daemon = get_arg('no_daemon', False)
+        self.stats = get_arg('stats', False)
+        self.stats_json = get_arg('stats_json')
+        self.output_format = get_arg('output_format', 'text')
+        if self.output_format not in OUTPUT_FORMATS:
+            raise Exception("Unknown output format %r; expected one of %s." %
+                            (self.output_format, OUTPUT_FORMATS))
 
         self.gecko_objdir = get_arg(
             'gecko_objdir', os.path.join(dirname(__file__), '../objdir-gecko'))
         self.gonk_objdir = get_arg(
             'gonk_objdir', os.path.join(dirname(__file__), '../out'))
 
-        product = get_arg('product')
-        if product:
-            product_dir = os.path.join(self.gonk_objdir, 'target/product', product)
-        else:
-            product_dir = self._guess_gonk_product(self.gonk_objdir)
+        self.product = get_arg('product')
+        # None until we need it; see the lib_search_dirs property.
+        self._lib_search_dirs = None
+
+    @property
+    def toolchain_dir(self):
+        if not self._toolchain_dir:
+            self._toolchain_dir = self._guess_toolchain_dir()
+        return self._toolchain_dir
+
+    @property
+    def lib_search_dirs(self):
+        if not self._lib_search_dirs:
+            if self.product:
+                product_dir = os.path.join(self.gonk_objdir, 'target/product',
+                                           self.product)
+            else:
+                product_dir = self._guess_gonk_product(self.gonk_objdir)
+            self._lib_search_dirs = [self.gecko_objdir, product_dir]
+        return self._lib_search_dirs
 
-        self.lib_search_dirs = [self.gecko_objdir, product_dir]
+    def lib_search_key(self):
+        """Get a string which identifies the directories we search for libs,
+        without guessing the product if we haven't yet."""
+        return repr((os.path.abspath(self.gecko_objdir),
+                     os.path.abspath(self.gonk_objdir), self.product))
 
     def cross_bin(self, bin_name):
         return os.path.join(self.toolchain_dir, self.toolchain_prefix + bin_name)
 
+    @staticmethod
+    def _from_vars(attrs):
+        """Rebuild a FixB2GStacksOptions from the vars() of another one,
+        without guessing any of the defaults again."""
+        options = object.__new__(FixB2GStacksOptions)
+        options.__dict__.update(attrs)
+        return options
+
     @staticmethod
     def _guess_toolchain_dir():
         patterns = [
@@ -201,152 +317,734 @@ class FixB2GStacksOptions(object):
             (products_dir, products)))
 
 
-class StackFixerCache():
-    """A cache for StackFixer which occasionally serializes itself to disk.
+class LRUCache(object):
+    """A cache keyed on strings, which holds at most max_size bytes' worth of
+    keys and values, evicting the least recently used entries to make room
+    for new ones.
 
-    This cache stores (lib, offset) --> string mappings, so we can avoid
-    calling addr2line.  After every so many puts, we write the cache out to
-    disk.
+    """
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._size = 0
+        # key --> (value, size of key and value)
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Get the value cached for key, or None."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._entries[key] = entry
+        return entry[0]
+
+    def put(self, key, value, value_size=None):
+        """Cache value for key.  value_size is how many bytes value counts
+        for; by default, len(value)."""
+        if value_size is None:
+            value_size = len(value)
+        size = len(key) + value_size
+        if size > self._max_size:
+            return
+        old_entry = self._entries.pop(key, None)
+        if old_entry is not None:
+            self._size -= old_entry[1]
+        self._entries[key] = (value, size)
+        self._size += size
+        while self._size > self._max_size:
+            (_, (_, old_size)) = self._entries.popitem(last=False)
+            self._size -= old_size
 
-    Please be kind and call flush() on this object when you're done with it.
-    That gives us one last chance to write our cache out to disk.
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+
+class Addr2linePool(object):
+    """The long-running addr2line processes which StackFixer asks about one
+    address at a time, one process per library.
 
-    When the cache is read in from disk, we check that the libraries' sizes,
-    mtimes, and ctimes haven't changed.  If they have, we throw out the cached
-    mappings.
+    addr2line reads a library's debug info when we first ask it about the
+    library, which for libxul.so can take hundreds of MB, so we run at most
+    max_procs processes, using at most max_memory bytes between them (where
+    we can measure that, i.e. on Linux).  When we need room, we stop the
+    processes we've used least recently.
 
-    In theory you can safely access this cache from multiple processes, because
-    we use fcntl locking on the cache file.  (We never block on acquiring a
-    lock on the cache file; if we can't immediately access the file, we simply
-    give up.) But note that I have not tested that this locking works as
-    intended.
+    If a process dies, or we can't talk to it, we start a new one and try
+    again.  If the new one fails too, we give up on the library until someone
+    calls forget() for it (e.g. because it has been rebuilt).
+
+    Please be kind and call close() once you're done with this object, so we
+    can stop our processes.
 
     """
-    def __init__(self, options):
-        self._initialized = False
-        self._lib_lookups = None
-        self._lib_metadata = None
-        self._put_counter = 0
+    # Check how much memory our processes use every this many lookups.
+    MEMORY_CHECK_INTERVAL = 256
 
-        # Write the cache file after this many puts.
-        self._write_cache_after_puts = 500
+    def __init__(self, addr2line, max_procs, max_memory):
+        self._addr2line = addr2line
+        self._max_procs = max(1, max_procs)
+        self._max_memory = max_memory
+        # lib_path --> Popen, least recently used first.
+        self._procs = OrderedDict()
+        # lib_paths we've given up on.
+        self._broken = set()
+        self._lookups = 0
 
-    def _ensure_initialized(self):
-        if self._initialized:
-            return
-        cache = self._read_cache_from_disk()
-        if cache:
-            self._lib_lookups = cache['lookups']
-            self._lib_metadata = cache['metadata']
-            self._validate_lib_metadata()
+    def lookup(self, lib_path, offset):
+        """Use addr2line to translate the given lib_path+offset into a
+        (func, file_name) pair.
+
+        Raises IOError if addr2line fails.
+
+        """
+        if lib_path in self._broken:
+            raise IOError('addr2line keeps failing on %s' % lib_path)
+        for attempt in (1, 2):
+            try:
+                (proc, started) = self._get_proc(lib_path)
+                result = self._query(proc, lib_path, offset)
+                break
+            except (IOError, OSError) as e:
+                self.stop(lib_path)
         else:
-            self._lib_lookups = defaultdict(_defaultdict_none_factory)
-            self._lib_metadata = {}
-        self._initialized = True
+            self._broken.add(lib_path)
+            raise IOError('addr2line failed twice on %s: %s' % (lib_path, e))
+
+        self._lookups += 1
+        if started or self._lookups % self.MEMORY_CHECK_INTERVAL == 0:
+            self._limit_memory(lib_path)
+        return result
+
+    def stop(self, lib_path):
+        """Stop the addr2line process for lib_path, if we have one."""
+        proc = self._procs.pop(lib_path, None)
+        if proc:
+            try:
+                proc.kill()
+            except OSError:
+                # It has already exited.
+                pass
+            proc.wait()
+
+    def forget(self, lib_path):
+        """Stop the process for lib_path, and try again with a new one next
+        time, even if we had given up on lib_path."""
+        self.stop(lib_path)
+        self._broken.discard(lib_path)
+
+    def close(self):
+        for lib_path in self._procs.keys():
+            self.stop(lib_path)
+
+    def _get_proc(self, lib_path):
+        """Get our addr2line process for lib_path, starting one if necessary.
+        Returns (proc, whether we just started it)."""
+        proc = self._procs.pop(lib_path, None)
+        started = proc is None
+        if started:
+            while len(self._procs) >= self._max_procs:
+                self.stop(next(iter(self._procs)))
+            proc = subprocess.Popen([self._addr2line, '-Cfe', lib_path],
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+        self._procs[lib_path] = proc
+        return (proc, started)
+
+    @staticmethod
+    def _query(proc, lib_path, offset):
+        proc.stdin.write('0x%x\n' % offset)
+        proc.stdin.flush()
+
+        # addr2line returns two lines for every address we give it.  The
+        # first line is of the form "foo()", and the second line is of the
+        # form "foo.cpp:123".
+        func = proc.stdout.readline()
+        file_name = proc.stdout.readline()
+        if not file_name:
+            raise IOError('addr2line exited while translating %s' % lib_path)
+        return func.strip(), file_name.strip()
+
+    def _limit_memory(self, keep):
+        """Stop processes, least recently used first, until our processes'
+        resident memory fits in max_memory.  Never stop keep's process."""
+        if not self._max_memory:
+            return
+        sizes = dict((lib_path, _resident_memory(proc.pid))
+                     for (lib_path, proc) in self._procs.iteritems())
+        if None in sizes.values():
+            # We can't tell how much memory our processes use here.
+            return
+        total = sum(sizes.itervalues())
+        for lib_path in self._procs.keys():
+            if total <= self._max_memory:
+                break
+            if lib_path != keep:
+                self.stop(lib_path)
+                total -= sizes[lib_path]
+
+
+def _resident_memory(pid):
+    """Get the number of bytes of RAM process pid is using, or None if we
+    can't tell (e.g. because we're not on Linux)."""
+    try:
+        with open('/proc/%d/statm' % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+class StackFixerStats(object):
+    """Counters and timers describing where a StackFixer spends its time.
+
+    phase_times maps each phase of the work to the seconds spent in it:
+
+      * lib_index_load, lib_index_save: reading and writing the LibIndex.
+      * find_libs: finding libraries in the index (walking the search dirs if
+        they've changed) and checking which copies have symbols.
+      * cache_load: opening the symbol cache and validating the cache entries
+        of each library we look at.
+      * cache_read, cache_write, cache_save: looking results up in the
+        cache, adding results to it, and committing them at the end.
+      * resolve: looking frames up with the symbolizers, including reading
+        line tables, starting addr2line, and demangling.
+
+    libs maps each lib to a dict with the number of frames we were asked to
+    look up in it (lookups), and how each of those went: the number we
+    couldn't look up because we couldn't find the lib (not_found) or because
+    addr2line failed (failed), and the number we had to resolve with a
+    symbolizer because the cache didn't have them (resolved).  The rest were
+    cache hits.  latencies has the seconds each resolution took.  In batch
+    mode, we resolve a library's frames together, and charge each the
+    average.
+
+    stack_memo_hits and stack_memo_misses count the runs of frames
+    StackFixer.translate_stack() found and didn't find in its memo.  Frames
+    in the runs it found never get looked up, so they're not in lookups;
+    each lib's memo counts them instead.
+
+    Given a run's total wall time, summary() and report() also show the time
+    not accounted for by any phase as 'other'; that's mostly scanning the
+    input and formatting frames.  With several workers, the phases' times
+    are summed over the workers, so they may add up to more than the total.
+
+    """
+    def __init__(self):
+        self.phase_times = {}
+        self.libs = {}
+        self.stack_memo_hits = 0
+        self.stack_memo_misses = 0
+
+    def add_time(self, phase, seconds):
+        self.phase_times[phase] = self.phase_times.get(phase, 0) + seconds
+
+    def lib(self, lib):
+        """Get the dict of counters for lib."""
+        counters = self.libs.get(lib)
+        if counters is None:
+            counters = self.libs[lib] = {'lookups': 0, 'resolved': 0,
+                                         'not_found': 0, 'failed': 0,
+                                         'memo': 0, 'latencies': []}
+        return counters
+
+    def merge(self, other):
+        """Add the counts and times in other, a StackFixerStats or its
+        vars(), to ours."""
+        if isinstance(other, StackFixerStats):
+            other = vars(other)
+        for (phase, seconds) in other['phase_times'].iteritems():
+            self.add_time(phase, seconds)
+        for (lib, counters) in other['libs'].iteritems():
+            ours = self.lib(lib)
+            for name in ('lookups', 'resolved', 'not_found', 'failed',
+                         'memo'):
+                ours[name] += counters[name]
+            ours['latencies'].extend(counters['latencies'])
+        self.stack_memo_hits += other['stack_memo_hits']
+        self.stack_memo_misses += other['stack_memo_misses']
+
+    def take(self):
+        """Return a StackFixerStats with our counts and times, and reset
+        ours to zero."""
+        taken = StackFixerStats()
+        taken.__dict__.update(vars(self))
+        self.__init__()
+        return taken
+
+    @staticmethod
+    def _percentile(sorted_values, fraction):
+        if not sorted_values:
+            return 0
+        index = int(round(fraction * (len(sorted_values) - 1)))
+        return sorted_values[index]
+
+    def summary(self, total_seconds=None):
+        """Get a dict summarizing our counters, suitable for dumping as JSON.
+        Latencies are in milliseconds, and other times are in seconds."""
+        libs = {}
+        for (lib, counters) in self.libs.iteritems():
+            lookups = counters['lookups']
+            cache_hits = (lookups - counters['resolved'] -
+                          counters['not_found'] - counters['failed'])
+            latencies = sorted(counters['latencies'])
+            libs[lib] = {
+                'lookups': lookups,
+                'cache_hits': cache_hits,
+                'resolved': counters['resolved'],
+                'not_found': counters['not_found'],
+                'failed': counters['failed'],
+                'memo': counters['memo'],
+                'hit_ratio': float(cache_hits) / lookups if lookups else 0,
+                'resolve_seconds': sum(latencies),
+                'latency_ms': dict(
+                    (name, 1000 * self._percentile(latencies, fraction))
+                    for (name, fraction) in (('p50', 0.5), ('p90', 0.9),
+                                             ('p99', 0.99), ('max', 1.0))),
+            }
+        summary = {
+            'phases': dict(self.phase_times),
+            'libs': libs,
+            'stack_memo': {'hits': self.stack_memo_hits,
+                           'misses': self.stack_memo_misses},
+        }
+        if total_seconds is not None:
+            summary['total_seconds'] = total_seconds
+            summary['phases']['other'] = max(
+                0, total_seconds - sum(self.phase_times.itervalues()))
+        return summary
+
+    def report(self, f, total_seconds=None):
+        """Write a human-readable summary of our counters to f."""
+        summary = self.summary(total_seconds)
+        if total_seconds is not None:
+            print('Total: %.3fs' % total_seconds, file=f)
+        print('Phases:', file=f)
+        for (phase, seconds) in sorted(summary['phases'].iteritems(),
+                                       key=lambda item: -item[1]):
+            print('  %-16s %9.3fs' % (phase, seconds), file=f)
+        print('Stack memo: %(hits)d hits, %(misses)d misses' %
+              summary['stack_memo'], file=f)
+        print('Libraries (frames from memoized stacks are under "memo", '
+              'not "lookups"):', file=f)
+        print('  %-24s %9s %9s %9s %9s %9s %6s %9s %9s %9s %9s' %
+              ('lib', 'memo', 'lookups', 'resolved', 'not found', 'failed',
+               'hit%', 'p50 ms', 'p90 ms', 'p99 ms', 'total s'), file=f)
+        for (lib, counters) in sorted(
+                summary['libs'].iteritems(),
+                key=lambda item: -(item[1]['lookups'] + item[1]['memo'])):
+            latency = counters['latency_ms']
+            print('  %-24s %9d %9d %9d %9d %9d %6.1f %9.3f %9.3f %9.3f %9.3f' %
+                  (lib, counters['memo'], counters['lookups'],
+                   counters['resolved'], counters['not_found'],
+                   counters['failed'], 100 * counters['hit_ratio'],
+                   latency['p50'], latency['p90'], latency['p99'],
+                   counters['resolve_seconds']), file=f)
+
+
+class StackFixerCache(object):
+    """A persistent cache for StackFixer, backed by an sqlite database.
+
+    This cache stores (lib, offset) --> (func, file_name) mappings, so we can
+    avoid looking frames up again.  Lookups are indexed queries against the
+    database (plus an in-memory memo, of up to MEMO_SIZE bytes, of what we've
+    seen recently), so we never have to load the whole cache into memory, and
+    new results are inserted incrementally rather than by rewriting the whole
+    file.
+
+    Please be kind and call flush() on this object when you're done with it.
+    That commits any results we haven't written out yet.
+
+    We key each library's entries on its GNU build-id, so cached results stay
+    valid when a library is touched, copied to another machine, or found in a
+    different objdir, and one cache (see options.cache_file) can be shared by
+    everyone working with the same build.  Stripped and unstripped copies of a
+    library share a build-id but not symbols, so we keep their entries apart.
+
+    Libraries without a build-id are keyed on their absolute path instead.
+    The first time we see such a library in a run, we check that its size,
+    mtime, and ctime haven't changed since we cached results for it.  If they
+    have, we throw out the cached mappings for that library.
+
+    Several processes may use the cache at once.  The database runs in WAL
+    mode, so readers never block the writer, and writers wait for each other
+    (up to a timeout) instead of giving up.  If a commit still fails, we keep
+    our pending results and try again at the next commit.
+
+    We remember when each library and each entry was last used, and keep the
+    cache under options.cache_max_size MB.  When flush() finds the cache has
+    outgrown that, it shrinks it to EVICT_TO of the limit, dropping the
+    libraries we've used least recently (typically, old builds) first, whole.
+    If that's not enough, because the libraries we're using now are bigger
+    than the limit, we drop their least recently used entries.  Deleted rows
+    leave free pages in the file, which later inserts reuse; compact()
+    returns them to the filesystem.
+
+    """
+    # Bump this when changing the tables below or what we store in them (e.g.
+    # version 2 stores demangled function names, version 3 stores when rows
+    # were last used, and version 4 remembers which copy of each lib we
+    # chose); we discard caches written with a different schema.
+    SCHEMA_VERSION = 4
+
+    # When the cache outgrows its limit, shrink it to this fraction of the
+    # limit, so that we don't have to evict again on the next run.
+    EVICT_TO = 0.9
+
+    # Record that an entry has been used only if we last recorded that more
+    # than this many seconds ago, so that reading from the cache rarely
+    # writes to it.
+    TOUCH_INTERVAL = 24 * 60 * 60
+
+    # Remember up to this many bytes of lookups in memory, counting each
+    # entry's strings plus MEMO_ENTRY_OVERHEAD for the objects holding them.
+    MEMO_SIZE = 32 * 1024 * 1024
+    MEMO_ENTRY_OVERHEAD = 200
+
+    def __init__(self, options, stats=None):
+        self._filename = options.cache_file
+        self._max_size = options.cache_max_size * 1024 * 1024
+        self._stats = stats or StackFixerStats()
+        self._db = None
+        # (lib_path, offset) --> (func, file_name)
+        self._memo = LRUCache(self.MEMO_SIZE)
+
+        # lib_path --> row id in the libs table, for libs we've validated.
+        self._lib_ids = {}
+        # lib_path --> the lib's metadata when we validated it.
+        self._lib_stamps = {}
+
+        # Commit our pending inserts after this many puts.
+        self._commit_after_puts = 500
+        self._put_counter = 0
+        # Whether we've added entries since we last checked the cache's size.
+        self._grown = False
+
+        # (lib_id, offset) of entries whose last_used we should update.
+        self._touched = []
 
     @staticmethod
     def cache_filename():
-        """Get the filename of our cache."""
-        return os.path.join(dirname(__file__), '.fix_b2g_stack.cache')
+        """Get the default filename of our cache."""
+        return os.path.join(dirname(__file__), '.fix_b2g_stack.sqlite')
+
+    @staticmethod
+    def dwarf_index_dir(filename):
+        """Get the directory in which the builtin symbolizer saves the line
+        tables it parses, for the cache database at filename."""
+        return filename + '-dwarf'
 
     @staticmethod
-    def _read_cache_from_disk():
+    def remove_cache_files(filename):
+        """Delete the cache database at filename, along with its WAL and
+        shared-memory files and the builtin symbolizer's saved line
+        tables."""
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(filename + suffix)
+            except OSError:
+                pass
+        shutil.rmtree(StackFixerCache.dwarf_index_dir(filename),
+                      ignore_errors=True)
+
+    def _ensure_initialized(self):
+        if self._db:
+            return
+        self._db = sqlite3.connect(self._filename, timeout=30)
+        self._db.text_factory = str
         try:
-            with open(StackFixerCache.cache_filename(), 'rb') as cache_file:
-                try:
-                    fcntl.lockf(cache_file.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
-                    return pickle.load(cache_file)
-                finally:
-                    try:
-                        fcntl.lockf(cache_file.fileno(), fcntl.LOCK_UN)
-                    except IOError:
-                        pass
-        except (EOFError, IOError, pickle.PickleError) as e:
+            self._db.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            # Some filesystems (e.g. NFS) don't support WAL; we can live with
+            # the default rollback journal.
             pass
-        return None
+        with self._db:
+            (version,) = self._db.execute('PRAGMA user_version').fetchone()
+            if version != StackFixerCache.SCHEMA_VERSION:
+                self._db.execute('DROP TABLE IF EXISTS libs')
+                self._db.execute('DROP TABLE IF EXISTS lookups')
+                self._db.execute('DROP TABLE IF EXISTS lib_paths')
+                self._db.execute('PRAGMA user_version = %d' %
+                                 StackFixerCache.SCHEMA_VERSION)
+            self._db.execute('''CREATE TABLE IF NOT EXISTS libs (
+                                    id INTEGER PRIMARY KEY,
+                                    key TEXT UNIQUE NOT NULL,
+                                    size INTEGER,
+                                    mtime REAL,
+                                    ctime REAL,
+                                    last_used REAL)''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS lookups (
+                                    lib_id INTEGER NOT NULL,
+                                    offset INTEGER NOT NULL,
+                                    func TEXT NOT NULL,
+                                    file_name TEXT NOT NULL,
+                                    last_used REAL NOT NULL,
+                                    PRIMARY KEY (lib_id, offset))''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS lib_paths (
+                                    search_key TEXT NOT NULL,
+                                    lib TEXT NOT NULL,
+                                    path TEXT NOT NULL,
+                                    size INTEGER,
+                                    mtime REAL,
+                                    ctime REAL,
+                                    PRIMARY KEY (search_key, lib))''')
 
     def flush(self):
-        if self._put_counter:
-            self._write_cache_to_disk()
+        if self._put_counter or self._touched or self._grown:
+            start = time.time()
+            if self._touched:
+                self._db.executemany('UPDATE lookups SET last_used = ? '
+                                     'WHERE lib_id = ? AND offset = ?',
+                                     ((start, lib_id, offset)
+                                      for (lib_id, offset) in self._touched))
+                self._touched = []
+            if self._grown:
+                self._evict()
+                self._grown = False
+            self._commit()
+            self._stats.add_time('cache_save', time.time() - start)
+
+    def _used_size(self):
+        """Get the number of bytes of the database file in use (i.e., not
+        counting free pages)."""
+        (page_size,) = self._db.execute('PRAGMA page_size').fetchone()
+        (page_count,) = self._db.execute('PRAGMA page_count').fetchone()
+        (free_pages,) = self._db.execute('PRAGMA freelist_count').fetchone()
+        return (page_count - free_pages) * page_size
+
+    def _evict(self):
+        """If the cache has outgrown its limit, shrink it to EVICT_TO of the
+        limit.  See the class comment for how we choose what to drop."""
+        if not self._max_size:
+            return
+        size = self._used_size()
+        if size <= self._max_size:
+            return
+        (entries,) = self._db.execute('SELECT COUNT(*) FROM lookups').fetchone()
+        # Assume every entry takes the same amount of space.
+        excess = int(entries *
+                     (1 - self.EVICT_TO * self._max_size / float(size)))
+
+        in_use = set(self._lib_ids.itervalues())
+        libs = self._db.execute('SELECT id, (SELECT COUNT(*) FROM lookups '
+                                '            WHERE lib_id = libs.id) '
+                                'FROM libs ORDER BY last_used').fetchall()
+        for (lib_id, lib_entries) in libs:
+            if excess <= 0:
+                break
+            if lib_id in in_use:
+                continue
+            self._db.execute('DELETE FROM lookups WHERE lib_id = ?', (lib_id,))
+            self._db.execute('DELETE FROM libs WHERE id = ?', (lib_id,))
+            excess -= lib_entries
+
+        if excess > 0:
+            self._db.execute('DELETE FROM lookups WHERE rowid IN '
+                             '(SELECT rowid FROM lookups '
+                             ' ORDER BY last_used LIMIT ?)', (excess,))
+
+    def compact(self):
+        """Shrink the cache to its limit, drop rows which belong to no
+        library, and rebuild the database file so that it takes no more disk
+        space than it needs.
+
+        Returns the size of the file before and after, in bytes.
 
-    def _write_cache_to_disk(self):
+        """
+        self._ensure_initialized()
+        before = self._file_size()
+        self._db.execute('DELETE FROM lookups '
+                         'WHERE lib_id NOT IN (SELECT id FROM libs)')
+        self._db.execute('DELETE FROM libs '
+                         'WHERE id NOT IN (SELECT DISTINCT lib_id FROM lookups)')
+        self._evict()
+        self._db.commit()
+        self._db.execute('VACUUM')
         try:
-            with open(StackFixerCache.cache_filename(), 'wb') as cache_file:
-                try:
-                    fcntl.lockf(cache_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-                    pickle.dump({'lookups': self._lib_lookups,
-                                 'metadata': self._lib_metadata},
-                                cache_file,
-                                pickle.HIGHEST_PROTOCOL)
-                    self._put_counter = 0
-                    return True
-                finally:
-                    try:
-                        fcntl.lockf(cache_file.fileno(), fcntl.LOCK_UN)
-                    except IOError:
-                        pass
-        except IOError, pickle.PickleError:
+            self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        except sqlite3.DatabaseError:
             pass
-        return False
+        return (before, self._file_size())
 
-    def _validate_lib_metadata(self):
-        for (lib_path, cached_metadata) in self._lib_metadata.items():
-            real_metadata = self._get_lib_metadata(lib_path)
-            if real_metadata != cached_metadata or not real_metadata:
-                self._lib_metadata[lib_path] = real_metadata
-                try:
-                    del self._lib_lookups[lib_path]
-                except KeyError:
-                    pass
+    def _file_size(self):
+        size = 0
+        for suffix in ('', '-wal'):
+            try:
+                size += os.path.getsize(self._filename + suffix)
+            except OSError:
+                pass
+        return size
+
+    def _commit(self):
+        try:
+            self._db.commit()
+            self._put_counter = 0
+            return True
+        except sqlite3.OperationalError:
+            # Someone else held the write lock for longer than our timeout.
+            # Our inserts are still pending, so we'll retry at the next commit.
+            return False
+
+    @staticmethod
+    def _get_build_id_key(lib_path):
+        """Get the key we file lib_path's entries under if it has a build-id,
+        or None if it doesn't."""
+        try:
+            with elf_utils.ElfFile(lib_path) as elf:
+                build_id = elf.build_id()
+                if not build_id:
+                    return None
+                if elf.has_symbols():
+                    return 'build-id:' + build_id
+                return 'build-id:%s:stripped' % build_id
+        except (IOError, OSError, elf_utils.ElfError):
+            return None
 
     @staticmethod
     def _get_lib_metadata(lib_path):
         try:
             st = os.stat(lib_path)
-            return (os.path.normpath(os.path.abspath(lib_path)),
-                    st.st_size, st.st_mtime, st.st_ctime)
-        except:
+            return (st.st_size, st.st_mtime, st.st_ctime)
+        except OSError:
             return None
 
-    def get(self, lib_path, offset):
-        self._ensure_initialized()
-        return self._lib_lookups[lib_path][offset]
+    def _get_lib_id(self, lib_path):
+        """Get the id of lib_path's row in the libs table, creating the row or
+        invalidating its cached lookups if needed."""
+        lib_id = self._lib_ids.get(lib_path)
+        if lib_id is not None:
+            return lib_id
 
-    def put(self, lib_path, offset, result):
+        start = time.time()
         self._ensure_initialized()
-        if lib_path not in self._lib_metadata:
-            self._lib_metadata[lib_path] = self._get_lib_metadata(lib_path)
-        self._lib_lookups[lib_path][offset] = result
+        key = self._get_build_id_key(lib_path)
+        if key:
+            # The build-id identifies the library's contents, so there's
+            # nothing to validate.
+            metadata = (None, None, None)
+        else:
+            key = os.path.normpath(os.path.abspath(lib_path))
+            metadata = self._get_lib_metadata(lib_path)
+
+        # Only write to the database if we have to, so that runs which find
+        # everything in the cache don't wait for the write lock.
+        wrote = False
+        select = 'SELECT id, size, mtime, ctime, last_used FROM libs WHERE key = ?'
+        row = self._db.execute(select, (key,)).fetchone()
+        if not row:
+            # Another process may be adding this lib at the same time, so
+            # don't fail if the row already exists.
+            self._db.execute('INSERT OR IGNORE INTO libs '
+                             '(key, size, mtime, ctime) VALUES (?, ?, ?, ?)',
+                             (key,) + (metadata or (None, None, None)))
+            row = self._db.execute(select, (key,)).fetchone()
+            wrote = True
+        lib_id = row[0]
+        if tuple(row[1:4]) != metadata or not metadata:
+            self._db.execute('DELETE FROM lookups WHERE lib_id = ?', (lib_id,))
+            self._db.execute('UPDATE libs SET size = ?, mtime = ?, ctime = ? '
+                             'WHERE id = ?',
+                             (metadata or (None, None, None)) + (lib_id,))
+            wrote = True
+        if row[4] is None or row[4] < start - self.TOUCH_INTERVAL:
+            self._db.execute('UPDATE libs SET last_used = ? WHERE id = ?',
+                             (start, lib_id))
+            wrote = True
+        if wrote:
+            self._commit()
+        self._lib_ids[lib_path] = lib_id
+        self._lib_stamps[lib_path] = self._get_lib_metadata(lib_path)
+        self._stats.add_time('cache_load', time.time() - start)
+        return lib_id
+
+    def remembered_lib_path(self, search_key, lib):
+        """Get the path remember_lib_path() last recorded for lib under
+        search_key, or None if we have none or the file has changed since."""
+        start = time.time()
+        self._ensure_initialized()
+        row = self._db.execute('SELECT path, size, mtime, ctime FROM lib_paths '
+                               'WHERE search_key = ? AND lib = ?',
+                               (search_key, lib)).fetchone()
+        self._stats.add_time('cache_read', time.time() - start)
+        if row and self._get_lib_metadata(row[0]) == tuple(row[1:]):
+            return row[0]
+        return None
 
+    def remember_lib_path(self, search_key, lib, lib_path):
+        """Record that we chose lib_path for lib when searching the
+        directories identified by search_key."""
+        metadata = self._get_lib_metadata(lib_path)
+        if not metadata:
+            return
+        start = time.time()
+        self._ensure_initialized()
+        self._db.execute('INSERT OR REPLACE INTO lib_paths '
+                         '(search_key, lib, path, size, mtime, ctime) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (search_key, lib, os.path.abspath(lib_path)) + metadata)
         self._put_counter += 1
-        if self._put_counter == self._write_cache_after_puts:
-            self._write_cache_to_disk()
+        self._stats.add_time('cache_write', time.time() - start)
+
+    def forget_changed_libs(self):
+        """Forget what we've looked up for libraries whose files have changed
+        since we validated them, so that we validate them again on their next
+        lookup.  Long-lived users call this between batches of input."""
+        changed = set(lib_path for (lib_path, stamp) in self._lib_stamps.items()
+                      if self._get_lib_metadata(lib_path) != stamp)
+        if not changed:
+            return
+        for lib_path in changed:
+            del self._lib_ids[lib_path]
+            del self._lib_stamps[lib_path]
+        # Libraries rarely change under us, so don't bother picking out their
+        # entries.
+        self._memo.clear()
 
-            # Reset the put counter even if the cache write above fails; if
-            # this write failed, it's likely that our next write will fail too,
-            # and we don't want to waste our time writing and failing over and
-            # over again.
-            self._put_counter = 0
+    def get(self, lib_path, offset):
+        """Get the cached (func, file_name) for lib_path+offset, or None."""
+        key = (lib_path, offset)
+        result = self._memo.get(key)
+        if result is None:
+            lib_id = self._get_lib_id(lib_path)
+            start = time.time()
+            row = self._db.execute(
+                'SELECT func, file_name, last_used FROM lookups '
+                'WHERE lib_id = ? AND offset = ?', (lib_id, offset)).fetchone()
+            self._stats.add_time('cache_read', time.time() - start)
+            if row:
+                result = row[:2]
+                self._remember(key, result)
+                if row[2] < start - self.TOUCH_INTERVAL:
+                    self._touched.append((lib_id, offset))
+        return result
 
-    def get_maybe_set(self, lib_path, offset, result):
-        """Get the addr2line result for (lib_path, offset).
+    def put(self, lib_path, offset, result):
+        """Cache result, a (func, file_name) pair, for lib_path+offset."""
+        lib_id = self._get_lib_id(lib_path)
+        start = time.time()
+        self._remember((lib_path, offset), result)
+        self._db.execute('INSERT OR REPLACE INTO lookups '
+                         '(lib_id, offset, func, file_name, last_used) '
+                         'VALUES (?, ?, ?, ?, ?)',
+                         (lib_id, offset) + tuple(result) + (start,))
 
-        If (lib_path, offset) is not in our cache, insert |result()| or
-        |result|, depending on whether |result| is callable.
+        self._put_counter += 1
+        self._grown = True
+        if self._put_counter >= self._commit_after_puts:
+            self._commit()
+        self._stats.add_time('cache_write', time.time() - start)
 
-        """
-        self._ensure_initialized()
-        if not self._lib_lookups[lib_path][offset]:
-            if callable(result):
-                self.put(lib_path, offset, result())
-            else:
-                self.put(lib_path, offset, result)
-        return self._lib_lookups[lib_path][offset]
+    def _remember(self, key, result):
+        """Put result, the (func, file_name) for key, in our memo.  (The memo
+        counts a (lib_path, offset) key as len(key) bytes, so we add the
+        path's length to the value's size.)"""
+        (func, file_name) = result
+        self._memo.put(key, result,
+                       len(key[0]) + len(func or '') + len(file_name or '') +
+                       self.MEMO_ENTRY_OVERHEAD)
 
 
 class StackFixer(object):
     """An object used for translating (lib, offset) tuples into function+file
-    names, using addr2line and a cache.
+    names, using our builtin DWARF reader or addr2line, and a cache.
 
     Here and elsewhere we adopt the convention that |lib| is a library's
     basename (e.g. 'libxul.so'), while lib_path is a relative path from
@@ -354,16 +1052,37 @@ class StackFixer(object):
 
     Please be kind and call close() once you're done with this object.  That
     gives us a chance to flush the cache to disk, making future invocations
-    faster.
+    faster, and to stop our addr2line processes.  (flush() does the former
+    without the latter.)
+
+    self.stats is a StackFixerStats describing what we've spent our time on.
 
     """
 
-    _addr2line_procs = {}
+    # translate_stack() remembers up to this many bytes of stacks, but doesn't
+    # bother with runs of frames longer than MAX_MEMO_STACK bytes; those are
+    # unlikely to repeat.
+    STACK_MEMO_SIZE = 32 * 1024 * 1024
+    MAX_MEMO_STACK = 16 * 1024
 
     def __init__(self, options):
-        self._lib_path_cache = defaultdict(list)
-        self._cache = StackFixerCache(options)
+        self.stats = StackFixerStats()
+        # We create the LibIndex and the Addr2linePool when we first need
+        # them, which we don't if all of our frames are in the cache.
+        self._lib_index = None
+        # lib --> the path we chose for it, or None if we couldn't find it.
+        self._lib_paths = {}
+        # lib --> the metadata of the file at _lib_paths[lib] when we chose it.
+        self._lib_stamps = {}
+        self._cache = StackFixerCache(options, self.stats)
         self._options = options
+        self._addr2line_pool = None
+
+        # lib --> DwarfSymbolizer, or None if we should use addr2line for lib.
+        self._dwarf_symbolizers = {}
+
+        # A stack's text --> its text with the frames rewritten.
+        self._stack_memo = LRUCache(self.STACK_MEMO_SIZE)
 
     def translate(self, lib, offset, pc=None, fn_guess=None):
         """Translate the given offset (an integer) into the given library (e.g.
@@ -372,25 +1091,172 @@ class StackFixer(object):
         pc and fn_guess are hints to make the output look nicer; we don't use
         either of these optional parameters to look up lib+offsets.
 
+        If we can't resolve a lib+offset, you may still have a guess as to
+        what function lives there.  (For example, NS_StackWalk is sometimes
+        able to resolve function names that addr2line can't.)  fn_guess should
+        be this guess, if you have one.
+
         """
+        (result, failure) = self.lookup(lib, offset)
+        if failure:
+            return '%s (%s)' % (self._fallback_str(lib, offset, pc, fn_guess),
+                                failure)
+        return self._format_result(lib, offset, pc, fn_guess, *result)
+
+    def lookup(self, lib, offset):
+        """Look up the given offset into the given library, using the cache
+        if we can.
+
+        Returns a ((func, file_name), failure) pair.  If we couldn't look
+        lib+offset up, the first element is None and failure says why (e.g.
+        "can't find lib"); otherwise, failure is None.  file_name is of the
+        form 'path/to/file.cpp:123'.  A symbolizer which doesn't know
+        lib+offset gives us ('??', '??:0').
+
+        """
+        counters = self.stats.lib(lib)
+        counters['lookups'] += 1
         lib_path = self._find_lib(lib)
-        return self._cache.get_maybe_set(lib_path, offset,
-            lambda: self._addr2line(lib, offset, pc, fn_guess))
+        if not lib_path:
+            counters['not_found'] += 1
+            return (None, "can't find lib")
 
-    def close(self):
+        result = self._cache.get(lib_path, offset)
+        if not result:
+            start = time.time()
+            try:
+                result = self._normalize(self._lookup(lib, lib_path, offset))
+            except IOError:
+                # addr2line keeps failing on this lib; Addr2linePool has
+                # already tried restarting it.
+                counters['failed'] += 1
+                return (None, 'addr2line exception')
+            finally:
+                elapsed = time.time() - start
+                counters['latencies'].append(elapsed)
+                self.stats.add_time('resolve', elapsed)
+            counters['resolved'] += 1
+            self._cache.put(lib_path, offset, result)
+        return (result, None)
+
+    def translate_stack(self, text):
+        """Rewrite the stack frames in text, a run of consecutive lines with
+        frames in them, such as one of DMD's stack traces, and return the
+        result.
+
+        Big logs repeat the same stacks many times (DMD prints a stack for
+        each of its records), so we remember the stacks we've rewritten, up
+        to STACK_MEMO_SIZE bytes' worth, and rewrite a repeated stack with one
+        dict lookup rather than a translate() per frame.
+
+        """
+        if len(text) > self.MAX_MEMO_STACK:
+            return _translate_frames(self, text)
+        entry = self._stack_memo.get(text)
+        if entry is None:
+            self.stats.stack_memo_misses += 1
+            lib_counts = defaultdict(int)
+            result = _translate_frames(self, text, lib_counts)
+            # Remember how many frames the stack has in each lib, so that the
+            # stats can count them when we use the memo.
+            self._stack_memo.put(text, (result, lib_counts.items()),
+                                 len(result))
+        else:
+            self.stats.stack_memo_hits += 1
+            (result, lib_counts) = entry
+            for (lib, count) in lib_counts:
+                self.stats.lib(lib)['memo'] += count
+        return result
+
+    def prefetch(self, frames):
+        """Resolve many lib+offsets at once and store the results in our cache,
+        so that later calls to translate() for them are cache hits.
+
+        frames maps each lib to a collection of offsets into that lib.
+
+        Rather than asking addr2line about one address at a time, we hand it
+        all of a library's uncached addresses in one go.  Different libraries
+        are resolved concurrently by up to options.jobs workers, so that a
+        slow libxul.so doesn't hold up all the small libraries.
+
+        """
+        work = []
+        for (lib, lib_offsets) in frames.iteritems():
+            lib_path = self._find_lib(lib)
+            if not lib_path:
+                # translate() will report that we can't find this lib.
+                continue
+
+            offsets = sorted(offset for offset in lib_offsets
+                             if not self._cache.get(lib_path, offset))
+            if offsets:
+                work.append((lib, lib_path, offsets))
+
+        resolved = self._resolve_libs(work)
+        while True:
+            # Time only the resolving, not the cache puts in between.
+            start = time.time()
+            item = next(resolved, None)
+            self.stats.add_time('resolve', time.time() - start)
+            if item is None:
+                break
+            (lib, lib_path, offsets, results, seconds) = item
+            if results is None:
+                # Leave these frames for translate() to handle one by one.
+                continue
+
+            counters = self.stats.lib(lib)
+            counters['resolved'] += len(offsets)
+            counters['latencies'].extend([seconds / len(offsets)] * len(offsets))
+            for (offset, result) in zip(offsets, results):
+                self._cache.put(lib_path, offset, self._normalize(result))
+
+    def flush(self):
+        """Write what we've learned to disk, so that other StackFixers (and
+        future invocations) can use it."""
         self._cache.flush()
+        if self._lib_index:
+            start = time.time()
+            self._lib_index.save()
+            self.stats.add_time('lib_index_save', time.time() - start)
+
+    def close(self):
+        self.flush()
+        if self._addr2line_pool:
+            self._addr2line_pool.close()
 
-    def _init_lib_path_cache(self):
-        """Initialize self._lib_path_cache by walking all of the subdirectories
-        of self._options.lib_search_dirs and finding all the '*.so', 'b2g', and
-        'plugin-container' files therein.
+    def refresh(self):
+        """Notice libraries which have been added, moved, or rebuilt since we
+        started, while keeping what we know about the others.
+
+        A long-lived StackFixer (e.g. a StackFixerDaemon's) calls this before
+        each batch of input.
 
         """
-        for root, _, files in itertools.chain(*[os.walk(dir) for dir in
-                                                self._options.lib_search_dirs]):
-            for f in files:
-                if f.endswith('.so') or f == 'b2g' or f == 'plugin-container':
-                    self._lib_path_cache[f].append(os.path.join(root, f))
+        if self._lib_index:
+            self._lib_index.invalidate()
+        old_paths = self._lib_paths
+        old_stamps = self._lib_stamps
+        self._lib_paths = {}
+        self._lib_stamps = {}
+        for (lib, old_path) in old_paths.iteritems():
+            if (self._find_lib(lib) == old_path and
+                    self._lib_stamps[lib] == old_stamps[lib]):
+                continue
+            self._dwarf_symbolizers.pop(lib, None)
+            if self._addr2line_pool:
+                self._addr2line_pool.forget(old_path)
+            self._stack_memo.clear()
+        self._cache.forget_changed_libs()
+
+    @staticmethod
+    def lib_index_filename():
+        """Get the filename of our persistent library index."""
+        return os.path.join(dirname(__file__), '.fix_b2g_stack.libindex')
+
+    @staticmethod
+    def _is_lib_name(f):
+        return f.endswith('.so') or f == 'b2g' or f == 'plugin-container'
 
     def _find_lib(self, lib):
         """Get a path to the given lib (e.g. 'libxul.so').
@@ -400,86 +1266,235 @@ class StackFixer(object):
 
         If we can't find the lib, we return None.
 
-        """
-        if not self._lib_path_cache:
-            self._init_lib_path_cache()
+        We find libs using a LibIndex of all the '*.so', 'b2g', and
+        'plugin-container' files under self._options.lib_search_dirs, which
+        we persist between runs.  Whether each candidate has symbols is
+        remembered in the same index.
 
-        lib_paths = self._lib_path_cache[lib]
-        if not lib_paths:
-            return None
-        if len(lib_paths) == 1:
-            return lib_paths[0]
+        Loading and refreshing the index takes a while on a big tree, so the
+        cache also remembers which copy of each lib we chose last time, if it
+        had symbols (so no other copy could be better).  If that file hasn't
+        changed since, we use it without looking at the index.
 
-        lib_path = first(self._lib_has_symbols, lib_paths)
+        """
+        if lib in self._lib_paths:
+            return self._lib_paths[lib]
+
+        search_key = self._options.lib_search_key()
+        lib_path = self._cache.remembered_lib_path(search_key, lib)
         if not lib_path:
-            lib_path = self._lib_path_cache[lib][0]
-        self._lib_path_cache[lib] = [lib_path]
+            index = self._get_lib_index()
+            start = time.time()
+            lib_paths = index.find(lib)
+            has_symbols = lambda path: index.file_fact(path, 'has_symbols',
+                                                       self._lib_has_symbols)
+            lib_path = first(has_symbols, lib_paths)
+            self.stats.add_time('find_libs', time.time() - start)
+            if lib_path:
+                self._cache.remember_lib_path(search_key, lib, lib_path)
+            elif lib_paths:
+                lib_path = lib_paths[0]
+        self._lib_paths[lib] = lib_path
+        self._lib_stamps[lib] = \
+            StackFixerCache._get_lib_metadata(lib_path) if lib_path else None
         return lib_path
 
-    def _lib_has_symbols(self, lib_path):
+    def _get_lib_index(self):
+        if not self._lib_index:
+            start = time.time()
+            self._lib_index = lib_index.LibIndex(self.lib_index_filename(),
+                                                 self._options.lib_search_dirs,
+                                                 file_filter=self._is_lib_name)
+            self.stats.add_time('lib_index_load', time.time() - start)
+        return self._lib_index
+
+    def _get_addr2line_pool(self):
+        if not self._addr2line_pool:
+            self._addr2line_pool = Addr2linePool(
+                self._options.cross_bin('addr2line'),
+                self._options.addr2line_procs,
+                self._options.addr2line_memory * 1024 * 1024)
+        return self._addr2line_pool
+
+    @staticmethod
+    def _lib_has_symbols(lib_path):
         """Check if the given lib_path has symbols.
 
-        We do this by running nm on the library.  If it's stripped, nm will not
-        output anything to stdout.
+        We do this by reading the library's ELF section headers and looking
+        for a .symtab or .debug_info section, which strip removes.  Since the
+        library is mmap'ed, this reads only a few pages of it.
 
         """
-        proc = subprocess.Popen(
-            [self._options.cross_bin('nm'), lib_path],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         try:
-            return not not proc.stdout.readline()
-        except IOError:
+            with elf_utils.ElfFile(lib_path) as elf:
+                return elf.has_symbols()
+        except (IOError, OSError, elf_utils.ElfError):
             return False
-        finally:
-            proc.kill()
 
-    def _addr2line(self, lib, offset, pc, fn_guess):
-        """Use addr2line to translate the given lib+offset.
+    def _get_dwarf_symbolizer(self, lib):
+        """Get a DwarfSymbolizer for lib, or None if we can't read lib's line
+        table ourselves (in which case we should use addr2line instead).
 
-        We use pc only for aesthetic purposes; it's not passed to addr2line or
-        anything.
+        """
+        if lib not in self._dwarf_symbolizers:
+            symbolizer = None
+            lib_path = self._find_lib(lib)
+            if lib_path and self._options.symbolizer == 'builtin':
+                try:
+                    symbolizer = dwarf_utils.DwarfSymbolizer(
+                        lib_path, StackFixerCache.dwarf_index_dir(
+                            self._options.cache_file))
+                except (IOError, OSError, elf_utils.ElfError,
+                        dwarf_utils.DwarfError):
+                    pass
+            self._dwarf_symbolizers[lib] = symbolizer
+        return self._dwarf_symbolizers[lib]
 
-        If addr2line can't resolve a lib+offset, you may still have a guess as
-        to what function lives there.  (For example, NS_StackWalk is sometimes
-        able to resolve function names that addr2line can't.)  fn_guess should
-        be this guess, if you have one.
+    @staticmethod
+    def _addr_str(lib, offset, pc):
+        _pc = ('0x%x ' % pc) if pc != None else ''
+        return '(%s%s+0x%x)' % (_pc, lib, offset)
+
+    @staticmethod
+    def _fallback_str(lib, offset, pc, fn_guess):
+        _fn_guess = demangle.demangle_text(fn_guess) + ' ' \
+            if fn_guess and fn_guess != '???' else ''
+        return '%s%s' % (_fn_guess, StackFixer._addr_str(lib, offset, pc))
+
+    @staticmethod
+    def _format_result(lib, offset, pc, fn_guess, func, file_name):
+        """Format the (func, file_name) pair we looked up for lib+offset."""
+        if func == '??' and file_name == '??:0':
+            # The symbolizer wasn't helpful here.
+            return '%s (no addr2line)' % \
+                StackFixer._fallback_str(lib, offset, pc, fn_guess)
+        return '%s %s %s' % (func, file_name,
+                             StackFixer._addr_str(lib, offset, pc))
+
+    @staticmethod
+    def _normalize(result):
+        """Put a (func, file_name) pair from a symbolizer in the form we cache
+        and print it in."""
+        (func, file_name) = result
+        return (func, os.path.normpath(file_name))
+
+    def _lookup(self, lib, lib_path, offset):
+        """Look up the given lib+offset, using our builtin DWARF reader if we
+        can and addr2line otherwise.  Returns a (func, file_name) pair.
+
+        Raises IOError if addr2line fails.
 
         """
-        def addr_str():
-            _pc = ('0x%x ' % pc) if pc != None else ''
-            return '(%s%s+0x%x)' % (_pc, lib, offset)
+        symbolizer = self._get_dwarf_symbolizer(lib)
+        if symbolizer:
+            return symbolizer.lookup(offset)
+        return self._get_addr2line_pool().lookup(lib_path, offset)
 
-        def fallback_str():
-            _fn_guess = fn_guess + ' ' if fn_guess and fn_guess != '???' else ''
-            return '%s%s' % (_fn_guess, addr_str())
+    def _resolve_libs(self, work):
+        """Resolve a list of (lib, lib_path, offsets) work items.
 
-        if lib not in StackFixer._addr2line_procs:
-            lib_path = self._find_lib(lib)
-            if not lib_path:
-                return "%s (can't find lib)" % fallback_str()
-            StackFixer._addr2line_procs[lib] = subprocess.Popen(
-                [self._options.cross_bin('addr2line'), '-Cfe', lib_path],
-                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        Yields (lib, lib_path, offsets, results, seconds) tuples, where
+        results is a list of (func, file_name) pairs in the same order as
+        offsets, or None if the lookup failed, and seconds is how long the
+        lookup took.  Results come back in whatever order the workers finish
+        them.
 
-        proc = StackFixer._addr2line_procs[lib]
+        The builtin symbolizer is CPU-bound, so we use a pool of processes for
+        it.  addr2line does its work in its own process, so for it a pool of
+        threads, each driving one addr2line, is enough.
+
+        """
+        jobs = min(self._options.jobs, len(work))
+        if jobs <= 1:
+            for (lib, lib_path, offsets) in work:
+                start = time.time()
+                try:
+                    results = self._resolve_many(lib, lib_path, offsets)
+                except IOError:
+                    results = None
+                yield (lib, lib_path, offsets, results, time.time() - start)
+            return
+
+        # Start on the libraries with the most addresses first; they're the
+        # ones which take longest.
+        work = sorted(work, key=lambda item: -len(item[2]))
+        if self._options.symbolizer == 'builtin':
+            pool = multiprocessing.Pool(jobs)
+        else:
+            pool = multiprocessing.pool.ThreadPool(jobs)
         try:
-            proc.stdin.write('0x%x\n' % offset)
-            proc.stdin.flush()
-
-            # addr2line returns two lines for every address we give it.  The
-            # first line is of the form "foo()", and the second line is of the
-            # form "foo.cpp:123".
-            func = proc.stdout.readline().strip()
-            file_name = os.path.normpath(proc.stdout.readline().strip())
-            if func == '??' and file_name == '??:0':
-                # addr2line wasn't helpful here.
-                return '%s (no addr2line)' % fallback_str()
-            return '%s %s %s' % (func, file_name, addr_str())
-        except IOError as e:
-            # If our addr2line process dies, don't try to restart it.  Just
-            # leave it in a dead state and presumably every time we read/write
-            # to/from it, we'll hit this case.
-            return '%s (addr2line exception)' % fallback_str()
+            addr2line = self._options.cross_bin('addr2line')
+            index_dir = StackFixerCache.dwarf_index_dir(
+                self._options.cache_file)
+            tasks = [(lib_path, offsets, addr2line, self._options.symbolizer,
+                      index_dir)
+                     for (_, lib_path, offsets) in work]
+            for (i, results, seconds) in pool.imap_unordered(
+                    _resolve_lib_worker, enumerate(tasks)):
+                (lib, lib_path, offsets) = work[i]
+                yield (lib, lib_path, offsets, results, seconds)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def _resolve_many(self, lib, lib_path, offsets):
+        """Look up a list of offsets into lib, returning a list of
+        (func, file_name) pairs in the same order.
+
+        Raises IOError if addr2line fails.
+
+        """
+        symbolizer = self._get_dwarf_symbolizer(lib)
+        if symbolizer:
+            return [symbolizer.lookup(offset) for offset in offsets]
+        return _addr2line_many(self._options.cross_bin('addr2line'), lib_path,
+                               offsets)
+
+
+def _addr2line_many(addr2line, lib_path, offsets):
+    """Run addr2line once on lib_path, feeding it all of offsets on stdin.
+
+    Returns a list of (func, file_name) pairs in the same order as offsets.
+    Raises IOError if addr2line fails.
+
+    """
+    proc = subprocess.Popen([addr2line, '-Cfe', lib_path],
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out = proc.communicate(''.join('0x%x\n' % offset for offset in offsets))[0]
+    lines = out.splitlines()
+    if proc.returncode or len(lines) != 2 * len(offsets):
+        raise IOError('addr2line failed on %s' % lib_path)
+    return [(lines[i].strip(), lines[i + 1].strip())
+            for i in range(0, len(lines), 2)]
+
+
+def _resolve_lib_worker(task):
+    """Pool worker for StackFixer._resolve_libs.
+
+    task is (i, (lib_path, offsets, addr2line, symbolizer, index_dir)), where
+    index_dir is where the builtin symbolizer saves line tables.  Returns
+    (i, results, seconds), where results is a list of (func, file_name) pairs,
+    or None if we couldn't resolve the offsets, and seconds is how long we
+    took.
+
+    """
+    (i, (lib_path, offsets, addr2line, symbolizer, index_dir)) = task
+    start = time.time()
+    if symbolizer == 'builtin':
+        try:
+            dwarf = dwarf_utils.DwarfSymbolizer(lib_path, index_dir)
+            return i, [dwarf.lookup(offset) for offset in offsets], \
+                time.time() - start
+        except (IOError, OSError, elf_utils.ElfError, dwarf_utils.DwarfError):
+            pass
+    try:
+        results = _addr2line_many(addr2line, lib_path, offsets)
+    except (IOError, OSError):
+        results = None
+    return i, results, time.time() - start
 
 
 def fix_b2g_stacks_in_file(infile, outfile, args={}, **kwargs):
@@ -493,54 +1508,776 @@ def fix_b2g_stacks_in_file(infile, outfile, args={}, **kwargs):
     both).  See the docs on FixB2GStacksOptions for the supported argument
     names.
 
+    Returns a StackFixerStats describing where the time went.
+
     """
     if args and kwargs:
         raise Exception("Can't pass args and kwargs to fix_b2g_stacks_in_file.")
     options = FixB2GStacksOptions(args if args else kwargs)
 
-    if options.remove_cache:
+    start = time.time()
+    stats = StackFixerStats()
+    json_output = options.output_format == 'json'
+    if (options.no_daemon or options.pipeline or json_output or
+            not _fix_b2g_stacks_with_daemon(infile, outfile, options, stats)):
+        if options.remove_cache:
+            StackFixerCache.remove_cache_files(options.cache_file)
+            lib_index.LibIndex.remove(StackFixer.lib_index_filename())
+
+        if json_output:
+            _fix_b2g_stacks_as_json(infile, outfile, options, stats)
+        elif options.pipeline:
+            _fix_b2g_stacks_pipelined(infile, outfile, options, stats)
+        else:
+            _fix_b2g_stacks_serially(infile, outfile, options, stats)
+    total_seconds = time.time() - start
+
+    if options.stats:
+        stats.report(sys.stderr, total_seconds)
+    if options.stats_json:
+        with open(options.stats_json, 'w') as f:
+            json.dump(stats.summary(total_seconds), f, indent=2, sort_keys=True)
+    return stats
+
+
+def _fix_b2g_stacks_serially(infile, outfile, options, stats):
+    """fix_b2g_stacks_in_file for when we're not in pipeline mode and there's
+    no daemon to help us.  Adds the StackFixer's stats to stats."""
+    fixer = StackFixer(options)
+    try:
+        blocks = _line_blocks(_chunk_reader(infile, CHUNK_SIZE))
+        if options.batch:
+            spool = _prefetch_frames(blocks, fixer)
+            blocks = _line_blocks(_chunk_reader(spool, CHUNK_SIZE))
+        for block in blocks:
+            outfile.write(_fix_block(fixer, block))
+    finally:
+        fixer.close()
+        stats.merge(fixer.stats)
+
+
+def _fix_b2g_stacks_as_json(infile, outfile, options, stats):
+    """fix_b2g_stacks_in_file for output_format='json'.  Adds the
+    StackFixer's stats to stats."""
+    fixer = StackFixer(options)
+    try:
+        tables = StackTables(fixer)
+        blocks = _line_blocks(_chunk_reader(infile, CHUNK_SIZE))
+        if options.batch:
+            spool = _prefetch_frames(blocks, fixer)
+            blocks = _line_blocks(_chunk_reader(spool, CHUNK_SIZE))
+        for block in blocks:
+            tables.add_block(block)
+        tables.write(outfile)
+    finally:
+        fixer.close()
+        stats.merge(fixer.stats)
+
+
+# How many bytes we read, send, or receive at once when streaming input.
+CHUNK_SIZE = 64 * 1024
+
+
+def _chunk_reader(infile, size):
+    """Get a function which reads the next chunk of at most size bytes from
+    infile, returning '' at EOF.
+
+    If infile is a real file (e.g. stdin), the function returns whatever is
+    available rather than waiting for a whole chunk, so that piping a live
+    log through us works.
+
+    """
+    if isinstance(infile, file):
+        fd = infile.fileno()
+        return lambda: os.read(fd, size)
+    return lambda: infile.read(size)
+
+
+def _line_blocks(read):
+    """Yield the data we get from calling read() until it returns '', in
+    blocks of whole lines (except perhaps for the last one)."""
+    remainder = ''
+    while True:
+        data = read()
+        if not data:
+            break
+        end = data.rfind('\n') + 1
+        if not end:
+            remainder += data
+            continue
+        yield remainder + data[:end]
+        remainder = data[end:]
+    if remainder:
+        yield remainder
+
+
+_frame_matcher = re.compile(
+    r'''(?P<fn>[^ ][^\]]*)              # either '???' or mangled fn signature
+        \[
+          (?P<lib>\S+)                  # library name
+          \s+
+          \+(?P<offset>0x[0-9a-fA-F]+)  # offset into lib
+        \]
+        \s+
+        (?P<pc>0x[0-9a-fA-F]+)          # program counter
+        ''',
+    re.VERBOSE)
+
+
+def _frame_lines(block):
+    """Yield (start, end) for each line of block, a string of whole lines,
+    which might contain a stack frame.
+
+    Most lines of a big log have no frames in them.  Rather than running
+    _frame_matcher over every line, we search the block for '+0x', which
+    every frame contains, with str.find (a memchr-style scan in C), and check
+    the line it's on for a '['.  Only the lines which pass need the regex.
+
+    """
+    pos = 0
+    while True:
+        hit = block.find('+0x', pos)
+        if hit == -1:
+            return
+        start = block.rfind('\n', pos, hit) + 1 or pos
+        end = block.find('\n', hit) + 1 or len(block)
+        if block.find('[', start, end) != -1:
+            yield (start, end)
+        pos = end
+
+
+def _frame_stacks(block):
+    """Yield (start, end) for each run of consecutive lines in block which
+    _frame_lines() thinks might contain stack frames."""
+    run_start = run_end = None
+    for (start, end) in _frame_lines(block):
+        if start != run_end:
+            if run_end is not None:
+                yield (run_start, run_end)
+            run_start = start
+        run_end = end
+    if run_end is not None:
+        yield (run_start, run_end)
+
+
+def _fix_block(fixer, block):
+    """Rewrite the stack frames in block, a string of whole lines, with the
+    StackFixer fixer.
+
+    Function names come out of the symbolizers already demangled, so lines
+    without stack frames pass through untouched, and we hand each run of
+    lines with frames to fixer.translate_stack() in one piece.
+
+    """
+    pieces = []
+    pos = 0
+    for (start, end) in _frame_stacks(block):
+        pieces.append(block[pos:start])
+        pieces.append(fixer.translate_stack(block[start:end]))
+        pos = end
+    if not pieces:
+        return block
+    pieces.append(block[pos:])
+    return ''.join(pieces)
+
+
+def _translate_frames(fixer, text, lib_counts=None):
+    """Rewrite the stack frames in text with fixer.translate().  If
+    lib_counts is given, count the frames in each lib in it.
+
+    _frame_matcher.split() gives us each frame's fields without building a
+    match object per frame, and we assemble the output with a single join.
+
+    """
+    pieces = []
+    for line in text.splitlines(True):
+        # split() gives [text, fn, lib, offset, pc, text, fn, ...].
+        parts = _frame_matcher.split(line)
+        pieces.append(parts[0])
+        for i in xrange(1, len(parts), 5):
+            pieces.append(fixer.translate(parts[i + 1], int(parts[i + 2], 16),
+                                          int(parts[i + 3], 16), parts[i]))
+            pieces.append(parts[i + 4])
+            if lib_counts is not None:
+                lib_counts[parts[i + 1]] += 1
+    return ''.join(pieces)
+
+
+def _collect_frames(block, frames):
+    """Add the lib+offset of each frame in block, a string of whole lines, to
+    frames, a dict mapping libs to sets of offsets."""
+    for (start, end) in _frame_lines(block):
+        for (_, lib, offset, _) in _frame_matcher.findall(block, start, end):
+            frames[lib].add(int(offset, 16))
+
+
+class StackTables(object):
+    """The stacks in a log, with their frames rewritten by a StackFixer, in a
+    compact structured form.  This is what output_format='json' writes.
+
+    Rewritten text repeats every frame's function name, file name, and
+    library in full, so a fixed DMD log is several times the size of the
+    original.  Instead, we store each distinct string, frame, and stack once,
+    and refer to it by its index everywhere else.  write() produces a JSON
+    document like
+
+      {"version": 2,
+       "strings": ["nsFoo::Bar()", "dom/Foo.cpp", "libxul.so", ...],
+       "frames": {"schema": ["func", "file", "line", "lib", "offset"],
+                  "data": [[0, 1, 152, 2, 17062], ...]},
+       "stacks": [[0, 4, 5], ...],
+       "log": ["Unreported: 1 block in heap block record 1 of 10\n",
+               [0, 7, 8, 8, 9], "\n...", [1, 7, 8, 9], ...]}
+
+    In a frame, func, file and lib are indices into strings, and offset is
+    the frame's offset into lib.  func, file and line are null if we
+    couldn't look the frame up (though func is the function name the input
+    gave, if it gave one).  A stack is a list of indices into frames,
+    innermost frame first.
+
+    log is the input in order.  Its strings are the lines without stack
+    frames, verbatim.  Its lists stand for runs of consecutive lines with
+    frames in them: the first element is an index into stacks, and the rest
+    are indices into strings for the text around the stack's frames -- the
+    text before the first frame, then the text after each frame, up to the
+    next frame or the end of the run.  That's where DMD's '    #01: ' frame
+    numbers, logcat prefixes and line breaks go, so a run of n frames has
+    n + 1 of them.  A frame's own text (its input function name, library,
+    offset and pc) isn't kept.
+
+    """
+    # Bump this whenever the format of the document changes.
+    FORMAT_VERSION = 2
+
+    FRAME_SCHEMA = ['func', 'file', 'line', 'lib', 'offset']
+
+    def __init__(self, fixer):
+        self._fixer = fixer
+        self._strings = []
+        self._string_ids = {}
+        self._frames = []
+        # (lib, offset) --> index in self._frames
+        self._frame_ids = {}
+        self._stacks = []
+        # tuple of frame indices --> index in self._stacks
+        self._stack_ids = {}
+        self._log = []
+        # The stack we're in the middle of, as ([frame indices], [text around
+        # the frames]), or None.  A stack can carry on into the next block.
+        self._open_stack = None
+
+    def add_block(self, block):
+        """Add block, a string of whole lines, to the end of the log."""
+        pos = 0
+        for (start, end) in _frame_stacks(block):
+            self._add_text(block[pos:start])
+            for line in block[start:end].splitlines(True):
+                # split() gives [text, fn, lib, offset, pc, text, fn, ...].
+                parts = _frame_matcher.split(line)
+                if len(parts) == 1:
+                    # It looked like it might have a frame, but it doesn't.
+                    self._add_text(line)
+                    continue
+                if self._open_stack is None:
+                    self._open_stack = ([], [''])
+                (frames, texts) = self._open_stack
+                texts[-1] += parts[0]
+                for i in xrange(1, len(parts), 5):
+                    # _frame_matcher's fn includes DMD's frame number, but
+                    # that's part of the text around the frame.
+                    number = _frame_number_matcher.match(parts[i])
+                    if number:
+                        texts[-1] += number.group()
+                    frames.append(self._frame_id(parts[i + 1],
+                                                 int(parts[i + 2], 16),
+                                                 parts[i]))
+                    texts.append(parts[i + 4])
+            pos = end
+        self._add_text(block[pos:])
+
+    def write(self, outfile):
+        """Write the document to outfile, as JSON."""
+        self._close_stack()
+        json.dump({'version': self.FORMAT_VERSION,
+                   'strings': self._strings,
+                   'frames': {'schema': self.FRAME_SCHEMA,
+                              'data': self._frames},
+                   'stacks': self._stacks,
+                   'log': self._log},
+                  outfile, separators=(',', ':'))
+        outfile.write('\n')
+
+    def _close_stack(self):
+        if self._open_stack is None:
+            return
+        (frames, texts) = self._open_stack
+        self._log.append([self._stack_id(tuple(frames))] +
+                         [self._string_id(text) for text in texts])
+        self._open_stack = None
+
+    def _add_text(self, text):
+        if not text:
+            return
+        self._close_stack()
+        text = text.decode('utf-8', 'replace')
+        if self._log and isinstance(self._log[-1], unicode):
+            # Keep the lines between two stacks together, even if they
+            # straddle a block boundary.
+            self._log[-1] += text
+        else:
+            self._log.append(text)
+
+    def _string_id(self, string):
+        if string is None:
+            return None
+        string_id = self._string_ids.get(string)
+        if string_id is None:
+            string_id = self._string_ids[string] = len(self._strings)
+            self._strings.append(string.decode('utf-8', 'replace'))
+        return string_id
+
+    def _frame_id(self, lib, offset, fn_guess):
+        key = (lib, offset)
+        frame_id = self._frame_ids.get(key)
+        if frame_id is None:
+            (func, file_name, line) = self._resolve(lib, offset, fn_guess)
+            frame_id = self._frame_ids[key] = len(self._frames)
+            self._frames.append([self._string_id(func),
+                                 self._string_id(file_name), line,
+                                 self._string_id(lib), offset])
+        return frame_id
+
+    def _stack_id(self, stack):
+        stack_id = self._stack_ids.get(stack)
+        if stack_id is None:
+            stack_id = self._stack_ids[stack] = len(self._stacks)
+            self._stacks.append(list(stack))
+        return stack_id
+
+    def _resolve(self, lib, offset, fn_guess):
+        """Get (func, file_name, line) for lib+offset, with None for whatever
+        we don't know."""
+        (result, _) = self._fixer.lookup(lib, offset)
+        if result:
+            (func, file_line) = result
+            match = _file_line_matcher.match(file_line)
+            if match and match.group('file') != '??':
+                return (func, match.group('file'), int(match.group('line')))
+            if func != '??':
+                return (func, None, None)
+        # _frame_matcher's fn includes DMD's frame number, if there is one.
+        fn_guess = _frame_number_matcher.sub('', fn_guess or '')
+        if fn_guess and fn_guess != '???':
+            return (demangle.demangle_text(fn_guess), None, None)
+        return (None, None, None)
+
+
+# Matches the '#01: ' in front of each of DMD's frames.
+_frame_number_matcher = re.compile(r'^#\d+:\s*')
+
+# Splits a symbolizer's 'path/to/file.cpp:123' (addr2line sometimes adds
+# ' (discriminator 2)') into the file and line.
+_file_line_matcher = re.compile(
+    r'(?P<file>.*):(?P<line>\d+)(?: \(discriminator \d+\))?$')
+
+
+# Pipeline mode reads its input in blocks of about this many bytes (extended
+# to the next line boundary).
+PIPELINE_BLOCK_SIZE = 1024 * 1024
+
+
+def _fix_b2g_stacks_pipelined(infile, outfile, options, stats):
+    """fix_b2g_stacks_in_file for options.pipeline mode.
+
+    We run three stages concurrently:
+
+      * A reader thread pulls line-aligned blocks of about PIPELINE_BLOCK_SIZE
+        bytes out of infile.  Reading big chunks lets GzipFile decompress in
+        bulk (and zlib releases the GIL while it does so).
+
+      * options.jobs worker processes each rewrite whole blocks, with a
+        StackFixer of their own.  The workers share the on-disk symbol cache,
+        so a frame one worker resolves is a cache hit for the others on the
+        next run.
+
+      * This thread writes the rewritten blocks to outfile in input order.
+
+    We hold roughly options.pipeline_memory MB of blocks at once, so memory
+    use is bounded no matter how big infile is.  We count the input of the
+    blocks the workers haven't finished yet, and the output of the ones they
+    have which we haven't written yet.  We budget by bytes rather than
+    blocks because rewritten blocks are several times bigger than the input.
+
+    The workers send back their StackFixers' stats with each block, and we
+    add them to stats.  (Their final cache flushes happen as they exit, so
+    stats doesn't count those.)
+
+    """
+    max_bytes = options.pipeline_memory * 1024 * 1024
+    blocks = Queue.Queue(maxsize=2)
+
+    def read_blocks():
         try:
-            os.remove(StackFixerCache.cache_filename())
-        except Exception:
+            for block in _line_blocks(
+                    lambda: infile.read(PIPELINE_BLOCK_SIZE)):
+                blocks.put(block)
+            blocks.put(None)
+        except Exception as e:
+            blocks.put(e)
+
+    # Each worker resolves frames on its own, so it shouldn't start pools of
+    # its own; daemonic pool processes can't have children anyway.
+    worker_options = copy.copy(options)
+    worker_options.jobs = 1
+    pool = multiprocessing.Pool(max(1, options.jobs),
+                                initializer=_pipeline_worker_init,
+                                initargs=(worker_options,))
+    reader = threading.Thread(target=read_blocks)
+    reader.daemon = True
+    reader.start()
+    try:
+        def write_block():
+            (_, result) = pending.popleft()
+            (out, block_stats) = result.get()
+            outfile.write(out)
+            stats.merge(block_stats)
+
+        def pending_bytes():
+            total = 0
+            for (input_size, result) in pending:
+                if result.ready():
+                    total += len(result.get()[0])
+                else:
+                    total += input_size
+            return total
+
+        # (size of the block's input, AsyncResult of its output)
+        pending = deque()
+        while True:
+            block = blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if block is None:
+                break
+            pending.append((len(block),
+                            pool.apply_async(_pipeline_fix_block, (block,))))
+            del block
+            # Always keep one block in flight, so the workers have something
+            # to do while we write.
+            while len(pending) > 1 and pending_bytes() > max_bytes:
+                write_block()
+        while pending:
+            write_block()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+# A pipeline worker process's options and StackFixer.
+_pipeline_options = None
+_pipeline_fixer = None
+
+
+def _pipeline_worker_init(options):
+    global _pipeline_options, _pipeline_fixer
+    _pipeline_options = options
+    _pipeline_fixer = StackFixer(options)
+    # Flush the fixer's cache when the worker exits.
+    multiprocessing.util.Finalize(None, _pipeline_fixer.close, exitpriority=10)
+
+
+def _pipeline_fix_block(block):
+    """Pool worker for _fix_b2g_stacks_pipelined: rewrite the stack frames in
+    block, a string of whole lines.
+
+    Returns the rewritten block and the vars() of our StackFixer's stats
+    while working on it.
+
+    """
+    if _pipeline_options.batch:
+        frames = defaultdict(set)
+        _collect_frames(block, frames)
+        _pipeline_fixer.prefetch(frames)
+    out = _fix_block(_pipeline_fixer, block)
+    # Commit what we've added to the cache.  Otherwise we'd hold the cache's
+    # write lock while we wait for our next block, and the other workers
+    # would time out waiting for it.
+    _pipeline_fixer.flush()
+    return (out, vars(_pipeline_fixer.stats.take()))
+
+
+def _prefetch_frames(blocks, fixer):
+    """The first pass of batch mode: copy blocks (an iterable of strings of
+    whole lines) into a temporary file while collecting every distinct frame
+    in them, then resolve all of those frames with fixer.prefetch().
+
+    Returns the temporary file, rewound, so the second pass can rewrite it.
+
+    """
+    frames = defaultdict(set)
+    spool = tempfile.TemporaryFile()
+    for block in blocks:
+        spool.write(block)
+        _collect_frames(block, frames)
+    fixer.prefetch(frames)
+    spool.seek(0)
+    return spool
+
+
+# Bump this whenever the messages StackFixerDaemon and its clients exchange
+# change.  Clients fall back to working locally if the daemon disagrees.
+DAEMON_PROTOCOL_VERSION = 2
+
+
+class StackFixerDaemon(SocketServer.UnixStreamServer):
+    """A server which fixes stacks on behalf of fix_b2g_stacks_in_file.
+
+    Most of the time a short run of fix_b2g_stack.py takes goes into learning
+    things which don't change between runs: walking the objdirs for
+    libraries, reading libraries' line tables, starting addr2line processes,
+    and pulling cached symbols out of the database.  The daemon learns them
+    once and keeps them in memory, in one StackFixer per configuration
+    (search dirs, toolchain, symbolizer, cache file).  Before each request,
+    we refresh() the StackFixer, so libraries which have been rebuilt since
+    the last request are looked up afresh.  We close StackFixers which
+    haven't served a request for FIXER_IDLE_TIMEOUT seconds, and keep at most
+    MAX_FIXERS of them, so that a long-lived daemon doesn't hold on to the
+    addr2line processes and tables of configurations nobody uses any more.
+
+    A request goes like this:
+
+      * The client sends a line containing the repr() of a dict with the
+        protocol version and the vars() of its FixB2GStacksOptions.
+
+      * We reply "ok" on a line of its own, or "error: <message>", in which
+        case the client does the work itself.
+
+      * The client streams its input and shuts down its side of the socket.
+        Meanwhile, we send the output as chunks, each preceded by a line
+        giving its length in bytes.  An empty chunk marks the end of the
+        output; if something goes wrong, we send "error: <message>" instead.
+
+      * If the client asked for stats, we then send a line containing the
+        repr() of the vars() of the StackFixerStats for the request.
+
+    We serve one request at a time; clients which connect while we're busy
+    wait their turn.  The socket is only accessible to the user who started
+    the daemon.  If no request arrives for idle_timeout seconds, serve()
+    returns.
+
+    """
+    MAX_FIXERS = 4
+    FIXER_IDLE_TIMEOUT = 60 * 60
+
+    def __init__(self, socket_path, idle_timeout=None):
+        # Maps each configuration's key to its StackFixer and the time it last
+        # served a request, least recently used first.
+        self._fixers = OrderedDict()
+        self._idle = False
+        self.timeout = idle_timeout or None
+        self._remove_stale_socket(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               _StackFixerDaemonHandler)
+
+    @staticmethod
+    def socket_filename():
+        """Get the default filename of the daemon's socket."""
+        return os.path.join(dirname(__file__), '.fix_b2g_stack.sock')
+
+    @staticmethod
+    def _remove_stale_socket(socket_path):
+        """Remove the socket a dead daemon left behind at socket_path.  Raise
+        an exception if a live daemon is listening there."""
+        if not os.path.exists(socket_path):
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+        except socket.error:
+            os.remove(socket_path)
+            return
+        finally:
+            sock.close()
+        raise Exception('A fix_b2g_stack daemon is already listening on %s.' %
+                        socket_path)
+
+    def server_bind(self):
+        old_umask = os.umask(0o177)
+        try:
+            SocketServer.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(old_umask)
+
+    def serve(self):
+        """Serve requests until we've been idle for idle_timeout seconds."""
+        while not self._idle:
+            self.handle_request()
+
+    def handle_timeout(self):
+        self._idle = True
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        self._close_fixers(len(self._fixers))
+        try:
+            os.remove(self.server_address)
+        except OSError:
             pass
 
-    matcher = re.compile(
-        r'''(?P<fn>[^ ][^\]]*)              # either '???' or mangled fn signature
-            \[
-              (?P<lib>\S+)                  # library name
-              \s+
-              \+(?P<offset>0x[0-9a-fA-F]+)  # offset into lib
-            \]
-            \s+
-            (?P<pc>0x[0-9a-fA-F]+)          # program counter
-            ''',
-        re.VERBOSE)
+    def _get_fixer(self, options):
+        """Get our StackFixer for options, creating it if necessary."""
+        if options.remove_cache:
+            # Drop our StackFixers, along with their connections to the cache.
+            self._close_fixers(len(self._fixers))
+            StackFixerCache.remove_cache_files(options.cache_file)
+            lib_index.LibIndex.remove(StackFixer.lib_index_filename())
+
+        key = (options.lib_search_key(), options._toolchain_dir,
+               options.toolchain_prefix, options.symbolizer,
+               options.cache_file, options.cache_max_size, options.jobs,
+               options.addr2line_procs, options.addr2line_memory)
+        now = time.time()
+        (fixer, _) = self._fixers.pop(key, (None, None))
+        idle = [k for (k, (_, last_used)) in self._fixers.iteritems()
+                if now - last_used > self.FIXER_IDLE_TIMEOUT]
+        self._close_fixers(max(len(idle), len(self._fixers) + 1 - self.MAX_FIXERS))
+        if fixer:
+            fixer.refresh()
+        else:
+            fixer = StackFixer(options)
+        self._fixers[key] = (fixer, now)
+        return fixer
+
+    def _close_fixers(self, count):
+        """Close our count least recently used StackFixers."""
+        for _ in range(count):
+            (_, (fixer, _)) = self._fixers.popitem(last=False)
+            fixer.close()
+
+    def fix_stacks(self, sock):
+        """Serve one request from the client connected to sock."""
+        blocks = _line_blocks(lambda: sock.recv(CHUNK_SIZE))
+        first_block = next(blocks, '')
+        if not first_block:
+            return
+        (request, _, rest) = first_block.partition('\n')
+        try:
+            request = ast.literal_eval(request)
+        except (SyntaxError, ValueError):
+            request = None
+        if (not isinstance(request, dict) or
+                request.get('version') != DAEMON_PROTOCOL_VERSION):
+            sock.sendall('error: expected protocol version %d\n' %
+                         DAEMON_PROTOCOL_VERSION)
+            return
+
+        options = FixB2GStacksOptions._from_vars(request['options'])
+        fixer = self._get_fixer(options)
+        fixer.stats.take()
+        sock.sendall('ok\n')
+
+        try:
+            blocks = itertools.chain([rest], blocks)
+            if options.batch:
+                spool = _prefetch_frames(blocks, fixer)
+                blocks = _line_blocks(_chunk_reader(spool, CHUNK_SIZE))
+            for block in blocks:
+                out = _fix_block(fixer, block)
+                if out:
+                    sock.sendall('%d\n%s' % (len(out), out))
+            sock.sendall('0\n')
+        finally:
+            fixer.flush()
+        if options.stats or options.stats_json:
+            sock.sendall(repr(vars(fixer.stats.take())) + '\n')
+
+
+class _StackFixerDaemonHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        try:
+            self.server.fix_stacks(self.request)
+        except Exception as e:
+            try:
+                self.request.sendall('error: %s\n' % e)
+            except socket.error:
+                pass
+            raise
 
-    fixer = StackFixer(options)
 
-    def subfn(match):
-        return fixer.translate(match.group('lib'),
-                               int(match.group('offset'), 16),
-                               int(match.group('pc'), 16),
-                               match.group('fn'))
-
-    # Filter our output through c++filt.  Pumping on a separate thread is
-    # *much* faster than filtering line-by-line.
-    #
-    # On Mac OS, the native c++filt doesn't filter our output correctly, so we
-    # use the cross-compiled one.  (I don't know if the system c++filt works
-    # properly on Linux, though I imagine it does.)
-    cppfilt = subprocess.Popen([options.cross_bin('c++filt')],
-                               stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE)
+def _fix_b2g_stacks_with_daemon(infile, outfile, options, stats):
+    """Have the StackFixerDaemon listening on options.daemon_socket do the
+    work of fix_b2g_stacks_in_file, adding the daemon's stats for the work to
+    stats.
+
+    Returns False, without having read anything from infile, if there's no
+    daemon there or it won't take our request.
+
+    """
+    if not os.path.exists(options.daemon_socket):
+        return False
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     try:
-        p = pump(outfile, cppfilt.stdout)
-        for line in infile:
-            cppfilt.stdin.write(matcher.sub(subfn, line))
+        try:
+            sock.connect(options.daemon_socket)
+        except socket.error:
+            return False
+
+        # The daemon may be running in another directory.
+        attrs = dict(vars(options))
+        attrs['cache_file'] = os.path.abspath(options.cache_file)
+        for attr in ('gecko_objdir', 'gonk_objdir', '_toolchain_dir'):
+            if attrs[attr]:
+                attrs[attr] = os.path.abspath(attrs[attr])
+        # Let the daemon guess the product, if need be.
+        attrs['_lib_search_dirs'] = None
+        sock.sendall(repr({'version': DAEMON_PROTOCOL_VERSION,
+                           'options': attrs}) + '\n')
+        replies = sock.makefile('rb')
+        if replies.readline() != 'ok\n':
+            return False
+
+        # Send the input on another thread, so neither we nor the daemon block
+        # on a full socket buffer.
+        read = _chunk_reader(infile, CHUNK_SIZE)
+        errors = []
+
+        def send_input():
+            try:
+                for data in iter(read, ''):
+                    sock.sendall(data)
+                sock.shutdown(socket.SHUT_WR)
+            except Exception as e:
+                errors.append(e)
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+        sender = threading.Thread(target=send_input)
+        sender.daemon = True
+        sender.start()
+
+        while True:
+            line = replies.readline()
+            if not line.strip().isdigit():
+                raise Exception('The fix_b2g_stack daemon failed: %s' %
+                                (line.strip() or 'it hung up'))
+            size = int(line)
+            if not size:
+                break
+            outfile.write(replies.read(size))
+        if options.stats or options.stats_json:
+            stats.merge(ast.literal_eval(replies.readline()))
+
+        sender.join()
+        if errors:
+            raise errors[0]
+        return True
     finally:
-        cppfilt.stdin.close()
-    p.join()
-    fixer.close()
+        sock.close()
 
 
 def add_argparse_arguments(parser):
@@ -566,7 +2303,60 @@ def add_argparse_arguments(parser):
                         help='Product being built (e.g. "otoro").  '
                              'We try to detect this automatically.')
     parser.add_argument('--remove-cache', action='store_true',
-                        help="Delete the persistent addr2line cache before running.")
+                        help="Delete the persistent symbol cache and library "
+                             "index before running.")
+    parser.add_argument('--cache-file', metavar='FILE',
+                        help='Symbol cache database to use.  It may be shared '
+                             'between checkouts of the same build (default: '
+                             '.fix_b2g_stack.sqlite next to fix_b2g_stack.py)')
+    parser.add_argument('--cache-max-size', metavar='MB', type=int,
+                        help='Evict the least recently used libraries and '
+                             'entries when the symbol cache grows past this '
+                             'size (default: 256)')
+    parser.add_argument('--symbolizer', choices=SYMBOLIZERS,
+                        help='How to translate lib+offsets into function and '
+                             'file names: "builtin" reads DWARF line tables '
+                             'in-process, falling back to addr2line for libs '
+                             'it can\'t read (default: builtin)')
+    parser.add_argument('--addr2line-procs', metavar='N', type=int,
+                        help='Most addr2line processes to keep running at '
+                             'once (default: 8)')
+    parser.add_argument('--addr2line-memory', metavar='MB', type=int,
+                        help='Stop the least recently used addr2line '
+                             'processes when they use more than this much '
+                             'RAM between them (default: 4096)')
+    parser.add_argument('--batch', action='store_true',
+                        help='Read all of the input first, then resolve each '
+                             'library\'s frames in one bulk lookup.  Faster on '
+                             'big inputs, but produces no output until the '
+                             'whole input has been read.')
+    parser.add_argument('--jobs', metavar='N', type=int,
+                        help='Number of libraries to resolve concurrently in '
+                             '--batch mode, or of worker processes in '
+                             '--pipeline mode (default: number of CPUs)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Rewrite the input in blocks on several worker '
+                             'processes, streaming the output in order.  '
+                             'Fastest for huge inputs.')
+    parser.add_argument('--pipeline-memory', metavar='MB', type=int,
+                        help='Cap on the input and output --pipeline mode '
+                             'holds in memory at once (default: 256)')
+    parser.add_argument('--daemon-socket', metavar='FILE',
+                        help='Socket of the fix_b2g_stack.py --daemon to use '
+                             '(default: .fix_b2g_stack.sock next to '
+                             'fix_b2g_stack.py)')
+    parser.add_argument('--no-daemon', action='store_true',
+                        help="Don't use a running fix_b2g_stack.py --daemon.")
+    parser.add_argument('--stats', action='store_true',
+                        help='Print lookup counts, cache hit ratios, resolver '
+                             'latencies and per-phase timings to stderr.')
+    parser.add_argument('--stats-json', metavar='FILE',
+                        help='Write the --stats summary to FILE as JSON.')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS,
+                        help='"text" rewrites the frames in the input; "json" '
+                             'writes a compact document with tables of '
+                             'distinct strings, frames and stacks instead '
+                             '(default: text)')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -579,8 +2369,40 @@ if __name__ == '__main__':
                             File to write output to (default: stdout).  If name
                             ends with ".gz", we will gzip the file.'''))
     add_argparse_arguments(parser)
+    parser.add_argument('--daemon', action='store_true',
+                        help='Instead of fixing stacks, stay running and fix '
+                             'them on behalf of later runs, which is faster.  '
+                             'Ignores all other options except '
+                             '--daemon-socket.')
+    parser.add_argument('--compact-cache', action='store_true',
+                        help='Instead of fixing stacks, shrink the symbol '
+                             'cache to --cache-max-size and rebuild it to '
+                             'free unused disk space.')
+    parser.add_argument('--daemon-idle-timeout', metavar='MINUTES', type=float,
+                        default=60,
+                        help='Exit the daemon after this many minutes without '
+                             'a request; 0 means never (default: 60)')
     args = parser.parse_args()
 
+    if args.compact_cache:
+        cache = StackFixerCache(FixB2GStacksOptions(args))
+        (before, after) = cache.compact()
+        print('Compacted the symbol cache from %.1f MB to %.1f MB.' %
+              (before / 1024.0 / 1024, after / 1024.0 / 1024), file=sys.stderr)
+        sys.exit(0)
+
+    if args.daemon:
+        daemon = StackFixerDaemon(
+            args.daemon_socket or StackFixerDaemon.socket_filename(),
+            idle_timeout=args.daemon_idle_timeout * 60)
+        # Clean up our socket when we're killed.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            daemon.serve()
+        finally:
+            daemon.server_close()
+        sys.exit(0)
+
     infile = sys.stdin
     if args.infile:
         if args.infile.endswith('.gz'):
@@ -595,4 +2417,7 @@ if __name__ == '__main__':
         else:
             outfile = open(args.outfile, 'w')
 
-    fix_b2g_stacks_in_file(infile, outfile, args)
+    try:
+        fix_b2g_stacks_in_file(infile, outfile, args)
+    finally:
+        outfile.close()
@@ -0,0 +1,929 @@
+"""An in-process demangler for C++ symbols mangled per the Itanium C++ ABI,
+which is the scheme gcc and clang use on Linux and Android.
+
+    >>> demangle('_ZN7mozilla3dom7Element12SetAttributeERK9nsAStringS4_')
+    'mozilla::dom::Element::SetAttribute(nsAString const&, nsAString const&)'
+
+We aim to produce the same text as c++filt.  We handle the constructs which
+show up in Gecko and Gonk libraries (nested and local names, templates,
+substitutions, operators, function and member pointers, thunks, clones, and
+so on); for the rare symbol which uses something we don't understand (e.g.
+most template argument expressions, beyond literals, template parameters and
+simple dependent names), demangle() returns the symbol
+unchanged, which is also what c++filt does for symbols it can't parse.
+
+"""
+
+from __future__ import print_function
+
+import re
+from collections import OrderedDict
+
+_BUILTIN_TYPES = {
+    'v': 'void', 'w': 'wchar_t', 'b': 'bool', 'c': 'char', 'a': 'signed char',
+    'h': 'unsigned char', 's': 'short', 't': 'unsigned short', 'i': 'int',
+    'j': 'unsigned int', 'l': 'long', 'm': 'unsigned long', 'x': 'long long',
+    'y': 'unsigned long long', 'n': '__int128', 'o': 'unsigned __int128',
+    'f': 'float', 'd': 'double', 'e': 'long double', 'g': '__float128',
+    'z': '...',
+}
+
+_D_BUILTIN_TYPES = {
+    'd': 'decimal64', 'e': 'decimal128', 'f': 'decimal32', 'h': 'half',
+    'i': 'char32_t', 's': 'char16_t', 'u': 'char8_t', 'a': 'auto',
+    'c': 'decltype(auto)', 'n': 'decltype(nullptr)',
+}
+
+# Suffixes for integer literals in template arguments, e.g. Foo<3u>.
+_LITERAL_SUFFIXES = {
+    'i': '', 'j': 'u', 'l': 'l', 'm': 'ul', 'x': 'll', 'y': 'ull',
+}
+
+_OPERATORS = {
+    'nw': 'new', 'na': 'new[]', 'dl': 'delete', 'da': 'delete[]',
+    'ps': '+', 'ng': '-', 'ad': '&', 'de': '*', 'co': '~', 'pl': '+',
+    'mi': '-', 'ml': '*', 'dv': '/', 'rm': '%', 'an': '&', 'or': '|',
+    'eo': '^', 'aS': '=', 'pL': '+=', 'mI': '-=', 'mL': '*=', 'dV': '/=',
+    'rM': '%=', 'aN': '&=', 'oR': '|=', 'eO': '^=', 'ls': '<<', 'rs': '>>',
+    'lS': '<<=', 'rS': '>>=', 'eq': '==', 'ne': '!=', 'lt': '<', 'gt': '>',
+    'le': '<=', 'ge': '>=', 'ss': '<=>', 'nt': '!', 'aa': '&&', 'oo': '||',
+    'pp': '++', 'mm': '--', 'cm': ',', 'pm': '->*', 'pt': '->', 'cl': '()',
+    'ix': '[]', 'qu': '?', 'aw': 'co_await',
+}
+
+_STD_SUBSTITUTIONS = {
+    't': 'std',
+    'a': 'std::allocator',
+    'b': 'std::basic_string',
+    # Like c++filt, we spell these out rather than printing std::string etc.
+    's': 'std::basic_string<char, std::char_traits<char>, std::allocator<char> >',
+    'i': 'std::basic_istream<char, std::char_traits<char> >',
+    'o': 'std::basic_ostream<char, std::char_traits<char> >',
+    'd': 'std::basic_iostream<char, std::char_traits<char> >',
+}
+
+_SPECIAL_NAMES = {
+    'V': 'vtable for ',
+    'T': 'VTT for ',
+    'I': 'typeinfo for ',
+    'S': 'typeinfo name for ',
+}
+
+_ABI_TAGS = re.compile(r'(?:\[abi:[^\]]*\])+$')
+
+_CLONE_SUFFIX = re.compile(r'\.[A-Za-z_]+(?:\.[0-9]+)*|(?:\.[0-9]+)+')
+
+
+class DemangleError(Exception):
+    pass
+
+
+def _join_args(args):
+    """Join argument texts with ', ' the way c++filt does.
+
+    c++filt drops the ', ' before an empty pack only when nothing follows it,
+    so an empty pack leaves e.g. 'f<, int>' or 'f(int, , char)' behind.
+
+    """
+    text = ''
+    for arg in reversed(args):
+        text = arg + ', ' + text if text else arg
+    return text
+
+
+def _join_template_args(args):
+    """Render a list of template argument texts as '<...>'.
+
+    Like c++filt, we leave a space between two closing angle brackets, except
+    after a trailing empty pack (c++filt's quirk, which we mimic so our output
+    matches its).
+
+    """
+    text = '<' + _join_args(args)
+    if text.endswith('>') and not (len(args) > 1 and not args[-1]):
+        text += ' '
+    return text + '>'
+
+
+class _Name(object):
+    """A type or name which renders as plain text.  |template_args|, if not
+    None, is the list of template arguments this name was instantiated with.
+    """
+    def __init__(self, text, template_args=None):
+        self.text = text
+        self.template_args = template_args
+
+    def render(self, decl=''):
+        return self.text + decl
+
+
+class _Qualified(object):
+    def __init__(self, inner, quals):
+        # const T with T = int const is just int const.
+        if isinstance(inner, _Qualified):
+            quals = inner.quals + ''.join(' ' + q for q in quals.split()
+                                          if q not in inner.quals.split())
+            inner = inner.inner
+        self.inner = inner
+        self.quals = quals
+
+    def render(self, decl=''):
+        if isinstance(self.inner, _Array):
+            # A const array is an array of const elements.
+            return _Array(_Qualified(self.inner.inner, self.quals),
+                          self.inner.dim).render(decl)
+        if isinstance(self.inner, _Function):
+            # Only member functions are cv-qualified; see _PointerToMember.
+            return self.inner.render(decl, self.quals)
+        return self.inner.render(self.quals + decl)
+
+
+class _Pointer(object):
+    def __init__(self, inner, op):
+        # Collapse references to references, e.g. T&& with T = int& is int&.
+        if op in ('&', '&&') and isinstance(inner, _Pointer) and \
+           inner.op in ('&', '&&'):
+            op = '&' if '&' in (op, inner.op) else '&&'
+            inner = inner.inner
+        self.inner = inner
+        self.op = op
+
+    def render(self, decl=''):
+        return self.inner.render(self.op + decl)
+
+
+class _Function(object):
+    def __init__(self, ret, params, ref_qual=''):
+        self.ret = ret
+        self.params = params
+        self.ref_qual = ref_qual
+
+    def render(self, decl='', quals=''):
+        quals += self.ref_qual
+        if self._returns_function_or_array():
+            # e.g. 'void (*(int))(char)', a function of int returning a
+            # pointer to a function of char.
+            if decl:
+                return self.ret.render('(%s)(%s)%s' %
+                                       (decl, self.params, quals))
+            return self.ret.render('(%s)%s' % (self.params, quals))
+        ret = self.ret.render() + ' ' if self.ret else ''
+        if decl:
+            return '%s(%s)(%s)%s' % (ret, decl, self.params, quals)
+        return '%s(%s)%s' % (ret, self.params, quals)
+
+    def _returns_function_or_array(self):
+        ret = self.ret
+        while isinstance(ret, (_Pointer, _Qualified, _PointerToMember)):
+            if isinstance(ret, _PointerToMember):
+                ret = ret.member
+            else:
+                ret = ret.inner
+        return isinstance(ret, (_Function, _Array)) and ret is not self.ret
+
+
+class _Array(object):
+    def __init__(self, inner, dim):
+        self.inner = inner
+        self.dim = dim
+
+    def render(self, decl=''):
+        # Arrays of arrays print as e.g. 'int [2][3]'.
+        dims = '[%s]' % self.dim
+        element = self.inner
+        while True:
+            if isinstance(element, _Qualified) and \
+               isinstance(element.inner, _Array):
+                element = _Array(_Qualified(element.inner.inner, element.quals),
+                                 element.inner.dim)
+            if not isinstance(element, _Array):
+                break
+            dims += '[%s]' % element.dim
+            element = element.inner
+        if decl:
+            return element.render(' (%s) %s' % (decl, dims))
+        return element.render(' ' + dims)
+
+
+class _PointerToMember(object):
+    def __init__(self, cls, member):
+        self.cls = cls
+        self.member = member
+
+    def render(self, decl=''):
+        member = self.member
+        if isinstance(member, _Function) or \
+           (isinstance(member, _Qualified) and isinstance(member.inner, _Function)):
+            return member.render(self.cls.render() + '::*' + decl)
+        return member.render(' ' + self.cls.render() + '::*' + decl)
+
+
+class _Pack(object):
+    """An argument pack, e.g. the <int, char> of f<int, char>(...)."""
+    def __init__(self, elements):
+        self.elements = elements
+
+    def render(self, decl=''):
+        return _join_args([e.render(decl) for e in self.elements])
+
+
+class _Demangler(object):
+    def __init__(self, mangled):
+        self.s = mangled
+        self.pos = 0
+        self.subs = []
+        self.template_args = []
+        # The last <source-name> we parsed outside of template arguments.
+        # Like c++filt, we name the constructors and destructors of unnamed
+        # types after it.
+        self.last_name = None
+        # While we expand a pack expansion, the index of the element of the
+        # pack we're printing the pattern for (see pack_expansion()).
+        self.pack_index = None
+        # The first pack a pack expansion's pattern referred to.
+        self.found_pack = None
+
+    # Low-level helpers.
+
+    def peek(self, n=1):
+        return self.s[self.pos:self.pos + n]
+
+    def next(self):
+        if self.pos >= len(self.s):
+            raise DemangleError('unexpected end of symbol')
+        c = self.s[self.pos]
+        self.pos += 1
+        return c
+
+    def consume(self, prefix):
+        if self.s.startswith(prefix, self.pos):
+            self.pos += len(prefix)
+            return True
+        return False
+
+    def expect(self, prefix):
+        if not self.consume(prefix):
+            raise DemangleError('expected %r at %d' % (prefix, self.pos))
+
+    def number(self):
+        start = self.pos
+        negative = self.consume('n')
+        digits_start = self.pos
+        while self.peek().isdigit():
+            self.pos += 1
+        if self.pos == digits_start:
+            raise DemangleError('expected a number at %d' % start)
+        value = int(self.s[digits_start:self.pos])
+        return -value if negative else value
+
+    def seq_id(self):
+        """Parse the <seq-id> of a substitution or template parameter, up to
+        and including the '_'.  Returns 0 for a bare '_', else seq-id + 1."""
+        if self.consume('_'):
+            return 0
+        value = 0
+        while True:
+            c = self.next()
+            if c == '_':
+                return value + 1
+            if c.isdigit():
+                value = value * 36 + int(c)
+            elif c.isupper():
+                value = value * 36 + ord(c) - ord('A') + 10
+            else:
+                raise DemangleError('bad seq-id at %d' % self.pos)
+
+    def discriminator(self):
+        # Like c++filt, accept a '_' with no number after it.
+        if self.consume('__'):
+            self.number()
+            self.expect('_')
+        elif self.consume('_') and self.peek().isdigit():
+            self.number()
+
+    # Encodings.
+
+    def encoding(self, with_return_type=True):
+        """Parse an <encoding>.  Returns the demangled text.
+
+        Like c++filt, we leave out the return type of the function enclosing a
+        local name (with_return_type=False).
+
+        """
+        c = self.peek()
+        if c in ('T', 'G') and self.peek(2) not in ('Ts', 'Tu', 'Te'):
+            return self.special_name()
+
+        (name, cv_quals, is_template) = self.name(top_level=True)
+        if self.pos >= len(self.s) or self.peek() in ('E', '.'):
+            return name.render()
+
+        # Function templates (other than constructors, destructors and
+        # conversion operators) encode their return type first.
+        ret = None
+        if is_template and not getattr(name, 'no_return_type', False):
+            ret = self.type()
+        params = self.bare_function_type()
+        text = '%s(%s)%s' % (name.render(), params, cv_quals)
+        if ret and with_return_type:
+            text = ret.render() + ' ' + text
+        return text
+
+    def bare_function_type(self):
+        params = []
+        while self.pos < len(self.s) and self.peek() not in ('E', '.'):
+            params.append(self.type())
+        return self.params_text(params)
+
+    @staticmethod
+    def params_text(params):
+        if len(params) == 1 and isinstance(params[0], _Name) and \
+           params[0].text == 'void':
+            return ''
+        return _join_args([p.render() for p in params])
+
+    def special_name(self):
+        if self.consume('T'):
+            c = self.next()
+            if c in _SPECIAL_NAMES:
+                return _SPECIAL_NAMES[c] + self.type().render()
+            if c == 'h':
+                self.call_offset('h')
+                return 'non-virtual thunk to ' + self.encoding()
+            if c == 'v':
+                self.call_offset('v')
+                return 'virtual thunk to ' + self.encoding()
+            if c == 'c':
+                self.call_offset(self.next())
+                self.call_offset(self.next())
+                return 'covariant return thunk to ' + self.encoding()
+            if c == 'C':
+                derived = self.type()
+                self.number()
+                self.expect('_')
+                base = self.type()
+                return 'construction vtable for %s-in-%s' % (base.render(),
+                                                             derived.render())
+            if c == 'H':
+                return 'TLS init function for ' + self.name()[0].render()
+            if c == 'W':
+                return 'TLS wrapper function for ' + self.name()[0].render()
+            raise DemangleError('unknown special name T%s' % c)
+
+        self.expect('G')
+        c = self.next()
+        if c == 'V':
+            return 'guard variable for ' + self.name()[0].render()
+        if c == 'R':
+            # c++filt reads an optional number here, but not the '_' which
+            # ends the name, so it gives up on names like _ZGR1x_ (unless the
+            # '_' reads as a local name's discriminator).  So do we.
+            name = self.name()[0].render()
+            index = self.number() if self.peek().isdigit() else 0
+            return 'reference temporary #%d for %s' % (index, name)
+        if c == 'T':
+            self.consume('t') or self.consume('n')
+            return 'transaction clone for ' + self.encoding()
+        raise DemangleError('unknown special name G%s' % c)
+
+    def call_offset(self, kind):
+        if kind == 'h':
+            self.number()
+            self.expect('_')
+        elif kind == 'v':
+            self.number()
+            self.expect('_')
+            self.number()
+            self.expect('_')
+        else:
+            raise DemangleError('bad call offset')
+
+    # Names.
+
+    def name(self, top_level=False):
+        """Parse a <name>.  Returns (name, cv_quals, is_template), where
+        cv_quals is the member function qualifier text (e.g. ' const')."""
+        c = self.peek()
+        if c == 'N':
+            return self.nested_name(top_level)
+        if c == 'Z':
+            return self.local_name(top_level)
+
+        if c == 'S' and self.peek(2) != 'St':
+            # A substitution naming a template, followed by its arguments.
+            name = self.substitution()
+            if self.peek() != 'I':
+                raise DemangleError('bare substitution used as a name')
+            args = self.template_arg_list(top_level)
+            self.subs.append(name)
+            return (_Name(name.render() + _join_template_args(args), args),
+                    '', True)
+
+        prefix = ''
+        if self.consume('St'):
+            prefix = 'std::'
+        name = self.unqualified_name(None)
+        name.text = prefix + name.text
+        if self.peek() == 'I':
+            self.subs.append(_Name(name.text))
+            args = self.template_arg_list(top_level)
+            template = _Name(name.text + self.template_suffix(name.text, args),
+                             args)
+            template.no_return_type = getattr(name, 'no_return_type', False)
+            return template, '', True
+        return name, '', False
+
+    @staticmethod
+    def template_suffix(name, args):
+        # Avoid e.g. 'operator<<int>'.
+        if name.endswith('<'):
+            return ' ' + _join_template_args(args)
+        return _join_template_args(args)
+
+    def cv_qualifiers(self):
+        quals = ''
+        if self.consume('r'):
+            quals = ' restrict' + quals
+        if self.consume('V'):
+            quals = ' volatile' + quals
+        if self.consume('K'):
+            quals = ' const' + quals
+        return quals
+
+    def nested_name(self, top_level):
+        self.expect('N')
+        cv_quals = self.cv_qualifiers()
+        if self.consume('R'):
+            cv_quals += ' &'
+        elif self.consume('O'):
+            cv_quals += ' &&'
+
+        text = None
+        last = None
+        is_template = False
+        no_return_type = False
+        while True:
+            c = self.peek()
+            if c == 'E':
+                self.pos += 1
+                break
+            if c == '':
+                raise DemangleError('unterminated nested name')
+
+            if c == 'S' and self.peek(2) != 'St':
+                component = self.substitution()
+                text = component.render()
+                last = component
+                is_template = False
+                # A substitution is already in the table; don't add it again.
+                continue
+            elif text is None and self.consume('St'):
+                text = 'std'
+                continue
+            elif c == 'I':
+                if text is None:
+                    raise DemangleError('template args without a template')
+                args = self.template_arg_list(top_level)
+                text += self.template_suffix(text, args)
+                is_template = True
+            elif c == 'T':
+                text = self.template_arg_at(self.template_param()).render()
+                is_template = False
+            elif c == 'D' and self.peek(2) in ('Dt', 'DT'):
+                raise DemangleError('decltype in nested name')
+            else:
+                component = self.unqualified_name(last)
+                no_return_type = getattr(component, 'no_return_type', False)
+                text = component.text if text is None else \
+                    text + '::' + component.text
+                last = component
+                is_template = False
+
+            if self.peek() != 'E':
+                self.subs.append(_Name(text))
+
+        name = _Name(text)
+        name.no_return_type = no_return_type
+        return name, cv_quals, is_template
+
+    def local_name(self, top_level):
+        """Parse a <local-name>.  Returns the same as name()."""
+        self.expect('Z')
+        saved_args = self.template_args
+        function = self.encoding(with_return_type=False)
+        self.template_args = saved_args
+        self.expect('E')
+        if self.consume('s'):
+            self.discriminator()
+            return _Name(function + '::string literal'), '', False
+        if self.consume('d'):
+            # A default argument; _ is the last parameter's, 0_ the one
+            # before it, and so on.
+            index = 1
+            if self.peek() != '_':
+                index = self.number() + 2
+            self.expect('_')
+            function += '::{default arg#%d}' % index
+        (entity, cv_quals, is_template) = self.name(top_level)
+        if self.peek() == '_':
+            self.discriminator()
+        name = _Name(function + '::' + entity.render())
+        name.no_return_type = getattr(entity, 'no_return_type', False)
+        return name, cv_quals, is_template
+
+    def unqualified_name(self, enclosing):
+        """Parse an <unqualified-name>.  enclosing is the previous component
+        of the nested name we're in, which names constructors and
+        destructors."""
+        self.consume('L')  # Internal linkage, e.g. static functions.
+        c = self.peek()
+        if c.isdigit():
+            name = _Name(self.source_name())
+        elif c == 'C':
+            self.pos += 1
+            inheriting = self.consume('I')
+            self.next()
+            if inheriting:
+                self.type()
+            name = _Name(self.ctor_dtor_base(enclosing))
+            name.no_return_type = True
+        elif c == 'D' and self.peek(2) in ('D0', 'D1', 'D2', 'D4', 'D5'):
+            self.pos += 2
+            name = _Name('~' + self.ctor_dtor_base(enclosing))
+            name.no_return_type = True
+        elif c == 'U':
+            name = _Name(self.unnamed_type_name())
+        elif c.islower():
+            name = self.operator_name()
+        else:
+            raise DemangleError('unknown unqualified name at %d' % self.pos)
+
+        while self.consume('B'):
+            name.text += '[abi:%s]' % self.source_name()
+        return name
+
+    def ctor_dtor_base(self, enclosing):
+        """Get the name of the class whose constructor or destructor we're
+        parsing, e.g. 'Foo' for ns::Foo<int>::Foo()."""
+        if enclosing is None:
+            raise DemangleError('constructor outside of a class')
+        text = enclosing.render()
+        if text.endswith('>'):
+            depth = 0
+            for i in range(len(text) - 1, -1, -1):
+                if text[i] == '>':
+                    depth += 1
+                elif text[i] == '<':
+                    depth -= 1
+                    if depth == 0:
+                        text = text[:i]
+                        break
+        text = _ABI_TAGS.sub('', text.rsplit('::', 1)[-1])
+        if text.startswith('{') and self.last_name:
+            # An unnamed type or a closure.
+            return self.last_name
+        return text
+
+    def source_name(self):
+        length = self.number()
+        if length <= 0 or self.pos + length > len(self.s):
+            raise DemangleError('bad source name length')
+        identifier = self.s[self.pos:self.pos + length]
+        self.pos += length
+        self.last_name = identifier
+        if identifier.startswith('_GLOBAL_') and identifier[8:9] in '._$' and \
+           identifier[9:10] == 'N':
+            return '(anonymous namespace)'
+        return identifier
+
+    def unnamed_type_name(self):
+        if self.consume('Ut'):
+            return '{unnamed type#%d}' % self.unnamed_type_index()
+        self.expect('Ul')
+        params = self.bare_function_type()
+        self.expect('E')
+        return '{lambda(%s)#%d}' % (params, self.unnamed_type_index())
+
+    def unnamed_type_index(self):
+        # Unlike a <seq-id>, the number here is decimal.
+        index = 1
+        if self.peek().isdigit():
+            index = self.number() + 2
+        self.expect('_')
+        return index
+
+    def operator_name(self):
+        if self.consume('cv'):
+            target = self.type()
+            name = _Name('operator ' + target.render())
+            name.no_return_type = True
+            return name
+        if self.consume('li'):
+            return _Name('operator"" ' + self.source_name())
+        if self.consume('v'):
+            self.next()
+            return _Name('operator ' + self.source_name())
+        code = self.peek(2)
+        if code not in _OPERATORS:
+            raise DemangleError('unknown operator %r' % code)
+        self.pos += 2
+        op = _OPERATORS[code]
+        if op[0].isalpha():
+            return _Name('operator ' + op)
+        return _Name('operator' + op)
+
+    # Substitutions and template parameters.
+
+    def substitution(self):
+        self.expect('S')
+        c = self.peek()
+        if c in _STD_SUBSTITUTIONS and c != 't':
+            self.pos += 1
+            return _Name(_STD_SUBSTITUTIONS[c])
+        index = self.seq_id()
+        if index >= len(self.subs):
+            raise DemangleError('bad substitution S%d' % index)
+        sub = self.subs[index]
+        if isinstance(sub, int):
+            # A template parameter.  Like c++filt, we look it up in the
+            # template we're in now, not the one we were in when we saw it.
+            return self.template_arg_at(sub)
+        return sub
+
+    def template_param(self):
+        """Parse a <template-param>.  Returns its index."""
+        self.expect('T')
+        return self.seq_id()
+
+    def template_arg_at(self, index):
+        if index >= len(self.template_args):
+            raise DemangleError('bad template parameter T%d' % index)
+        arg = self.template_args[index]
+        if isinstance(arg, _Pack):
+            if self.pack_index is not None:
+                if self.pack_index >= len(arg.elements):
+                    raise DemangleError('packs of different lengths')
+                return arg.elements[self.pack_index]
+            if self.found_pack is None:
+                self.found_pack = arg
+        return arg
+
+    def template_arg_list(self, top_level=False):
+        """Parse <template-args> and return a list of their texts.  If
+        top_level, these args are what T_ etc. refer to from now on."""
+        self.expect('I')
+        args = []
+        nodes = []
+        last_name = self.last_name
+        while not self.consume('E'):
+            node = self.template_arg()
+            nodes.append(node)
+            args.append(node.render())
+        self.last_name = last_name
+        if top_level:
+            self.template_args = nodes
+        return args
+
+    def template_arg(self):
+        c = self.peek()
+        if c == 'L':
+            return _Name(self.expr_primary())
+        if c == 'J':
+            self.pos += 1
+            pack = []
+            while not self.consume('E'):
+                pack.append(self.template_arg())
+            return _Pack(pack)
+        if c == 'X':
+            self.pos += 1
+            text = self.expression()
+            self.expect('E')
+            return _Name(text)
+        return self.type()
+
+    def expression(self):
+        """Parse the few kinds of <expression> which show up in the template
+        arguments of library code, e.g. the std::__is_scalar<int>::__value of
+        std::__enable_if<std::__is_scalar<int>::__value, void>."""
+        c = self.peek()
+        if c == 'L':
+            return self.expr_primary()
+        if c == 'T':
+            return self.template_arg_at(self.template_param()).render()
+        if self.consume('sp'):
+            # A pack expansion, e.g. the Is... of std::_Index_tuple<Is...>;
+            # a pack renders as its elements, joined with ', '.
+            return self.expression()
+        if self.consume('sr'):
+            # <unresolved-type> <base-unresolved-name>, the old way gcc
+            # mangles a dependent name like T::value.
+            if self.peek() == 'N':
+                raise DemangleError('unsupported scope resolution at %d' %
+                                    self.pos)
+            scope = self.type().render()
+            name = self.source_name()
+            if self.peek() == 'I':
+                name += _join_template_args(self.template_arg_list())
+            return scope + '::' + name
+        raise DemangleError('unsupported expression at %d' % self.pos)
+
+    def expr_primary(self):
+        self.expect('L')
+        if self.consume('_Z'):
+            saved_args = self.template_args
+            text = self.encoding()
+            self.template_args = saved_args
+            self.expect('E')
+            return text
+        type_code = self.peek()
+        if type_code == 'b' and self.peek(3) in ('b0E', 'b1E'):
+            self.pos += 3
+            return 'true' if self.s[self.pos - 2] == '1' else 'false'
+        if type_code in _LITERAL_SUFFIXES:
+            self.pos += 1
+            value = self.number()
+            self.expect('E')
+            return '%d%s' % (value, _LITERAL_SUFFIXES[type_code])
+        literal_type = self.type()
+        start = self.pos
+        while self.peek() not in ('E', ''):
+            self.pos += 1
+        value = self.s[start:self.pos].replace('n', '-', 1)
+        self.expect('E')
+        return '(%s)%s' % (literal_type.render(), value)
+
+    # Types.
+
+    def type(self):
+        c = self.peek()
+        if c in _BUILTIN_TYPES:
+            self.pos += 1
+            return _Name(_BUILTIN_TYPES[c])
+        if c == 'D' and self.peek(2)[1:] in _D_BUILTIN_TYPES:
+            self.pos += 2
+            return _Name(_D_BUILTIN_TYPES[self.s[self.pos - 1]])
+
+        if c in ('r', 'V', 'K'):
+            quals = self.cv_qualifiers()
+            if self.peek() == 'F':
+                # A member function's cv-qualifiers; the unqualified function
+                # type isn't a substitution candidate.
+                result = _Qualified(self.function_type(), quals)
+            else:
+                result = _Qualified(self.type(), quals)
+        elif c in ('P', 'R', 'O'):
+            self.pos += 1
+            op = {'P': '*', 'R': '&', 'O': '&&'}[c]
+            result = _Pointer(self.type(), op)
+        elif c == 'F':
+            result = self.function_type()
+        elif c == 'A':
+            self.pos += 1
+            dim = ''
+            if self.peek() != '_':
+                dim = str(self.number())
+            self.expect('_')
+            result = _Array(self.type(), dim)
+        elif c == 'M':
+            self.pos += 1
+            cls = self.type()
+            result = _PointerToMember(cls, self.type())
+        elif c == 'T' and self.peek(2) not in ('Ts', 'Tu', 'Te'):
+            index = self.template_param()
+            result = self.template_arg_at(index)
+            self.subs.append(index)
+            if self.peek() != 'I':
+                return result
+            args = self.template_arg_list()
+            result = _Name(result.render() + _join_template_args(args))
+        elif c == 'S' and self.peek(2) != 'St':
+            result = self.substitution()
+            if self.peek() != 'I':
+                # Substitutions aren't added to the table again.
+                return result
+            args = self.template_arg_list()
+            result = _Name(result.render() + _join_template_args(args))
+        elif c == 'D' and self.peek(2) == 'Dp':
+            self.pos += 2
+            result = self.pack_expansion()
+        elif c == 'u':
+            self.pos += 1
+            result = _Name(self.source_name())
+        elif c.isdigit() or c in ('N', 'Z', 'S', 'T'):
+            if c == 'T':
+                self.pos += 2  # Elaborated type specifier; we print it bare.
+            result = self.name()[0]
+        else:
+            raise DemangleError('unknown type at %d' % self.pos)
+
+        self.subs.append(result)
+        return result
+
+    def pack_expansion(self):
+        """Parse the pattern of a pack expansion, after its 'Dp'.
+
+        Like c++filt, we print the pattern once for each element of the first
+        pack it refers to, with that element in place of the pack, wherever
+        in the pattern the pack is: e.g. DpRT_ with T_ = <int, char> is
+        'int&, char&', and DpN1AIT_E1bE is 'A<int>::b, A<char>::b'.  We build
+        text as we parse, so we do that by parsing the pattern again for each
+        element.
+
+        """
+        start = self.pos
+        num_subs = len(self.subs)
+        (outer_found_pack, self.found_pack) = (self.found_pack, None)
+        pattern = self.type()
+        pack = self.found_pack
+        self.found_pack = outer_found_pack
+        if pack is None:
+            return _Name(pattern.render() + '...')
+        if self.pack_index is not None:
+            # A pack expansion within a pack expansion's pattern; the outer
+            # one is already printing the pattern once per element.
+            return pattern
+
+        # The pattern's substitutions go into the table only once.
+        (end, subs) = (self.pos, self.subs)
+        elements = []
+        for i in range(len(pack.elements)):
+            self.pos = start
+            self.subs = subs[:num_subs]
+            self.pack_index = i
+            try:
+                elements.append(self.type())
+            finally:
+                self.pack_index = None
+        (self.pos, self.subs) = (end, subs)
+        return _Pack(elements)
+
+    def function_type(self):
+        self.expect('F')
+        self.consume('Y')
+        ret = self.type()
+        params = []
+        while self.peek() != 'E' and self.peek(2) not in ('RE', 'OE'):
+            params.append(self.type())
+        ref_qual = ''
+        if self.consume('R'):
+            ref_qual = ' &'
+        elif self.consume('O'):
+            ref_qual = ' &&'
+        self.expect('E')
+        return _Function(ret, self.params_text(params), ref_qual)
+
+
+def demangle_or_raise(mangled):
+    """Demangle mangled, raising DemangleError if we can't."""
+    if not mangled.startswith('_Z'):
+        raise DemangleError('%s is not a mangled C++ name' % mangled)
+    d = _Demangler(mangled)
+    d.pos = 2
+    text = d.encoding()
+
+    # gcc adds suffixes such as .constprop.0 or .isra.1 to clones of
+    # functions.
+    while d.pos < len(d.s):
+        match = _CLONE_SUFFIX.match(d.s, d.pos)
+        if not match:
+            raise DemangleError('trailing garbage in %s' % mangled)
+        text += ' [clone %s]' % match.group(0)
+        d.pos = match.end()
+    return text
+
+
+# demangle() remembers the text for this many of the symbols it has
+# demangled most recently.  fix_b2g_stack's daemon lives for a long time, so
+# the memo mustn't grow without bound.
+_CACHE_SIZE = 64 * 1024
+
+# mangled --> demangled text, least recently used first.
+_cache = OrderedDict()
+
+
+def demangle(mangled):
+    """Demangle the given symbol name, memoizing the result.
+
+    Returns mangled unchanged if it isn't a mangled C++ name or uses a
+    construct we don't understand.
+
+    """
+    text = _cache.pop(mangled, None)
+    if text is None:
+        try:
+            text = demangle_or_raise(mangled)
+        except (DemangleError, AttributeError, IndexError, ValueError,
+                RuntimeError):
+            text = mangled
+        while len(_cache) >= _CACHE_SIZE:
+            _cache.popitem(last=False)
+    _cache[mangled] = text
+    return text
+
+
+_MANGLED_WORD = re.compile(r'(?<![\w$.])_Z[\w$.]+')
+
+
+def demangle_text(text):
+    """Demangle every mangled name in text, like c++filt does to its input."""
+    return _MANGLED_WORD.sub(lambda m: demangle(m.group(0)), text)
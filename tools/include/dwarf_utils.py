@@ -0,0 +1,945 @@
+"""An in-process replacement for |addr2line -Cfe LIB|.
+
+DwarfSymbolizer reads a library's .debug_line program, the functions and
+inlined subroutines in its .debug_info, and its symbol table once, flattens
+them into sorted address tables, and then answers lookups with a binary
+search.  Compared to talking to a long-lived addr2line process, this saves us
+a pipe round trip for every frame we symbolize.
+
+Like addr2line, in inlined code we name the innermost inlined function, so
+the name goes with the file and line the line table gives.
+
+Parsing a big library's line program in Python takes a while (tens of
+seconds for libxul), so DwarfSymbolizer can save the tables it builds in a
+directory, keyed on the library's build-id, and load them from there next
+time, in this process or any other.
+
+We understand DWARF versions 2 through 4, which is what the B2G toolchains
+emit.  For a library with line programs in any other version (e.g. the
+DWARF 5 which newer compilers emit by default), DwarfSymbolizer raises
+DwarfError, so the caller falls back to addr2line.
+
+"""
+
+from __future__ import print_function
+
+import os
+import errno
+import struct
+import tempfile
+import cPickle as pickle
+from array import array
+from bisect import bisect_right
+
+from . import demangle
+from . import elf_utils
+
+DW_TAG_inlined_subroutine = 0x1d
+DW_TAG_subprogram = 0x2e
+
+DW_AT_name = 0x03
+DW_AT_stmt_list = 0x10
+DW_AT_low_pc = 0x11
+DW_AT_high_pc = 0x12
+DW_AT_language = 0x13
+DW_AT_comp_dir = 0x1b
+DW_AT_abstract_origin = 0x31
+DW_AT_specification = 0x47
+DW_AT_ranges = 0x55
+DW_AT_linkage_name = 0x6e
+DW_AT_MIPS_linkage_name = 0x2007
+
+DW_FORM_addr = 0x01
+DW_FORM_ref_addr = 0x10
+
+DW_LNS_copy = 1
+DW_LNS_advance_pc = 2
+DW_LNS_advance_line = 3
+DW_LNS_set_file = 4
+DW_LNS_set_column = 5
+DW_LNS_negate_stmt = 6
+DW_LNS_set_basic_block = 7
+DW_LNS_const_add_pc = 8
+DW_LNS_fixed_advance_pc = 9
+
+DW_LNE_end_sequence = 1
+DW_LNE_set_address = 2
+DW_LNE_define_file = 3
+
+
+class DwarfError(Exception):
+    """Raised when a library has no debug info we can use."""
+    pass
+
+
+def read_uleb128(data, offset):
+    """Decode an unsigned LEB128 at data[offset].  Returns (value, new_offset)."""
+    result = 0
+    shift = 0
+    while True:
+        byte = ord(data[offset])
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, offset
+        shift += 7
+
+
+def read_sleb128(data, offset):
+    """Decode a signed LEB128 at data[offset].  Returns (value, new_offset)."""
+    result = 0
+    shift = 0
+    while True:
+        byte = ord(data[offset])
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            if byte & 0x40:
+                result -= 1 << shift
+            return result, offset
+
+
+def read_cstring(data, offset):
+    """Read a NUL-terminated string at data[offset].  Returns (str, new_offset)."""
+    end = data.index('\0', offset)
+    return data[offset:end], end + 1
+
+
+def read_initial_length(data, offset, endian):
+    """Read a DWARF unit length, which tells us whether the unit uses the
+    32-bit or the 64-bit DWARF format.
+
+    Returns (unit_length, offset_size, new_offset).
+
+    """
+    (length,) = struct.unpack_from(endian + 'I', data, offset)
+    if length == 0xffffffff:
+        (length,) = struct.unpack_from(endian + 'Q', data, offset + 4)
+        return length, 8, offset + 12
+    return length, 4, offset + 4
+
+
+def _comp_dirs_by_stmt_list(elf):
+    """Map each line program offset in .debug_line to the DW_AT_comp_dir of the
+    compilation unit which refers to it.
+
+    Line programs name their files relative to the compilation directory, which
+    is only recorded in .debug_info, so we parse just enough of each unit's
+    first DIE to find it.
+
+    """
+    info = elf.section_data('.debug_info')
+    abbrev = elf.section_data('.debug_abbrev')
+    strs = elf.section_data('.debug_str') or ''
+    if not info or not abbrev:
+        return {}
+
+    endian = elf.endian
+    comp_dirs = {}
+    offset = 0
+    while offset < len(info):
+        (unit_length, offset_size, die_offset) = \
+            read_initial_length(info, offset, endian)
+        next_unit = die_offset + unit_length
+        (version,) = struct.unpack_from(endian + 'H', info, die_offset)
+        if 2 <= version <= 4:
+            try:
+                attrs = _read_unit_die_attrs(info, abbrev, strs, die_offset + 2,
+                                             version, offset_size, endian)
+                if DW_AT_stmt_list in attrs:
+                    comp_dirs[attrs[DW_AT_stmt_list]] = attrs.get(DW_AT_comp_dir, '')
+            except (struct.error, IndexError, ValueError, DwarfError):
+                pass
+        offset = next_unit
+    return comp_dirs
+
+
+def _read_abbrev(abbrev, offset, code):
+    """Find abbreviation |code| in the table at abbrev[offset].  Returns a list
+    of (attribute, form) pairs."""
+    while True:
+        (entry_code, offset) = read_uleb128(abbrev, offset)
+        if entry_code == 0:
+            raise DwarfError('Abbreviation %d not found' % code)
+        (_, offset) = read_uleb128(abbrev, offset)  # tag
+        offset += 1  # has_children
+        specs = []
+        while True:
+            (attr, offset) = read_uleb128(abbrev, offset)
+            (form, offset) = read_uleb128(abbrev, offset)
+            if attr == 0 and form == 0:
+                break
+            specs.append((attr, form))
+        if entry_code == code:
+            return specs
+
+
+def _read_abbrev_table(abbrev, offset):
+    """Read the whole abbreviation table at abbrev[offset].  Returns a dict
+    mapping each code to (tag, has_children, [(attribute, form), ...])."""
+    table = {}
+    while True:
+        (code, offset) = read_uleb128(abbrev, offset)
+        if code == 0:
+            return table
+        (tag, offset) = read_uleb128(abbrev, offset)
+        has_children = abbrev[offset] != '\0'
+        offset += 1
+        specs = []
+        while True:
+            (attr, offset) = read_uleb128(abbrev, offset)
+            (form, offset) = read_uleb128(abbrev, offset)
+            if attr == 0 and form == 0:
+                break
+            specs.append((attr, form))
+        table[code] = (tag, has_children, specs)
+
+
+def _skip_program(specs, version, address_size, offset_size):
+    """Get a list of steps for skipping over the attributes |specs| of a DIE
+    without decoding them: runs of fixed-size attributes collapse into their
+    total size, and variable-size ones are left as their DW_FORM codes."""
+    fixed_sizes = {
+        0x01: address_size, 0x0b: 1, 0x0c: 1, 0x11: 1, 0x05: 2, 0x12: 2,
+        0x06: 4, 0x13: 4, 0x07: 8, 0x14: 8, 0x20: 8, 0x0e: offset_size,
+        0x17: offset_size, 0x19: 0,
+        0x10: address_size if version == 2 else offset_size,
+    }
+    steps = []
+    for (_, form) in specs:
+        size = fixed_sizes.get(form)
+        if size is None:
+            steps.append(-form)
+        elif steps and steps[-1] >= 0:
+            steps[-1] += size
+        else:
+            steps.append(size)
+    return steps
+
+
+def _skip_attrs(data, offset, steps):
+    """Skip over a DIE's attributes, following steps from _skip_program.
+    Returns the offset after them."""
+    for step in steps:
+        if step >= 0:
+            offset += step
+        elif step == -0x08:  # string
+            offset = data.index('\0', offset) + 1
+        elif step in (-0x0f, -0x15, -0x0d):  # udata, ref_udata, sdata
+            while ord(data[offset]) & 0x80:
+                offset += 1
+            offset += 1
+        elif step in (-0x09, -0x18):  # block, exprloc
+            (length, offset) = read_uleb128(data, offset)
+            offset += length
+        elif step == -0x0a:  # block1
+            offset += 1 + ord(data[offset])
+        else:
+            raise DwarfError('Cannot skip DW_FORM 0x%x' % -step)
+    return offset
+
+
+def _read_unit_die_attrs(info, abbrev, strs, offset, version, offset_size, endian):
+    """Read the attributes of the first DIE in a compilation unit whose header
+    starts (after the length and version fields) at info[offset].
+
+    Returns a dict mapping the integer- and string-valued attributes to their
+    values.  Other attributes are skipped.
+
+    """
+    off_fmt = endian + ('Q' if offset_size == 8 else 'I')
+    (abbrev_offset,) = struct.unpack_from(off_fmt, info, offset)
+    offset += offset_size
+    address_size = ord(info[offset])
+    offset += 1
+
+    (code, offset) = read_uleb128(info, offset)
+    attrs = {}
+    for (attr, form) in _read_abbrev(abbrev, abbrev_offset, code):
+        (value, offset) = _read_form(info, strs, offset, form, version,
+                                     address_size, offset_size, endian)
+        attrs[attr] = value
+    return attrs
+
+
+def _read_form(data, strs, offset, form, version, address_size, offset_size,
+               endian):
+    """Read an attribute value of the given form.  Returns (value, new_offset);
+    value is None for forms we skip over without interpreting."""
+    def unpack(fmt, size):
+        return struct.unpack_from(endian + fmt, data, offset)[0], offset + size
+
+    def address_fmt(size):
+        return {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}[size]
+
+    if form == 0x01:  # DW_FORM_addr
+        return unpack(address_fmt(address_size), address_size)
+    if form in (0x0b, 0x0c, 0x11):  # data1, flag, ref1
+        return ord(data[offset]), offset + 1
+    if form in (0x05, 0x12):  # data2, ref2
+        return unpack('H', 2)
+    if form in (0x06, 0x13):  # data4, ref4
+        return unpack('I', 4)
+    if form in (0x07, 0x14, 0x20):  # data8, ref8, ref_sig8
+        return unpack('Q', 8)
+    if form == 0x08:  # string
+        return read_cstring(data, offset)
+    if form == 0x0e:  # strp
+        (str_offset, offset) = unpack(address_fmt(offset_size), offset_size)
+        return read_cstring(strs, str_offset)[0], offset
+    if form == 0x17:  # sec_offset
+        return unpack(address_fmt(offset_size), offset_size)
+    if form == 0x10:  # ref_addr
+        size = address_size if version == 2 else offset_size
+        return unpack(address_fmt(size), size)
+    if form in (0x0f, 0x15):  # udata, ref_udata
+        return read_uleb128(data, offset)
+    if form == 0x0d:  # sdata
+        return read_sleb128(data, offset)
+    if form == 0x19:  # flag_present
+        return True, offset
+    if form in (0x09, 0x18):  # block, exprloc
+        (length, offset) = read_uleb128(data, offset)
+        return None, offset + length
+    if form == 0x0a:  # block1
+        return None, offset + 1 + ord(data[offset])
+    if form == 0x03:  # block2
+        (length, offset) = unpack('H', 2)
+        return None, offset + length
+    if form == 0x04:  # block4
+        (length, offset) = unpack('I', 4)
+        return None, offset + length
+    if form == 0x16:  # indirect
+        (form, offset) = read_uleb128(data, offset)
+        return _read_form(data, strs, offset, form, version, address_size,
+                          offset_size, endian)
+    raise DwarfError('Unknown DW_FORM 0x%x' % form)
+
+
+class LineTable(object):
+    """A flattened view of every line program in a .debug_line section.
+
+    Row i maps the addresses [starts[i], starts[i + 1]) to the source location
+    (file_names[files[i]], lines[i]).  A file index of -1 marks the end of a
+    sequence, i.e. a gap with no line info.
+
+    Pass elf=None to get an empty table, e.g. to fill in from a saved one.
+
+    """
+    def __init__(self, elf):
+        self.file_names = []
+        self.starts = array('L')
+        self.files = array('l')
+        self.lines = array('l')
+        if elf is None:
+            return
+
+        data = elf.section_data('.debug_line')
+        if not data:
+            raise DwarfError('%s has no .debug_line section' % elf.path)
+
+        self._file_name_ids = {}
+        comp_dirs = _comp_dirs_by_stmt_list(elf)
+
+        sequences = []
+        offset = 0
+        while offset < len(data):
+            offset = self._read_program(data, offset, elf.endian,
+                                        elf.address_size, comp_dirs, sequences)
+
+        # Sequences from different compilation units aren't necessarily in
+        # address order, so sort them before flattening.
+        sequences.sort(key=lambda seq: seq[0][0])
+        for seq in sequences:
+            for (address, file_id, line) in seq:
+                self.starts.append(address)
+                self.files.append(file_id)
+                self.lines.append(line)
+
+    def _intern_file_name(self, name):
+        file_id = self._file_name_ids.get(name)
+        if file_id is None:
+            file_id = len(self.file_names)
+            self.file_names.append(name)
+            self._file_name_ids[name] = file_id
+        return file_id
+
+    def _read_program(self, data, offset, endian, address_size, comp_dirs,
+                      sequences):
+        """Run the line program starting at data[offset], appending its
+        sequences to |sequences|.  Returns the offset of the next program."""
+        program_offset = offset
+        (unit_length, offset_size, offset) = \
+            read_initial_length(data, offset, endian)
+        end = offset + unit_length
+        (version,) = struct.unpack_from(endian + 'H', data, offset)
+        if not 2 <= version <= 4:
+            raise DwarfError('Unsupported line program version %d' % version)
+        offset += 2
+        (header_length,) = struct.unpack_from(
+            endian + ('Q' if offset_size == 8 else 'I'), data, offset)
+        offset += offset_size
+        program_start = offset + header_length
+
+        min_inst_length = ord(data[offset])
+        offset += 1
+        if version >= 4:
+            offset += 1  # maximum_operations_per_instruction; VLIW only.
+        default_is_stmt = ord(data[offset])
+        line_base = struct.unpack_from('b', data, offset + 1)[0]
+        line_range = ord(data[offset + 2])
+        opcode_base = ord(data[offset + 3])
+        offset += 4
+        opcode_lengths = [0] + [ord(c) for c in data[offset:offset + opcode_base - 1]]
+        offset += opcode_base - 1
+
+        comp_dir = comp_dirs.get(program_offset, '')
+        include_dirs = [comp_dir]
+        while data[offset] != '\0':
+            (include_dir, offset) = read_cstring(data, offset)
+            include_dirs.append(os.path.join(comp_dir, include_dir))
+        offset += 1
+
+        file_ids = [None]
+
+        def add_file(name, dir_index):
+            if dir_index < len(include_dirs):
+                name = os.path.join(include_dirs[dir_index], name)
+            file_ids.append(self._intern_file_name(name))
+
+        while data[offset] != '\0':
+            (name, offset) = read_cstring(data, offset)
+            (dir_index, offset) = read_uleb128(data, offset)
+            (_, offset) = read_uleb128(data, offset)  # mtime
+            (_, offset) = read_uleb128(data, offset)  # length
+            add_file(name, dir_index)
+
+        address_fmt = endian + ('Q' if address_size == 8 else 'I')
+        const_add_pc = ((255 - opcode_base) // line_range) * min_inst_length
+
+        def reset():
+            return 0, 1, 1, default_is_stmt
+
+        (address, file_index, line, is_stmt) = reset()
+        rows = []
+        offset = program_start
+        while offset < end:
+            opcode = ord(data[offset])
+            offset += 1
+            if opcode >= opcode_base:
+                adjusted = opcode - opcode_base
+                address += (adjusted // line_range) * min_inst_length
+                line += line_base + adjusted % line_range
+                rows.append((address, file_index, line))
+            elif opcode == 0:
+                (length, offset) = read_uleb128(data, offset)
+                sub_opcode = ord(data[offset])
+                if sub_opcode == DW_LNE_end_sequence:
+                    rows.append((address, None, 0))
+                    self._add_sequence(rows, file_ids, sequences)
+                    rows = []
+                    (address, file_index, line, is_stmt) = reset()
+                elif sub_opcode == DW_LNE_set_address:
+                    (address,) = struct.unpack_from(address_fmt, data, offset + 1)
+                elif sub_opcode == DW_LNE_define_file:
+                    (name, o) = read_cstring(data, offset + 1)
+                    (dir_index, o) = read_uleb128(data, o)
+                    add_file(name, dir_index)
+                offset += length
+            elif opcode == DW_LNS_copy:
+                rows.append((address, file_index, line))
+            elif opcode == DW_LNS_advance_pc:
+                (delta, offset) = read_uleb128(data, offset)
+                address += delta * min_inst_length
+            elif opcode == DW_LNS_advance_line:
+                (delta, offset) = read_sleb128(data, offset)
+                line += delta
+            elif opcode == DW_LNS_set_file:
+                (file_index, offset) = read_uleb128(data, offset)
+            elif opcode == DW_LNS_negate_stmt:
+                is_stmt = not is_stmt
+            elif opcode == DW_LNS_const_add_pc:
+                address += const_add_pc
+            elif opcode == DW_LNS_fixed_advance_pc:
+                address += struct.unpack_from(endian + 'H', data, offset)[0]
+                offset += 2
+            else:
+                # DW_LNS_set_column, set_basic_block, set_prologue_end, etc.,
+                # none of which affect the (address, file, line) mapping.
+                for _ in range(opcode_lengths[opcode]):
+                    (_, offset) = read_uleb128(data, offset)
+        return end
+
+    @staticmethod
+    def _add_sequence(rows, file_ids, sequences):
+        # The linker points sequences for discarded functions at address 0;
+        # those would shadow the real code at low addresses.
+        if len(rows) < 2 or rows[0][0] == 0:
+            return
+        seq = []
+        for (address, file_index, line) in rows:
+            if file_index is None or file_index >= len(file_ids):
+                file_id = -1
+            else:
+                file_id = file_ids[file_index]
+            seq.append((address, file_id, line))
+        sequences.append(seq)
+
+    def lookup(self, address):
+        """Get the (file_name, line) containing |address|, or None."""
+        i = bisect_right(self.starts, address) - 1
+        if i < 0 or self.files[i] < 0:
+            return None
+        return self.file_names[self.files[i]], self.lines[i]
+
+
+class FunctionTable(object):
+    """A flattened view of the functions in a .debug_info section, including
+    the copies of functions which the compiler inlined into others.
+
+    Row i maps the addresses [starts[i], starts[i + 1]) to the innermost
+    function containing them, names[name_ids[i]].  A name id of -1 marks
+    addresses which no function we know about contains.
+
+    We name functions the way addr2line does: by their linkage (i.e.
+    mangled) name if the debug info has one.  Otherwise, if |symbols| (a
+    list like ElfFile.function_symbols returns) has a symbol at the start of
+    the function, we use the symbol's name, and failing that, the function's
+    plain DW_AT_name.  In C, the plain name is the linkage name.
+
+    Pass elf=None to get an empty table, e.g. to fill in from a saved one.
+
+    """
+    # The DW_LANG_* values of the languages whose names aren't mangled; see
+    # non_mangled() in binutils' dwarf2.c.
+    UNMANGLED_LANGUAGES = frozenset([
+        0x1, 0x2, 0x3, 0x5, 0x6, 0x7, 0x9, 0xc, 0xd, 0xf, 0x12, 0x1d, 0x8001])
+
+    def __init__(self, elf, symbols=()):
+        self.names = []
+        self.starts = array('L')
+        self.name_ids = array('l')
+        if elf is None:
+            return
+
+        info = elf.section_data('.debug_info')
+        abbrev = elf.section_data('.debug_abbrev')
+        if not info or not abbrev:
+            return
+        strs = elf.section_data('.debug_str') or ''
+        ranges = elf.section_data('.debug_ranges') or ''
+
+        # DIE offset --> (DW_AT_name, linkage name, offset of the DIE named by
+        # DW_AT_abstract_origin or DW_AT_specification), for the DIEs of
+        # functions and inlined functions.
+        self._dies = {}
+        abbrev_tables = {}
+        # (low, high, DIE offset) for each address range of each function.
+        function_ranges = []
+
+        endian = elf.endian
+        offset = 0
+        while offset < len(info):
+            (unit_length, offset_size, header_offset) = \
+                read_initial_length(info, offset, endian)
+            next_unit = header_offset + unit_length
+            try:
+                self._read_unit(info, abbrev, strs, ranges, offset,
+                                header_offset, next_unit, offset_size, endian,
+                                abbrev_tables, function_ranges)
+            except (struct.error, IndexError, KeyError, ValueError,
+                    DwarfError):
+                # Skip units we can't parse, e.g. DWARF 5 ones; the symbol
+                # table names the functions in them.
+                pass
+            offset = next_unit
+
+        symbol_names = {}
+        for symbol in symbols:
+            symbol_names.setdefault(symbol[0], symbol[2])
+        # DIE offset --> (name, lowest address)
+        functions = {}
+        for (low, _, die_offset) in function_ranges:
+            if die_offset in functions:
+                functions[die_offset][1] = min(low, functions[die_offset][1])
+            else:
+                functions[die_offset] = [None, low]
+        for (die_offset, function) in functions.iteritems():
+            (name, is_linkage_name) = self._name_of(die_offset)
+            if not is_linkage_name:
+                name = symbol_names.get(function[1], name)
+            function[0] = name
+        del self._dies
+
+        self._build([(low, high, functions[die_offset][0])
+                     for (low, high, die_offset) in function_ranges])
+
+    def _read_unit(self, info, abbrev, strs, ranges, unit_offset, offset, end,
+                   offset_size, endian, abbrev_tables, function_ranges):
+        """Read the DIEs of the compilation unit whose header starts (after
+        the length field) at info[offset], adding its functions to
+        self._dies and their address ranges to function_ranges."""
+        (version,) = struct.unpack_from(endian + 'H', info, offset)
+        if not 2 <= version <= 4:
+            raise DwarfError('Unsupported .debug_info version %d' % version)
+        offset += 2
+        (abbrev_offset,) = struct.unpack_from(
+            endian + ('Q' if offset_size == 8 else 'I'), info, offset)
+        offset += offset_size
+        address_size = ord(info[offset])
+        offset += 1
+
+        table = abbrev_tables.get(abbrev_offset)
+        if table is None:
+            table = abbrev_tables[abbrev_offset] = \
+                _read_abbrev_table(abbrev, abbrev_offset)
+
+        # code --> _skip_program() for the abbreviation
+        skip_programs = {}
+
+        # The unit's DIE comes first.  Addresses in .debug_ranges are
+        # relative to its low_pc.
+        base_address = None
+        unmangled = False
+        depth = 0
+        while offset < end:
+            die_offset = offset
+            (code, offset) = read_uleb128(info, offset)
+            if code == 0:
+                depth -= 1
+                if depth <= 0:
+                    break
+                continue
+            (tag, has_children, specs) = table[code]
+            if has_children:
+                depth += 1
+            if base_address is not None and \
+               tag not in (DW_TAG_subprogram, DW_TAG_inlined_subroutine):
+                # Most DIEs describe types and variables, which we don't
+                # need, so skip them as quickly as we can.
+                steps = skip_programs.get(code)
+                if steps is None:
+                    steps = skip_programs[code] = _skip_program(
+                        specs, version, address_size, offset_size)
+                offset = _skip_attrs(info, offset, steps)
+                continue
+
+            name = linkage_name = ref = low = high = ranges_offset = None
+            language = None
+            high_is_length = False
+            for (attr, form) in specs:
+                (value, offset) = _read_form(info, strs, offset, form, version,
+                                             address_size, offset_size, endian)
+                if attr == DW_AT_name:
+                    name = value
+                elif attr in (DW_AT_linkage_name, DW_AT_MIPS_linkage_name):
+                    linkage_name = value
+                elif attr in (DW_AT_abstract_origin, DW_AT_specification):
+                    # Most reference forms are relative to the unit.
+                    ref = value if form == DW_FORM_ref_addr \
+                        else unit_offset + value
+                elif attr == DW_AT_low_pc:
+                    low = value
+                elif attr == DW_AT_high_pc:
+                    high = value
+                    high_is_length = form != DW_FORM_addr
+                elif attr == DW_AT_ranges:
+                    ranges_offset = value
+                elif attr == DW_AT_language:
+                    language = value
+
+            if base_address is None:
+                base_address = low or 0
+                unmangled = language in FunctionTable.UNMANGLED_LANGUAGES
+                continue
+            if unmangled and not linkage_name:
+                linkage_name = name
+            self._dies[die_offset] = (name, linkage_name, ref)
+
+            if low is not None and high is not None:
+                if high_is_length:
+                    high += low
+                # As in the line table, the linker points discarded functions
+                # at address 0.
+                if low and high > low:
+                    function_ranges.append((low, high, die_offset))
+            elif ranges_offset is not None:
+                for (low, high) in _read_ranges(ranges, ranges_offset,
+                                                base_address, address_size,
+                                                endian):
+                    function_ranges.append((low, high, die_offset))
+
+    def _name_of(self, die_offset):
+        """Get (name, is_linkage_name) for the function whose DIE is at
+        die_offset, following DW_AT_abstract_origin and DW_AT_specification to
+        the DIEs which say what the function is called."""
+        name = None
+        for _ in range(8):
+            entry = self._dies.get(die_offset)
+            if entry is None:
+                break
+            (plain_name, linkage_name, die_offset) = entry
+            if linkage_name:
+                return linkage_name, True
+            name = name or plain_name
+        return name, False
+
+    def _build(self, ranges):
+        """Fill in our rows from a list of (low, high, name) ranges, giving
+        each address to the innermost range containing it."""
+        name_ids = {None: -1}
+
+        def add_row(address, name_id):
+            if self.starts and self.starts[-1] == address:
+                self.name_ids[-1] = name_id
+            else:
+                self.starts.append(address)
+                self.name_ids.append(name_id)
+
+        # Inlined functions' ranges nest inside their callers', so sorting
+        # outer ranges before the inner ones they contain lets us track the
+        # functions containing the current address with a stack.
+        ranges.sort(key=lambda r: (r[0], -r[1]))
+        stack = []  # (high, name id), innermost last
+        for (low, high, name) in ranges:
+            while stack and stack[-1][0] <= low:
+                end = stack.pop()[0]
+                add_row(end, stack[-1][1] if stack else -1)
+            if stack:
+                high = min(high, stack[-1][0])
+            name_id = name_ids.get(name)
+            if name_id is None:
+                name_id = name_ids[name] = len(self.names)
+                self.names.append(name)
+            stack.append((high, name_id))
+            add_row(low, name_id)
+        while stack:
+            end = stack.pop()[0]
+            add_row(end, stack[-1][1] if stack else -1)
+
+    def lookup(self, address):
+        """Get the name of the innermost function containing |address|, or
+        None."""
+        i = bisect_right(self.starts, address) - 1
+        if i < 0 or self.name_ids[i] < 0:
+            return None
+        return self.names[self.name_ids[i]]
+
+
+def _read_ranges(data, offset, base_address, address_size, endian):
+    """Read the address range list at data[offset] in .debug_ranges.
+    Returns a list of (low, high) pairs."""
+    fmt = endian + ('QQ' if address_size == 8 else 'II')
+    max_address = (1 << (8 * address_size)) - 1
+    result = []
+    while True:
+        (low, high) = struct.unpack_from(fmt, data, offset)
+        offset += 2 * address_size
+        if low == 0 and high == 0:
+            return result
+        if low == max_address:
+            base_address = high
+        elif high > low and base_address + low:
+            result.append((base_address + low, base_address + high))
+
+
+class DwarfSymbolizer(object):
+    """Translates offsets into a library into (function, 'file:line') pairs,
+    the same way |addr2line -Cfe| does.
+
+    The constructor raises ElfError or DwarfError if the library isn't an ELF
+    file or has no line info, in which case the caller should fall back to
+    addr2line.
+
+    If index_dir is given, we look there for the tables an earlier
+    DwarfSymbolizer built for a library with the same build-id, and save the
+    tables we build there if we don't find any.  We keep the
+    MAX_SAVED_INDEXES most recently used ones.
+
+    """
+    # Bump this whenever the format of saved indexes changes.
+    INDEX_FORMAT_VERSION = 1
+
+    MAX_SAVED_INDEXES = 16
+
+    def __init__(self, lib_path, index_dir=None):
+        self._reset_tables()
+        with elf_utils.ElfFile(lib_path) as elf:
+            index_path = self._index_path(elf, index_dir)
+            if index_path and self._load(index_path):
+                return
+            symbols = elf.function_symbols(with_files=True)
+            for section in elf.sections:
+                if section.flags & elf_utils.SHF_ALLOC and section.size:
+                    self._sections.append((section.addr,
+                                           section.addr + section.size))
+            self._sections.sort()
+            try:
+                self._line_table = LineTable(elf)
+                self._function_table = FunctionTable(elf, symbols)
+            except (struct.error, IndexError, ValueError) as e:
+                raise DwarfError('Could not parse %s: %s' % (lib_path, e))
+
+        for (address, _, name, file_name) in symbols:
+            if self._func_starts and self._func_starts[-1] == address:
+                continue
+            self._func_starts.append(address)
+            self._func_names.append(name)
+            self._func_files.append(file_name)
+
+        if index_path:
+            self._save(index_path)
+
+    @staticmethod
+    def _index_path(elf, index_dir):
+        """Get the file in index_dir in which we save elf's tables, or None if
+        we shouldn't save them."""
+        if not index_dir:
+            return None
+        build_id = elf.build_id()
+        if not build_id:
+            return None
+        # Stripped and unstripped copies of a library share a build-id.
+        if not elf.has_symbols():
+            build_id += '-stripped'
+        return os.path.join(index_dir, build_id + '.dwarf')
+
+    def _load(self, index_path):
+        """Fill in our tables from index_path.  Returns False if there's
+        nothing usable there."""
+        try:
+            with open(index_path, 'rb') as f:
+                data = pickle.load(f)
+            if data.get('version') != (DwarfSymbolizer.INDEX_FORMAT_VERSION,
+                                       array('L').itemsize):
+                return False
+            table = self._line_table
+            table.starts.fromstring(data['starts'])
+            table.files.fromstring(data['files'])
+            table.lines.fromstring(data['lines'])
+            table.file_names = data['file_names']
+            functions = self._function_table
+            functions.starts.fromstring(data['inline_starts'])
+            functions.name_ids.fromstring(data['inline_name_ids'])
+            functions.names = data['inline_names']
+            self._func_starts.fromstring(data['func_starts'])
+            self._func_names = data['func_names']
+            self._func_files = data['func_files']
+            self._sections = data['sections']
+            # Mark the index as recently used; see _save.
+            os.utime(index_path, None)
+        except (EOFError, IOError, OSError, AttributeError, KeyError,
+                ValueError, pickle.PickleError):
+            self._reset_tables()
+            return False
+        return True
+
+    def _save(self, index_path):
+        """Save our tables to index_path, and forget all but the
+        MAX_SAVED_INDEXES most recently used indexes in its directory.
+
+        Like LibIndex.save, we write to a temporary file and rename it into
+        place, so that other processes never see a half-written index.
+
+        """
+        index_dir = os.path.dirname(index_path)
+        table = self._line_table
+        functions = self._function_table
+        try:
+            try:
+                os.makedirs(index_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            (fd, tmp_filename) = tempfile.mkstemp(dir=index_dir, prefix='.')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({'version': (DwarfSymbolizer.INDEX_FORMAT_VERSION,
+                                         array('L').itemsize),
+                             'starts': table.starts.tostring(),
+                             'files': table.files.tostring(),
+                             'lines': table.lines.tostring(),
+                             'file_names': table.file_names,
+                             'inline_starts': functions.starts.tostring(),
+                             'inline_name_ids': functions.name_ids.tostring(),
+                             'inline_names': functions.names,
+                             'func_starts': self._func_starts.tostring(),
+                             'func_names': self._func_names,
+                             'func_files': self._func_files,
+                             'sections': self._sections},
+                            f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_filename, index_path)
+
+            indexes = []
+            for name in os.listdir(index_dir):
+                if name.endswith('.dwarf'):
+                    path = os.path.join(index_dir, name)
+                    indexes.append((os.stat(path).st_mtime, path))
+            indexes.sort(reverse=True)
+            for (_, path) in indexes[DwarfSymbolizer.MAX_SAVED_INDEXES:]:
+                os.remove(path)
+        except (IOError, OSError, pickle.PickleError):
+            pass
+
+    def _reset_tables(self):
+        self._line_table = LineTable(None)
+        self._function_table = FunctionTable(None)
+        self._func_starts = array('L')
+        self._func_names = []
+        self._func_files = []
+        # The (start, end) addresses of the sections which get loaded into
+        # memory, in order.
+        self._sections = []
+
+    def _in_section(self, address):
+        """Check whether |address| is in a section which gets loaded into
+        memory.  addr2line knows nothing about addresses which aren't."""
+        i = bisect_right(self._sections, (address, float('inf'))) - 1
+        return i >= 0 and address < self._sections[i][1]
+
+    def _function_at(self, address):
+        """Get (name, file_name) for the function containing |address|.
+        Either may be None.  file_name is set only when the name comes from
+        the symbol table.
+
+        We follow addr2line (i.e. _bfd_dwarf2_find_nearest_line): we take the
+        innermost function containing the address from the debug info, which
+        in inlined code is the inlined function.  If the debug info doesn't
+        describe the address, we take the closest symbol at or below it,
+        ignoring the symbol's size as addr2line does.
+
+        """
+        name = self._function_table.lookup(address)
+        if name:
+            return name, None
+        i = bisect_right(self._func_starts, address) - 1
+        if i < 0:
+            return None, None
+        return self._func_names[i], self._func_files[i]
+
+    def function_at(self, address):
+        """Get the name of the function containing |address|, or None."""
+        return self._function_at(address)[0]
+
+    def lookup(self, address):
+        """Get (func, file_name) for |address|, formatted like addr2line's two
+        output lines, e.g. ('malloc', 'memory/build/replace_malloc.c:152').
+        C++ function names are demangled.
+
+        Like addr2line, where we know the function but not the line, we give
+        the file the symbol table says the function came from (or '??') and
+        line '?'.  Returns ('??', '??:0') if we know nothing about the address,
+        e.g. because it's past the end of the library's code.
+
+        """
+        if not self._in_section(address):
+            return '??', '??:0'
+        (func, file_name) = self._function_at(address)
+        location = self._line_table.lookup(address)
+        if location:
+            location = '%s:%d' % location
+        elif func:
+            location = ('??' if file_name is None else file_name) + ':?'
+        else:
+            location = '??:0'
+        return demangle.demangle(func or '??'), location
@@ -0,0 +1,246 @@
+"""A small, dependency-free reader for ELF files.
+
+We only read what the stack-fixing tools need: the section headers, the raw
+contents of a few sections, the build-id, and the function symbols.  The file
+is mmap'ed, so looking at a library's section headers touches only a few pages
+of it, no matter how large the library is.
+
+"""
+
+from __future__ import print_function
+
+import mmap
+import struct
+from collections import namedtuple
+
+# Values from the ELF spec which we care about.
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+SHT_SYMTAB = 2
+SHT_NOTE = 7
+SHT_NOBITS = 8
+SHT_DYNSYM = 11
+
+SHF_ALLOC = 0x2
+
+NT_GNU_BUILD_ID = 3
+
+EM_ARM = 40
+
+STT_FUNC = 2
+STT_FILE = 4
+STB_LOCAL = 0
+
+Section = namedtuple('Section',
+                     ['name', 'type', 'flags', 'addr', 'offset', 'size', 'link'])
+
+
+class ElfError(Exception):
+    """Raised when a file isn't an ELF file we know how to read."""
+    pass
+
+
+class ElfFile(object):
+    """A read-only view of an ELF file.
+
+    Please be kind and call close() once you're done with this object (or use
+    it in a with statement), so we can unmap the file.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            try:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error) as e:
+                # mmap refuses to map empty files.
+                raise ElfError('Could not map %s: %s' % (path, e))
+
+        try:
+            self._read_header()
+            self._read_section_headers()
+        except (struct.error, IndexError) as e:
+            self.close()
+            raise ElfError('%s is truncated or corrupt: %s' % (path, e))
+        except ElfError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _read_header(self):
+        ident = self._map[:16]
+        if len(ident) < 16 or ident[:4] != '\x7fELF':
+            raise ElfError('%s is not an ELF file' % self.path)
+
+        elf_class = ord(ident[4])
+        elf_data = ord(ident[5])
+        if elf_class not in (ELFCLASS32, ELFCLASS64):
+            raise ElfError('%s has unknown ELF class %d' % (self.path, elf_class))
+        if elf_data not in (ELFDATA2LSB, ELFDATA2MSB):
+            raise ElfError('%s has unknown ELF data encoding %d' %
+                           (self.path, elf_data))
+
+        self.is_64 = elf_class == ELFCLASS64
+        self.endian = '<' if elf_data == ELFDATA2LSB else '>'
+        self.address_size = 8 if self.is_64 else 4
+        (self.machine,) = struct.unpack_from(self.endian + 'H', self._map, 18)
+
+        if self.is_64:
+            (self._shoff, self._shentsize, self._shnum, self._shstrndx) = \
+                struct.unpack_from(self.endian + '40xQ10xHHH', self._map, 0)
+        else:
+            (self._shoff, self._shentsize, self._shnum, self._shstrndx) = \
+                struct.unpack_from(self.endian + '32xI10xHHH', self._map, 0)
+
+    def _read_section_headers(self):
+        if self.is_64:
+            fmt = self.endian + 'IIQQQQII'
+        else:
+            fmt = self.endian + 'IIIIIIII'
+
+        raw = []
+        for i in range(self._shnum):
+            raw.append(struct.unpack_from(fmt, self._map,
+                                          self._shoff + i * self._shentsize))
+
+        names = None
+        if self._shstrndx < len(raw):
+            strtab = raw[self._shstrndx]
+            names = (strtab[4], strtab[5])
+
+        self.sections = []
+        self._sections_by_name = {}
+        for (name_idx, sh_type, flags, addr, offset, size, link, _) in raw:
+            name = self._read_cstring(names[0] + name_idx) if names else ''
+            section = Section(name, sh_type, flags, addr, offset, size, link)
+            self.sections.append(section)
+            self._sections_by_name.setdefault(name, section)
+
+    def _read_cstring(self, offset):
+        end = self._map.find('\0', offset)
+        if end == -1:
+            raise ElfError('Unterminated string in %s' % self.path)
+        return self._map[offset:end]
+
+    def section(self, name):
+        """Get the Section named |name|, or None if there's no such section."""
+        return self._sections_by_name.get(name)
+
+    def has_section(self, name):
+        return name in self._sections_by_name
+
+    def section_data(self, name):
+        """Get the contents of the section named |name| as a string, or None if
+        there's no such section (or it occupies no space in the file).
+
+        """
+        section = self.section(name)
+        if not section or section.type == SHT_NOBITS:
+            return None
+        return self._map[section.offset:section.offset + section.size]
+
+    def build_id(self):
+        """Get this file's GNU build-id as a hex string, or None if it doesn't
+        have one.
+
+        The linker computes the build-id from the file's contents, so it
+        identifies a build of a library regardless of where the file lives or
+        when it was copied.  Stripping a library doesn't change its build-id.
+
+        """
+        for section in self.sections:
+            if section.type != SHT_NOTE:
+                continue
+            offset = section.offset
+            end = section.offset + section.size
+            while offset + 12 <= end:
+                (namesz, descsz, note_type) = \
+                    struct.unpack_from(self.endian + 'III', self._map, offset)
+                name_offset = offset + 12
+                desc_offset = name_offset + ((namesz + 3) & ~3)
+                name = self._map[name_offset:name_offset + namesz]
+                if note_type == NT_GNU_BUILD_ID and name == 'GNU\0':
+                    return self._map[desc_offset:desc_offset + descsz].encode('hex')
+                offset = desc_offset + ((descsz + 3) & ~3)
+        return None
+
+    def has_symbols(self):
+        """Check whether this file has a symbol table or debug info, i.e.
+        whether it has been stripped."""
+        return self.has_section('.symtab') or self.has_section('.debug_info')
+
+    def function_symbols(self, with_files=False):
+        """Get a list of (address, size, name) tuples for each function in this
+        file's symbol table.
+
+        We read .symtab if we have one, and .dynsym otherwise.  On ARM, the low
+        bit of a Thumb function's address is set; we clear it here.  Other
+        architectures' functions can start at odd addresses, so we leave
+        theirs alone.
+
+        If with_files is true, each tuple gets a fourth element, the name of
+        the source file the function came from (from the STT_FILE symbol
+        before it), or None if we can't tell.  Like addr2line, we trust that
+        only for local symbols, or when the file has a single STT_FILE
+        symbol, since the linker puts global symbols after all the files'
+        local ones.
+
+        """
+        symtab = self.section('.symtab') or self.section('.dynsym')
+        if not symtab or symtab.type not in (SHT_SYMTAB, SHT_DYNSYM):
+            return []
+        strtab = self.sections[symtab.link]
+
+        if self.is_64:
+            fmt = self.endian + 'IBBHQQ'
+        else:
+            fmt = self.endian + 'IIIBBH'
+        entsize = struct.calcsize(fmt)
+        address_mask = ~1 if self.machine == EM_ARM else ~0
+
+        symbols = []
+        file_name = None
+        # Whether we've seen an STT_FILE symbol after some other symbol.
+        seen_symbol = seen_file_after_symbol = False
+        # Symbol 0 is always a null symbol.
+        for offset in range(symtab.offset + entsize,
+                            symtab.offset + symtab.size, entsize):
+            if self.is_64:
+                (name_idx, info, _, shndx, value, size) = \
+                    struct.unpack_from(fmt, self._map, offset)
+            else:
+                (name_idx, value, size, info, _, shndx) = \
+                    struct.unpack_from(fmt, self._map, offset)
+            if info & 0xf == STT_FILE:
+                file_name = self._read_cstring(strtab.offset + name_idx)
+                seen_file_after_symbol = seen_symbol
+                continue
+            seen_symbol = True
+            if info & 0xf != STT_FUNC or not shndx or not name_idx:
+                continue
+            name = self._read_cstring(strtab.offset + name_idx)
+            is_global = info >> 4 != STB_LOCAL
+            symbol_file = None
+            if not is_global or not seen_file_after_symbol:
+                symbol_file = file_name
+            symbols.append((value & address_mask, size, name, symbol_file,
+                            is_global))
+
+        # When several symbols share an address, prefer the global ones.
+        symbols.sort(key=lambda s: (s[0], not s[4]))
+        if with_files:
+            return [s[:4] for s in symbols]
+        return [s[:3] for s in symbols]
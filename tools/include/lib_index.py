@@ -0,0 +1,195 @@
+"""A persistent index of the libraries under a set of directory trees.
+
+Walking a gecko objdir or a gonk product directory to find libxul.so takes a
+long time on a big tree.  LibIndex remembers, for every directory it has
+walked, the directory's mtime, its subdirectories, and the interesting files
+in it.  Adding or removing an entry in a directory changes that directory's
+mtime, so on the next run we only have to re-list the directories whose mtimes
+changed; for all the others, a stat() is enough.
+
+LibIndex also remembers facts we've computed about individual files (e.g.
+"this copy of libxul.so has symbols"), keyed on the file's size and mtime.
+
+"""
+
+from __future__ import print_function
+
+import os
+import time
+import tempfile
+import cPickle as pickle
+
+
+class LibIndex(object):
+    """Maps library basenames to the paths where they live.
+
+    index_filename is where we persist the index between runs.  roots is a
+    list of directories to search; they're searched in order, and each root is
+    walked top-down, so find() returns paths in the order os.walk would visit
+    them.  file_filter(basename) decides which files we index (default: all
+    of them), and we don't descend into directories named in exclude_dirs.
+
+    Please be kind and call save() once you're done with this object, so the
+    next run can reuse what we learned.
+
+    """
+    # Bump this whenever the format of the pickled index changes.
+    FORMAT_VERSION = 1
+
+    def __init__(self, index_filename, roots, file_filter=None, exclude_dirs=()):
+        self._index_filename = index_filename
+        self._roots = [os.path.normpath(root) for root in roots]
+        self._file_filter = file_filter or (lambda basename: True)
+        self._exclude_dirs = frozenset(exclude_dirs)
+        self._dirty = False
+        self._paths = None
+
+        data = self._load()
+        # dir path --> (mtime, [subdir names], [file names]).  An mtime of None
+        # means we must re-list the directory next time.
+        self._dirs = data.get('dirs', {})
+        # file path --> {fact name: ((size, mtime), value)}
+        self._file_facts = data.get('file_facts', {})
+
+    def _load(self):
+        try:
+            with open(self._index_filename, 'rb') as f:
+                data = pickle.load(f)
+            if data.get('version') == LibIndex.FORMAT_VERSION:
+                return data
+        except (EOFError, IOError, OSError, AttributeError, ValueError,
+                pickle.PickleError):
+            pass
+        return {}
+
+    def save(self):
+        """Write the index to disk, if it has changed.
+
+        We write to a temporary file and rename it into place, so concurrent
+        runs never see a half-written index.  If two runs save at once, the
+        last one wins, which is fine: either index is correct.
+
+        """
+        if not self._dirty:
+            return
+        directory = os.path.dirname(os.path.abspath(self._index_filename))
+        try:
+            (fd, tmp_filename) = tempfile.mkstemp(dir=directory,
+                                                  prefix='.lib_index')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump({'version': LibIndex.FORMAT_VERSION,
+                             'dirs': self._dirs,
+                             'file_facts': self._file_facts},
+                            f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_filename, self._index_filename)
+            self._dirty = False
+        except (IOError, OSError, pickle.PickleError):
+            pass
+
+    @staticmethod
+    def remove(index_filename):
+        try:
+            os.remove(index_filename)
+        except OSError:
+            pass
+
+    def invalidate(self):
+        """Make the next find() bring the index up to date with the filesystem
+        again.  Long-lived users call this when the trees they're searching
+        may have changed."""
+        self._paths = None
+
+    def find(self, basename):
+        """Get a list of the paths to files named basename, in search order."""
+        if self._paths is None:
+            self._refresh()
+        return self._paths.get(basename, [])
+
+    def _refresh(self):
+        """Bring the index up to date with the filesystem and build
+        self._paths."""
+        self._paths = {}
+        # Don't trust mtimes from the last couple of seconds: the directory
+        # could change again within the filesystem's timestamp granularity
+        # without its mtime changing.
+        trust_before = time.time() - 2
+        seen = set()
+        for root in self._roots:
+            self._refresh_dir(root, trust_before, seen)
+
+        # Forget about directories which no longer exist (or which are no
+        # longer under one of our roots).
+        for dir_path in self._dirs.keys():
+            if dir_path not in seen:
+                del self._dirs[dir_path]
+                self._dirty = True
+
+        indexed = set(path for paths in self._paths.itervalues()
+                      for path in paths)
+        for path in self._file_facts.keys():
+            if path not in indexed:
+                del self._file_facts[path]
+                self._dirty = True
+
+    def _refresh_dir(self, root, trust_before, seen):
+        stack = [root]
+        while stack:
+            dir_path = stack.pop()
+            if dir_path in seen:
+                continue
+            seen.add(dir_path)
+            try:
+                mtime = os.stat(dir_path).st_mtime
+            except OSError:
+                continue
+
+            entry = self._dirs.get(dir_path)
+            if entry is None or entry[0] is None or entry[0] != mtime:
+                entry = self._list_dir(dir_path, mtime, trust_before)
+                self._dirs[dir_path] = entry
+                self._dirty = True
+            (_, subdirs, files) = entry
+
+            for f in files:
+                self._paths.setdefault(f, []).append(os.path.join(dir_path, f))
+            # Push subdirectories in reverse so we pop them in listing order.
+            for d in reversed(subdirs):
+                stack.append(os.path.join(dir_path, d))
+
+    def _list_dir(self, dir_path, mtime, trust_before):
+        subdirs = []
+        files = []
+        try:
+            names = os.listdir(dir_path)
+        except OSError:
+            names = []
+        for name in names:
+            path = os.path.join(dir_path, name)
+            if os.path.isdir(path):
+                # Like os.walk, don't follow symlinks to directories.
+                if name not in self._exclude_dirs and not os.path.islink(path):
+                    subdirs.append(name)
+            elif self._file_filter(name):
+                files.append(name)
+        return (mtime if mtime < trust_before else None, subdirs, files)
+
+    def file_fact(self, path, name, compute):
+        """Get a cached fact about the file at path, computing and caching it
+        with compute(path) if we don't know it yet or the file has changed
+        since we computed it.
+
+        """
+        try:
+            st = os.stat(path)
+            stamp = (st.st_size, st.st_mtime)
+        except OSError:
+            return compute(path)
+
+        facts = self._file_facts.setdefault(path, {})
+        cached = facts.get(name)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        value = compute(path)
+        facts[name] = (stamp, value)
+        self._dirty = True
+        return value